@@ -0,0 +1,188 @@
+"""Local stub of the GitHub API serving generated or recorded search results, used by the
+benchmarks and the tests"""
+
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+FRAGMENT = 'config = {"access_token": "0123456789abcdefghijklmnopqrstuvwxyz"}'
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    """HTTP server handling each request on its own thread, http.server.ThreadingHTTPServer only
+        exists from Python 3.7"""
+
+    daemon_threads = True
+
+
+def search_item(scope, index, fragment=FRAGMENT, updated_at='2020-01-01T00:00:00Z'):
+    """A search result for the scope in the shape the GitHub API returns it"""
+
+    repository = {
+        'id': index % 50,
+        'node_id': 'MDEwOlJlcG9zaXRvcnk{}'.format(index % 50),
+        'name': 'repo{}'.format(index % 50),
+        'full_name': 'org/repo{}'.format(index % 50),
+        'html_url': 'https://github.example.com/org/repo{}'.format(index % 50)
+    }
+    text_matches = [{
+        'object_url': 'https://github.example.com/api/v3/objects/{}'.format(index),
+        'object_type': 'FileContent',
+        'fragment': fragment
+    }]
+    if scope == 'code':
+        return {
+            'name': 'config{}.py'.format(index),
+            'path': 'src/config{}.py'.format(index),
+            'sha': '{:040x}'.format(index),
+            'html_url': 'https://github.example.com/org/repo{}/blob/main/src/config{}.py'.format(index % 50, index),
+            'repository': repository,
+            'text_matches': text_matches
+        }
+    if scope == 'commits':
+        return {
+            'sha': '{:040x}'.format(index),
+            'node_id': 'MDY6Q29tbWl0{}'.format(index),
+            'html_url': 'https://github.example.com/org/repo{}/commit/{:040x}'.format(index % 50, index),
+            'comments_url': '',
+            'commit': {'committer': {'name': 'Tyrion', 'email': 'tyrion@example.com',
+                                     'date': updated_at.replace('Z', '.000+00:00')}},
+            # Every tenth commit isn't linked to an account
+            'committer': {'login': 'tyrion', 'id': 1} if index % 10 != 9 else None,
+            'repository': repository,
+            'text_matches': text_matches
+        }
+    if scope == 'issues':
+        return {
+            'id': index,
+            'title': 'Issue {}'.format(index),
+            'body': fragment,
+            'html_url': 'https://github.example.com/org/repo{}/issues/{}'.format(index % 50, index),
+            'user': {'login': 'tyrion', 'id': 1},
+            'state': 'open',
+            'updated_at': updated_at,
+            'repository_url': repository.get('html_url'),
+            'text_matches': text_matches
+        }
+    return {
+        'id': index,
+        'full_name': 'org/repo{}'.format(index),
+        'description': fragment,
+        'html_url': 'https://github.example.com/org/repo{}'.format(index),
+        'updated_at': updated_at,
+        'owner': {'login': 'org', 'id': 1},
+        'text_matches': text_matches
+    }
+
+
+class GitHubStub(object):
+    """Local HTTP server answering the GitHub API calls GitHub Watchman makes.
+
+        Every search returns `results` items, paginated like the real API and with rate limit
+        headers. Items are generated by search_item, or taken in turn from `items` when replaying
+        recorded responses. A size:low..high qualifier narrows the results to those whose index is in the
+        range. GraphQL nodes(ids:) lookups resolve the repository and commit node IDs in search
+        results. Responses queued in `failures` are returned, in order, before GET responses"""
+
+    def __init__(self, results=250, fragment=FRAGMENT, latency=0, search_limit=30, items=None):
+        self.results = results
+        self.items = items
+        self.fragment = fragment
+        self.latency = latency
+        self.search_limit = search_limit
+        self.failures = []
+        self.requests = []
+        self.lock = threading.Lock()
+        self.server = _Server(('127.0.0.1', 0), self._handler())
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/api/v3'.format(self.server.server_port)
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body=None, headers=None):
+                payload = json.dumps(body).encode('utf-8') if body is not None else b''
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                with stub.lock:
+                    stub.requests.append((self.path, body, dict(self.headers)))
+                nodes = []
+                for node_id in body.get('variables', {}).get('ids', []):
+                    if node_id.startswith('MDEwOlJlcG9zaXRvcnk'):
+                        nodes.append({'id': node_id, 'pushedAt': '2020-01-01T00:00:00Z',
+                                      'updatedAt': '2020-01-01T00:00:00Z', 'visibility': 'INTERNAL',
+                                      'defaultBranchRef': {'name': 'main'}})
+                    elif node_id.startswith('MDY6Q29tbWl0'):
+                        nodes.append({'id': node_id, 'committer': {
+                            'name': 'Tyrion', 'email': 'tyrion@example.com',
+                            'user': {'login': 'tyrion', 'databaseId': 1}}})
+                    else:
+                        nodes.append(None)
+                self._send(200, {'data': {'nodes': nodes}}, {'X-RateLimit-Resource': 'graphql'})
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = parse_qs(url.query)
+                with stub.lock:
+                    stub.requests.append((url.path, params, dict(self.headers)))
+                    failure = stub.failures.pop(0) if stub.failures else None
+                    remaining = max(stub.search_limit - len(stub.requests), 0)
+                if stub.latency:
+                    time.sleep(stub.latency)
+                if failure is not None:
+                    status, headers = failure
+                    return self._send(status, {'message': 'stub failure'}, headers)
+
+                rate_headers = {
+                    'X-RateLimit-Remaining': str(remaining),
+                    'X-RateLimit-Reset': str(int(time.time()) + 60)
+                }
+                scope = url.path.rsplit('/', 1)[1]
+                per_page = int(params.get('per_page', ['30'])[0])
+                page = int(params.get('page', ['1'])[0])
+                low, high = 0, stub.results - 1
+                size = re.search(r'size:(\d+)\.\.(\d+)', params.get('q', [''])[0])
+                if size:
+                    low, high = max(int(size.group(1)), low), min(int(size.group(2)), high)
+                matching = max(high - low + 1, 0)
+                total = min(matching, 1000)
+                last_page = max((total + per_page - 1) // per_page, 1)
+                start = low + (page - 1) * per_page
+                indexes = range(start, min(start + per_page, low + total))
+                if stub.items:
+                    items = [stub.items[index % len(stub.items)] for index in indexes]
+                else:
+                    items = [search_item(scope, index, stub.fragment) for index in indexes]
+                headers = dict(rate_headers, **{'X-RateLimit-Resource': 'search'})
+                if last_page > 1:
+                    headers['Link'] = '<{}{}?q=x&per_page={}&page={}>; rel="last"'.format(
+                        stub.url.rsplit('/api/v3', 1)[0], url.path, per_page, last_page)
+                self._send(200, {'total_count': matching, 'incomplete_results': False, 'items': items}, headers)
+
+        return Handler
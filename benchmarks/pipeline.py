@@ -0,0 +1,234 @@
+"""Benchmarks for each stage of the search pipeline, run against a local stub of the GitHub API.
+
+Run from the repository root:
+
+    python -m benchmarks.pipeline --hits 10000 --rules 16
+
+Every rule searches for one string, and the stub returns hits / rules code results for each
+search, generated or replayed from a recorded --fixture. For each stage the requests issued,
+wall time, time spent sleeping, peak memory allocated and results per second are reported.
+
+Memory is traced with tracemalloc from the start of each stage, so it is the peak of what the
+stage allocated. It includes the stub's threads but not memory allocated outside Python,
+and tracing slows allocation heavy stages a little"""
+
+import argparse
+import itertools
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+from unittest import mock
+
+import github_watchman.github_wrapper as github
+import github_watchman.logger as logger
+from github_watchman.cache import MatchCache
+from github_watchman.dedup import Deduplicator
+from github_watchman.ratelimit import RateLimiter
+from github_watchman.rule_engine import Rule, RuleEngine, load_rules
+from github_watchman.scheduler import ScanScheduler
+from benchmarks.github_stub import GitHubStub
+
+RULES_PATH = (Path(__file__).parents[1] / 'github_watchman/rules').resolve()
+COLUMNS = ('stage', 'requests', 'wall_s', 'sleep_s', 'peak_alloc_mb', 'results', 'results_per_s')
+
+
+class Stage(object):
+    """Measures one stage: wall time, sleeps, requests made to the stub and results handled"""
+
+    def __init__(self, name, stub):
+        self.name = name
+        self.stub = stub
+        self.results = 0
+        self.slept = 0
+        self.lock = threading.Lock()
+
+    def _sleep(self, seconds):
+        with self.lock:
+            self.slept += seconds
+        self.real_sleep(seconds)
+
+    def __enter__(self):
+        self.real_sleep = time.sleep
+        self.patch = mock.patch('time.sleep', self._sleep)
+        self.patch.start()
+        self.requests = len(self.stub.requests)
+        tracemalloc.start()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall = time.perf_counter() - self.started
+        self.peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.patch.stop()
+        self.requests = len(self.stub.requests) - self.requests
+
+    def row(self):
+        return {
+            'stage': self.name,
+            'requests': self.requests,
+            'wall_s': round(self.wall, 3),
+            'sleep_s': round(self.slept, 3),
+            'peak_alloc_mb': round(self.peak / 1024 / 1024, 1),
+            'results': self.results,
+            'results_per_s': round(self.results / self.wall) if self.wall else 0
+        }
+
+
+def benchmark_rules(count):
+    """count code rules made from the shipped ones, each searching for its own string"""
+
+    shipped = load_rules(RULES_PATH)
+    rules = []
+    for index, rule in zip(range(count), itertools.cycle(shipped)):
+        rules.append(Rule({
+            'filename': 'benchmark{}_{}'.format(index, rule.filename),
+            'enabled': True,
+            'meta': {'name': rule.name, 'severity': rule.severity},
+            'scope': ['code'],
+            'strings': ['"benchmark{}"'.format(index)],
+            'pattern': rule.pattern
+        }))
+    return rules
+
+
+def client(stub, workers, search_limit, match_cache=None):
+    return github.GitHubAPIClient('token', stub.url, max_workers=workers,
+                                  rate_limiter=RateLimiter(search_limit=search_limit), match_cache=match_cache)
+
+
+class Sink(object):
+    """TCP server that reads and discards whatever SocketJSONLogger sends it"""
+
+    def __init__(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+        threading.Thread(target=self._drain, daemon=True).start()
+
+    def _drain(self):
+        connection, _ = self.server.accept()
+        while connection.recv(65536):
+            pass
+        connection.close()
+
+
+def run(hits=10000, rules=16, workers=4, search_limit=100000, fixture=None, matcher='re'):
+    """Run every stage and return a row of measurements for each"""
+
+    rule_list = benchmark_rules(rules)
+    items = None
+    if fixture is not None:
+        with open(fixture) as fixture_file:
+            items = json.load(fixture_file)
+            items = items.get('items') if isinstance(items, dict) else items
+    rows = []
+    with GitHubStub(results=max(hits // rules, 1), items=items, search_limit=search_limit * 10) as stub:
+        github_client = client(stub, workers, search_limit)
+
+        with Stage('search', stub) as stage:
+            found = {rule.filename: list(github_client.iter_search('search/code', rule.strings[0]))
+                     for rule in rule_list}
+            stage.results = sum(len(results) for results in found.values())
+        rows.append(stage.row())
+
+        with Stage('filter', stub) as stage:
+            for rule in rule_list:
+                for item in found.get(rule.filename):
+                    rule.matches(item.get('text_matches'))
+                    stage.results += 1
+        rows.append(stage.row())
+
+        with Stage('filter:engine:{}'.format(matcher), stub) as stage:
+            engine = RuleEngine(rule_list, matcher)
+            for results in found.values():
+                for item in results:
+                    engine.match_item(item.get('text_matches'))
+                    stage.results += 1
+        rows.append(stage.row())
+
+        with Stage('filter:match_cache', stub) as stage:
+            match_cache = MatchCache()
+            for rule in rule_list:
+                for item in found.get(rule.filename):
+                    match_cache.matches(rule, item.get('sha'), item.get('text_matches'))
+                    stage.results += 1
+        rows.append(stage.row())
+
+        findings = [github._code_result(item) for results in found.values() for item in results]
+        with Stage('dedup', stub) as stage:
+            deduplicator = Deduplicator()
+            for finding in findings:
+                deduplicator.is_new('code', finding)
+                stage.results += 1
+        rows.append(stage.row())
+
+        log_path = tempfile.mkdtemp()
+        file_logger = logger.FileLogger(log_path)
+        with Stage('log:file', stub) as stage:
+            for finding in findings:
+                file_logger.log_notification(finding, 'code', 'Benchmark', 50)
+            file_logger.close()
+            stage.results = len(findings)
+        os.remove(os.path.join(log_path, 'github_watchman.log'))
+        rows.append(stage.row())
+
+        sink = Sink()
+        stream_logger = logger.SocketJSONLogger('127.0.0.1', sink.port,
+                                                spool_path=os.path.join(log_path, 'spool.ndjson'))
+        with Stage('log:stream', stub) as stage:
+            for finding in findings:
+                stream_logger.log_notification(finding, 'code', 'Benchmark', 50)
+            stream_logger.close()
+            stage.results = len(findings)
+        rows.append(stage.row())
+
+        with Stage('scan', stub) as stage:
+            def output(rule, scope, finding):
+                stage.results += 1
+
+            scheduler = ScanScheduler(client(stub, workers, search_limit), None, workers=workers)
+            with mock.patch('builtins.print'):
+                scheduler.run([(rule, 'code') for rule in rule_list], output)
+        rows.append(stage.row())
+
+    return rows
+
+
+def print_table(rows):
+    widths = [max(len(column), *(len(str(row.get(column))) for row in rows)) for column in COLUMNS]
+    print('  '.join(column.ljust(width) for column, width in zip(COLUMNS, widths)))
+    for row in rows:
+        print('  '.join(str(row.get(column)).ljust(width) for column, width in zip(COLUMNS, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the GitHub Watchman search pipeline against a local '
+                                                 'stub of the GitHub API')
+    parser.add_argument('--hits', type=int, default=10000, help='Code results across all rules (default: 10000)')
+    parser.add_argument('--rules', type=int, default=16, help='Rules to search for (default: 16)')
+    parser.add_argument('--workers', type=int, default=4, help='Worker threads (default: 4)')
+    parser.add_argument('--search-limit', dest='search_limit', type=int, default=100000,
+                        help='Search requests per minute the rate limiter allows (default: 100000)')
+    parser.add_argument('--fixture', help='JSON file of recorded search results, or a recorded search response, '
+                                          'to replay instead of generated ones')
+    parser.add_argument('--matcher', choices=['re', 're2', 'hyperscan'], default='re',
+                        help='Regex engine for the rule engine stage (default: re)')
+    parser.add_argument('--json', dest='json_path', help='Also write the measurements to this file')
+    args = parser.parse_args()
+
+    rows = run(args.hits, args.rules, args.workers, args.search_limit, args.fixture, args.matcher)
+    print_table(rows)
+    if args.json_path:
+        with open(args.json_path, 'w') as json_file:
+            json.dump(rows, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,26 @@
+# Imported first so --profile-startup can time the imports that follow
+import github_watchman.startup as startup
 import builtins
 import argparse
 import os
-import yaml
+import signal
+import sys
 import time
 from pathlib import Path
 from datetime import date
-from colorama import init, deinit
 from termcolor import colored
 
 import github_watchman.github_wrapper as github
 import github_watchman.__about__ as a
 import github_watchman.config as cfg
 import github_watchman.logger as logger
+import github_watchman.metrics as metrics
+import github_watchman.rule_engine as rule_engine
+from github_watchman.cache import CACHE_PATH, MatchCache, RepositoryCache
+from github_watchman.dedup import Deduplicator
+from github_watchman.ratelimit import MAX_RETRIES, RateLimiter
+from github_watchman.scheduler import ScanScheduler
+from github_watchman.state import ScanState
 
 
 RULES_PATH = (Path(__file__).parent / 'rules').resolve()
@@ -24,98 +33,57 @@ def validate_conf(path):
     if os.environ.get('GITHUB_WATCHMAN_TOKEN') and os.environ.get('GITHUB_WATCHMAN_URL'):
         return True
     if os.path.exists(path):
+        import yaml
+
         with open(path) as yaml_file:
             return yaml.safe_load(yaml_file).get('github_watchman')
 
 
-def search(github_connection, rule, tf, scope):
-    if isinstance(OUTPUT_LOGGER, logger.StdoutLogger):
-        print = OUTPUT_LOGGER.log_info
+def output_finding(rule, scope, finding):
+    """Send a finding to the selected output as soon as it is found"""
+
+    if isinstance(OUTPUT_LOGGER, logger.CSVLogger):
+        OUTPUT_LOGGER.write_row(csv_filename(rule), scope, finding)
+    elif isinstance(OUTPUT_LOGGER, logger.JSONLogger):
+        OUTPUT_LOGGER.log_notification(finding, scope, rule.name, rule.severity)
     else:
-        print = builtins.print
-    try:
-        if scope == 'code':
-            print(colored('Searching for {} in {}'.format(rule.get('meta').get('name'),
-                                                          'code'), 'yellow'))
+        # ParquetLogger, which is only imported when it is selected
+        OUTPUT_LOGGER.write_row(rule.filename.split('.')[0], scope, finding, rule.name, rule.severity)
 
-            code = github.search_code(github_connection, OUTPUT_LOGGER, rule, tf)
-            if code:
-                if isinstance(OUTPUT_LOGGER, logger.CSVLogger):
-                    OUTPUT_LOGGER.write_csv('exposed_{}'.format(rule.get('filename').split('.')[0]),
-                                            'code',
-                                            code)
-                else:
-                    for log_data in code:
-                        OUTPUT_LOGGER.log_notification(log_data, 'code', rule.get('meta').get('name'),
-                                                       rule.get('meta').get('severity'))
-                    print('Results output to log')
 
-        if scope == 'commits':
-            print(colored('Searching for {} in {}'.format(rule.get('meta').get('name'),
-                                                          'commits'), 'yellow'))
+def csv_filename(rule):
+    return 'exposed_{}'.format(rule.filename.split('.')[0])
 
-            commits = github.search_commits(github_connection, OUTPUT_LOGGER, rule, tf)
-            if commits:
-                if isinstance(OUTPUT_LOGGER, logger.CSVLogger):
-                    OUTPUT_LOGGER.write_csv('exposed_{}'.format(rule.get('filename').split('.')[0]),
-                                            'commits',
-                                            commits)
-                else:
-                    for log_data in commits:
-                        OUTPUT_LOGGER.log_notification(log_data, 'commits', rule.get('meta').get('name'),
-                                                       rule.get('meta').get('severity'))
-                    print('Results output to log')
 
-        if scope == 'issues':
-            print(colored('Searching for {} in {}'.format(rule.get('meta').get('name'),
-                                                          'issues'), 'yellow'))
+def complete_search(rule, scope, total):
+    """Called once all queries for a rule and scope have completed"""
 
-            issues = github.search_issues(github_connection, OUTPUT_LOGGER, rule, tf)
-            if issues:
-                if isinstance(OUTPUT_LOGGER, logger.CSVLogger):
-                    OUTPUT_LOGGER.write_csv('exposed_{}'.format(rule.get('filename').split('.')[0]),
-                                            'issues',
-                                            issues)
-                else:
-                    for log_data in issues:
-                        OUTPUT_LOGGER.log_notification(log_data, 'issues', rule.get('meta').get('name'),
-                                                       rule.get('meta').get('severity'))
-                    print('Results output to log')
+    if isinstance(OUTPUT_LOGGER, logger.StdoutLogger):
+        print = OUTPUT_LOGGER.log_info
+    else:
+        print = builtins.print
 
-        if scope == 'repositories':
-            print(colored('Searching for {} in {}'.format(rule.get('meta').get('name'),
-                                                          'repositories'), 'yellow'))
+    if isinstance(OUTPUT_LOGGER, logger.CSVLogger):
+        path = OUTPUT_LOGGER.complete(csv_filename(rule), scope)
+        if path:
+            print('CSV written: {}'.format(path))
+    elif isinstance(OUTPUT_LOGGER, logger.JSONLogger):
+        if total:
+            print('Results output to log')
+    else:
+        path = OUTPUT_LOGGER.complete(rule.filename.split('.')[0], scope)
+        if path:
+            print('Parquet written: {}'.format(path))
 
-            repositories = github.search_repositories(github_connection, OUTPUT_LOGGER, rule, tf)
-            if repositories:
-                if isinstance(OUTPUT_LOGGER, logger.CSVLogger):
-                    OUTPUT_LOGGER.write_csv('exposed_{}'.format(rule.get('filename').split('.')[0]),
-                                            'repositories',
-                                            repositories)
-                else:
-                    for log_data in repositories:
-                        OUTPUT_LOGGER.log_notification(log_data, 'wiki_blobs', rule.get('meta').get('name'),
-                                                       rule.get('meta').get('severity'))
-                    print('Results output to log')
-    except Exception as e:
-        if isinstance(OUTPUT_LOGGER, logger.StdoutLogger):
-            print = OUTPUT_LOGGER.log_critical
-        else:
-            print = builtins.print
 
-        print(colored(e, 'red'))
+def search(github_connection, rule, tf, scope):
+    ScanScheduler(github_connection, OUTPUT_LOGGER, tf, workers=1).run([(rule, scope)], output_finding,
+                                                                       complete_search)
 
 
-def load_rules():
-    rules = []
+def load_rules(cache_path=None):
     try:
-        for file in os.scandir(RULES_PATH):
-            if file.name.endswith('.yaml'):
-                with open(file) as yaml_file:
-                    rule = yaml.safe_load(yaml_file)
-                    if rule.get('enabled'):
-                        rules.append(rule)
-        return rules
+        return rule_engine.load_rules(RULES_PATH, cache_path)
     except Exception as e:
         if isinstance(OUTPUT_LOGGER, logger.StdoutLogger):
             print = OUTPUT_LOGGER.log_critical
@@ -127,16 +95,30 @@ def load_rules():
 
 def main():
     global OUTPUT_LOGGER
+    profile = startup.StartupProfile()
+    profile.mark('imports')
+    if sys.argv[1:2] == ['rules']:
+        import github_watchman.rule_profiler as rule_profiler
+        sys.exit(rule_profiler.main(sys.argv[2:]))
+    if sys.argv[1:2] == ['worker']:
+        import github_watchman.distributed as distributed
+        sys.exit(distributed.main(sys.argv[2:]))
     try:
-        init()
+        if os.name == 'nt':
+            # Only Windows consoles need colorama to show colours
+            from colorama import init
+            init()
 
         parser = argparse.ArgumentParser(description=a.__summary__)
         required = parser.add_argument_group('required arguments')
         required.add_argument('--timeframe', choices=['d', 'w', 'm', 'a'], dest='time',
                               help='How far back to search: d = 24 hours w = 7 days, m = 30 days, a = all time',
                               required=True)
-        required.add_argument('--output', choices=['csv', 'file', 'stdout', 'stream'], dest='logging_type',
+        required.add_argument('--output', choices=['csv', 'file', 'stdout', 'stream', 'parquet'],
+                              dest='logging_type',
                               help='Where to send results', required=True)
+        parser.add_argument('--csv-compression', dest='csv_compression', choices=['gzip', 'zstd'],
+                            help='Compress CSV output. zstd must be installed separately')
         parser.add_argument('--version', action='version',
                             version='github-watchman {}'.format(a.__version__))
         parser.add_argument('--all', dest='everything', action='store_true',
@@ -149,6 +131,51 @@ def main():
                             help='Search issues')
         parser.add_argument('--repositories', dest='repositories', action='store_true',
                             help='Search merge requests')
+        parser.add_argument('--workers', dest='workers', type=int, default=4,
+                            help='Number of searches to run in parallel (default: 4)')
+        parser.add_argument('--async', dest='event_loop', action='store_true',
+                            help='Send every request from one asyncio event loop with pooled keep-alive connections, '
+                                 'so --workers can be raised to hundreds. aiohttp must be installed separately')
+        parser.add_argument('--max-retries', dest='max_retries', type=int, default=MAX_RETRIES,
+                            help='Times to retry a failed request, with backoff, before giving up '
+                                 '(default: {})'.format(MAX_RETRIES))
+        parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+                            help='Don\'t cache repository metadata, rule matches and parsed rules in '
+                                 '~/.cache/github-watchman')
+        parser.add_argument('--incremental', dest='incremental', action='store_true',
+                            help='Only search for activity since the last run and skip results already reported')
+        parser.add_argument('--dedup-across-rules', dest='dedup_across_rules', action='store_true',
+                            help='Only report each result for the first rule that finds it')
+        parser.add_argument('--no-merge-queries', dest='merge_queries', action='store_false',
+                            help='Search for each string of each rule separately, instead of combining the strings '
+                                 'of every rule into as few searches as possible')
+        parser.add_argument('--clone', dest='clone_owners', action='append', metavar='OWNER',
+                            help='Mirror the repositories of an organisation or user and scan their full history '
+                                 'for code and commits locally instead of using the search API. Can be given more '
+                                 'than once')
+        parser.add_argument('--matcher', dest='matcher', choices=['re', 're2', 'hyperscan'], default='re',
+                            help='Regex engine that matches every rule against the content of cloned repositories in '
+                                 'one pass. re2 and hyperscan must be installed separately (default: re)')
+        parser.add_argument('--clone-path', dest='clone_path',
+                            help='Where to keep mirrors of cloned repositories '
+                                 '(default: {})'.format(os.path.join(CACHE_PATH, 'mirrors')))
+        parser.add_argument('--daemon', dest='daemon', action='store_true',
+                            help='Keep running, scanning each rule and scope again on its interval for activity since '
+                                 'the last scan, and reload rules when their files change')
+        parser.add_argument('--interval', dest='interval', default='1h',
+                            help='How often the daemon scans each rule and scope, in seconds or with an s, m, h or d '
+                                 'suffix. Rules can set their own interval (default: 1h)')
+        parser.add_argument('--queue', dest='queue', metavar='URL',
+                            help='Publish the searches to a work queue for `github-watchman worker` processes on this '
+                                 'or other hosts to run, and output what they find. URL is sqlite:///path/to/queue.db '
+                                 'or redis://host:port/db')
+        parser.add_argument('--metrics-port', dest='metrics_port', type=int, metavar='PORT',
+                            help='Serve request, timing and finding metrics for Prometheus at '
+                                 'http://127.0.0.1:PORT/metrics while the scan runs')
+        parser.add_argument('--metrics-summary', dest='metrics_summary', metavar='PATH',
+                            help='Write a JSON summary of the scan\'s metrics to PATH when it finishes')
+        parser.add_argument('--profile-startup', dest='profile_startup', action='store_true',
+                            help='Show how long each phase of starting up took before scanning')
 
         args = parser.parse_args()
         tm = args.time
@@ -158,6 +185,25 @@ def main():
         repositories = args.repositories
         issues = args.issues
         logging_type = args.logging_type
+        csv_compression = args.csv_compression
+        workers = args.workers
+        event_loop = args.event_loop
+        max_retries = args.max_retries
+        no_cache = args.no_cache
+        incremental = args.incremental
+        dedup_across_rules = args.dedup_across_rules
+        merge_queries = args.merge_queries
+        clone_owners = args.clone_owners
+        clone_path = args.clone_path
+        matcher = args.matcher
+        profile_startup = args.profile_startup
+        daemon_mode = args.daemon
+        interval = args.interval
+        queue_url = args.queue
+        metrics_port = args.metrics_port
+        metrics_summary = args.metrics_summary
+        metrics_server = metrics.MetricsServer(metrics_port) if metrics_port else None
+        profile.mark('arguments')
 
         if tm == 'd':
             tf = cfg.DAY_TIMEFRAME
@@ -177,7 +223,13 @@ def main():
                 .format(os.path.expanduser('~')))
         else:
             config = validate_conf(conf_path)
-            connection = github.initiate_github_connection()
+            profile.mark('config')
+            repository_cache = None if no_cache else RepositoryCache()
+            match_cache = MatchCache(None if no_cache else CACHE_PATH)
+            connection = github.initiate_github_connection(max_workers=workers, repository_cache=repository_cache,
+                                                           rate_limiter=RateLimiter(max_retries=max_retries),
+                                                           match_cache=match_cache, event_loop=event_loop)
+            profile.mark('connection')
 
         if logging_type:
             if logging_type == 'file':
@@ -201,11 +253,18 @@ def main():
                                                             config.get('logging').get('json_tcp').get('port'))
                 else:
                     raise Exception("JSON TCP stream selected with no config")
+            elif logging_type == 'parquet':
+                import github_watchman.parquet_logger as parquet_logger
+                parquet_path = os.environ.get('GITHUB_WATCHMAN_PARQUET_PATH') or \
+                    ((config.get('logging') or {}).get('parquet') or {}).get('path')
+                OUTPUT_LOGGER = parquet_logger.ParquetLogger(parquet_path)
             else:
-                OUTPUT_LOGGER = logger.CSVLogger()
+                OUTPUT_LOGGER = logger.CSVLogger(compression=csv_compression)
         else:
             print('No logging option selected, defaulting to CSV')
-            OUTPUT_LOGGER = logger.CSVLogger()
+            OUTPUT_LOGGER = logger.CSVLogger(compression=csv_compression)
+        connection.log_handler = OUTPUT_LOGGER
+        profile.mark('output')
 
         now = int(time.time())
         today = date.today().strftime('%Y-%m-%d')
@@ -233,52 +292,98 @@ def main():
             print('Version: {}\n'.format(a.__version__))
             print('Searching from {} to {}'.format(start_date, today))
             print('Importing rules...')
-            rules_list = load_rules()
+            rules_list = load_rules(None if no_cache else CACHE_PATH)
             print('{} rules loaded'.format(len(rules_list)))
         else:
             OUTPUT_LOGGER.log_info('GitHub Watchman started execution')
             OUTPUT_LOGGER.log_info('Version: {}'.format(a.__version__))
             OUTPUT_LOGGER.log_info('Importing rules...')
-            rules_list = load_rules()
+            rules_list = load_rules(None if no_cache else CACHE_PATH)
             OUTPUT_LOGGER.log_info('{} rules loaded'.format(len(rules_list)))
             print = OUTPUT_LOGGER.log_info
+        profile.mark('rules')
+        if profile_startup:
+            print(profile.report())
 
+        scopes = []
         if everything:
             print(colored('Getting everything...', 'magenta'))
-            for rule in rules_list:
-                if 'code' in rule.get('scope'):
-                    search(connection, rule, tf, 'code')
-                if 'commits' in rule.get('scope'):
-                    search(connection, rule, tf, 'commits')
-                if 'issues' in rule.get('scope'):
-                    search(connection, rule, tf, 'issues')
-                if 'repositories' in rule.get('scope'):
-                    search(connection, rule, tf, 'repositories')
+            scopes = ['code', 'commits', 'issues', 'repositories']
         else:
             if code:
                 print(colored('Searching blobs', 'magenta'))
-                for rule in rules_list:
-                    if 'code' in rule.get('scope'):
-                        search(connection, rule, tf, 'code')
+                scopes.append('code')
             if commits:
                 print(colored('Searching commits', 'magenta'))
-                for rule in rules_list:
-                    if 'commits' in rule.get('scope'):
-                        search(connection, rule, tf, 'commits')
+                scopes.append('commits')
             if issues:
                 print(colored('Searching issues', 'magenta'))
-                for rule in rules_list:
-                    if 'issues' in rule.get('scope'):
-                        search(connection, rule, tf, 'issues')
+                scopes.append('issues')
             if repositories:
                 print(colored('Searching repositories', 'magenta'))
-                for rule in rules_list:
-                    if 'repositories' in rule.get('scope'):
-                        search(connection, rule, tf, 'repositories')
+                scopes.append('repositories')
+
+        if everything:
+            jobs = [(rule, scope) for rule in rules_list for scope in scopes if scope in rule.scope]
+        else:
+            jobs = [(rule, scope) for scope in scopes for rule in rules_list if scope in rule.scope]
+        match_cache.invalidate(rules_list)
+        deduplicator = Deduplicator() if dedup_across_rules else None
+        if clone_owners and daemon_mode:
+            raise Exception(colored('--clone can\'t be used with --daemon', 'red'))
+        if queue_url and daemon_mode:
+            raise Exception(colored('--queue can\'t be used with --daemon', 'red'))
+        if clone_owners:
+            import github_watchman.clone_scan as clone_scan
+            print(colored('Mirroring repositories of {}'.format(', '.join(clone_owners)), 'magenta'))
+            repositories = [clone_scan.MirrorRepository.from_api(repository) for owner in clone_owners
+                            for repository in connection.get_repositories(owner)]
+            print('{} repositories to scan'.format(len(repositories)))
+            scanner = clone_scan.CloneScanner(OUTPUT_LOGGER, clone_path or clone_scan.MIRROR_PATH, tf, workers=workers,
+                                              token=connection.token, deduplicator=deduplicator, matcher=matcher)
+            scanner.run(repositories, jobs, output_finding, complete_search)
+            jobs = [(rule, scope) for rule, scope in jobs if scope not in clone_scan.SCOPES]
+        if daemon_mode:
+            import github_watchman.daemon as daemon
+            watcher = daemon.Daemon(connection, OUTPUT_LOGGER, RULES_PATH, scopes, ScanState(), output_finding,
+                                    complete_search, rules=rules_list, timeframe=tf,
+                                    interval=daemon.parse_interval(interval), workers=workers,
+                                    dedup_across_rules=dedup_across_rules, merge_queries=merge_queries,
+                                    cache_path=None if no_cache else CACHE_PATH)
+            signal.signal(signal.SIGTERM, lambda signum, frame: watcher.stop())
+            print(colored('Running as a daemon, scanning every {} unless a rule sets its own interval. '
+                          'Stop with Ctrl+C or SIGTERM'.format(interval), 'magenta'))
+            try:
+                watcher.run()
+            except KeyboardInterrupt:
+                print(colored('Stopping...', 'magenta'))
+        elif queue_url:
+            import github_watchman.distributed as distributed
+            work_queue = distributed.open_queue(queue_url)
+            state = ScanState() if incremental else None
+            distributed.DistributedScheduler(connection, OUTPUT_LOGGER, work_queue, tf, state=state,
+                                             deduplicator=deduplicator, merge_queries=merge_queries).run(
+                jobs, output_finding, complete_search)
+            work_queue.close()
+        else:
+            state = ScanState() if incremental else None
+            ScanScheduler(connection, OUTPUT_LOGGER, tf, workers=workers, state=state,
+                          deduplicator=deduplicator, merge_queries=merge_queries).run(jobs, output_finding,
+                                                                                      complete_search)
+        match_cache.close()
+        connection.close()
+        OUTPUT_LOGGER.close()
+        if metrics_summary:
+            metrics.REGISTRY.write_summary(metrics_summary)
+            print('Metrics summary written: {}'.format(metrics_summary))
+        if metrics_server is not None:
+            metrics_server.close()
 
         print(colored('++++++Audit completed++++++', 'green'))
 
-        deinit()
+        if os.name == 'nt':
+            from colorama import deinit
+            deinit()
 
     except Exception as e:
         if isinstance(OUTPUT_LOGGER, logger.StdoutLogger):
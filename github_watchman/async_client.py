@@ -0,0 +1,264 @@
+import asyncio
+import json
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+
+import requests
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+import github_watchman.logger as logger
+import github_watchman.metrics as metrics
+from github_watchman.github_wrapper import GitHubAPIClient
+from github_watchman.ratelimit import RateLimiter, retry_message
+from github_watchman.sharding import SEARCH_RESULT_CAP, Shard
+
+TEXT_MATCH_MEDIA_TYPE = 'application/vnd.github.v3.text-match+json'
+
+
+class AsyncGitHubAPIClient(object):
+    """asyncio counterpart to GitHubAPIClient, for running many requests from one event loop.
+
+        Connections are pooled and kept alive up to connection_limit, and every request carries
+        its own media type so the client can be shared freely between tasks. Retries, rate
+        limits and query sharding are handled the same way as the threaded client, and a
+        RateLimiter can be shared between the two. Requires aiohttp, install with
+        `pip install github-watchman[async]`"""
+
+    def __init__(self, token, base_url, connection_limit=100, rate_limiter=None, timeout=60, log_handler=None):
+        if aiohttp is None:
+            raise ImportError('aiohttp is required for the asyncio client: pip install github-watchman[async]')
+        self.token = token
+        self.per_page = 100
+        self.connection_limit = connection_limit
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.log_handler = log_handler
+        self.session = None
+
+        if 'https://api.github.com' not in base_url and 'api/v3' not in base_url:
+            self.base_url = '/'.join((base_url.rstrip('/'), 'api/v3'))
+        else:
+            self.base_url = base_url.rstrip('/')
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def open(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.connection_limit),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            headers={'Authorization': 'token {}'.format(self.token)})
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def send(self, method, url, params=None, data=None, headers=None, verify_ssl=True):
+        """Send a single request once the rate limiter allows it, without retrying"""
+
+        resource = self.rate_limiter.resource(url)
+        await self.rate_limiter.acquire_async(resource)
+        endpoint = metrics.endpoint(url)
+        started = time.perf_counter()
+        async with self.session.request(method, url, params=params, data=data, headers=headers,
+                                        ssl=None if verify_ssl else False) as response:
+            metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint)
+            metrics.RESPONSES.inc(endpoint=endpoint, status=response.status)
+            self.rate_limiter.update(resource, response.headers)
+            body = await response.read()
+            links = {rel: {'url': str(link.get('url'))} for rel, link in response.links.items()}
+            return AsyncResponse(str(response.url), response.status, response.headers, links, body)
+
+    async def make_request(self, url, params=None, data=None, method='GET', media_type=TEXT_MATCH_MEDIA_TYPE,
+                           headers=None):
+        """Make a request, retrying with backoff as the rate limiter allows. Raises an exception
+            if the request still fails"""
+
+        request_headers = {'Accept': media_type}
+        request_headers.update(headers or {})
+
+        resource = self.rate_limiter.resource(url)
+        attempt = 0
+        while True:
+            try:
+                response = await self.send(method, url, params, data, request_headers)
+            except aiohttp.ClientConnectionError:
+                delay = self.rate_limiter.retry_delay(resource, attempt)
+                if delay is None:
+                    raise
+                logger.print_info(self.log_handler, retry_message(None, {}))
+            else:
+                if response.status_code < 400:
+                    return response
+                delay = self.rate_limiter.retry_delay(resource, attempt, response.status_code, response.headers,
+                                                      response.text)
+                if delay is None:
+                    response.raise_for_status()
+                logger.print_info(self.log_handler, retry_message(response.status_code, response.headers))
+            metrics.SLEEP_SECONDS.inc(delay, reason='backoff')
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def iter_search(self, url, query, media_type=TEXT_MATCH_MEDIA_TYPE):
+        """Async generator over the items of a paginated search. Once the first page gives the
+            number of pages, the rest are all requested at once and yielded in page order.
+
+            Searches matching more than the 1000 results the API returns are split into shards
+            as GitHubAPIClient.iter_search does, with the first pages of each round of shards
+            requested at once"""
+
+        endpoint = '/'.join((self.base_url, url))
+
+        def get_page(search_query, page):
+            params = {
+                'per_page': self.per_page,
+                'q': search_query,
+                'page': page
+            }
+            metrics.PAGES.inc(endpoint=url)
+            return asyncio.ensure_future(self.make_request(endpoint, params=params, media_type=media_type))
+
+        searches = [(query, None)]
+        while searches:
+            next_searches = []
+            first_pages = [get_page(search_query, 1) for search_query, _ in searches]
+            try:
+                for (search_query, shard), first_page in zip(searches, first_pages):
+                    response = await first_page
+                    body = response.json()
+                    if body.get('total_count', 0) > SEARCH_RESULT_CAP:
+                        if shard is None:
+                            shard = Shard.for_endpoint(url, query)
+                        if shard is not None and shard.splittable():
+                            next_searches.extend((part.query, part) for part in shard.split())
+                            continue
+                        logger.print_info(self.log_handler, '{} results for {}, only the first {} can be returned'
+                                          .format(body.get('total_count'), search_query, SEARCH_RESULT_CAP))
+
+                    for item in body.get('items'):
+                        yield item
+                    if response.links.get('last'):
+                        last_url = response.links.get('last').get('url')
+                        total_pages = int(parse_qs(urlparse(last_url).query).get('page')[0])
+                        pages = [get_page(search_query, page) for page in range(2, total_pages + 1)]
+                        try:
+                            for page in pages:
+                                for item in (await page).json().get('items'):
+                                    yield item
+                        finally:
+                            for page in pages:
+                                page.cancel()
+            finally:
+                for first_page in first_pages:
+                    first_page.cancel()
+            searches = next_searches
+
+    async def multipage_search(self, url, query, media_type=TEXT_MATCH_MEDIA_TYPE):
+        return [item async for item in self.iter_search(url, query, media_type)]
+
+    @property
+    def graphql_url(self):
+        # GitHub Enterprise serves GraphQL from /api/graphql rather than under /api/v3
+        if self.base_url.endswith('/api/v3'):
+            return '{}/graphql'.format(self.base_url[:-len('/v3')])
+        return '/'.join((self.base_url, 'graphql'))
+
+    async def graphql(self, query, variables=None):
+        """Run a GraphQL query and return its data. Raises an exception if GitHub returned
+            errors and no data"""
+
+        response = await self.make_request(self.graphql_url, data=json.dumps({'query': query,
+                                                                              'variables': variables or {}}),
+                                           method='POST', media_type='application/json')
+        body = response.json()
+        if body.get('errors') and not body.get('data'):
+            raise Exception('GraphQL Error: {}'.format(body.get('errors')[0].get('message')))
+        return body.get('data')
+
+    async def get_user(self):
+        return (await self.make_request('/'.join((self.base_url, 'user')))).json()
+
+    async def get_repository(self, fullname):
+        return (await self.make_request('/'.join((self.base_url, 'repos/{}'.format(fullname))))).json()
+
+
+class EventLoopGitHubAPIClient(GitHubAPIClient):
+    """GitHubAPIClient that sends every request through an AsyncGitHubAPIClient, on one event loop
+        running in a background thread.
+
+        The query functions, sharding, enrichment and caches of the threaded client are used as
+        they are. Scan workers only wait on the loop, which holds every connection, so the number
+        of searches in flight is limited by the rate limiter rather than by connection pools"""
+
+    def __init__(self, token, base_url, max_workers=4, rate_limiter=None, repository_cache=None, match_cache=None,
+                 log_handler=None, connection_limit=100):
+        super().__init__(token, base_url, max_workers=max_workers, rate_limiter=rate_limiter,
+                         repository_cache=repository_cache, match_cache=match_cache, log_handler=log_handler)
+        self.client = AsyncGitHubAPIClient(token, base_url, connection_limit=connection_limit,
+                                           rate_limiter=self.rate_limiter)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='github-watchman-event-loop', daemon=True)
+        self.thread.start()
+        self._run(self.client.open())
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def _send(self, method, url, params, data, verify_ssl, headers):
+        request_headers = {'Accept': TEXT_MATCH_MEDIA_TYPE}
+        request_headers.update(headers or {})
+        try:
+            return self._run(self.client.send(method, url, params, data, request_headers, verify_ssl))
+        except aiohttp.ClientConnectionError as connection_error:
+            # make_request retries connection errors from requests
+            raise requests.exceptions.ConnectionError(connection_error)
+
+    def close(self):
+        if self.loop.is_closed():
+            return
+        self._run(self.client.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        super().close()
+
+
+class AsyncResponse(object):
+    """The parts of an aiohttp response the clients need, read before the connection is released.
+        Attributes are named as on a requests response"""
+
+    __slots__ = ('url', 'status_code', 'headers', 'links', 'body')
+
+    def __init__(self, url, status_code, headers, links, body):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.links = links
+        self.body = body
+
+    @property
+    def text(self):
+        return self.body.decode('utf-8', 'replace')
+
+    def json(self):
+        return json.loads(self.body.decode('utf-8')) if self.body else None
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            try:
+                message = (self.json() or {}).get('message')
+            except ValueError:
+                message = None
+            if isinstance(message, dict):
+                message = message.get('error')
+            raise Exception('{} Error: {} for url: {}'.format(self.status_code, message or self.text, self.url))
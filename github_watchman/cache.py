@@ -0,0 +1,199 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'github-watchman')
+# How long a cached repository is used before it is looked up again
+REPOSITORY_TTL = 3600
+# Entries not refreshed for this long are evicted from disk
+REPOSITORY_MAX_AGE = 30 * 86400
+# Match verdicts kept in memory, and not used for this long evicted from disk
+MATCH_CACHE_SIZE = 100000
+MATCH_MAX_AGE = 90 * 86400
+# Verdicts written to disk together
+MATCH_FLUSH_SIZE = 500
+
+
+class CachedRepository(object):
+    __slots__ = ('data', 'fetched')
+
+    def __init__(self, data, fetched):
+        self.data = data
+        self.fetched = fetched
+
+
+class RepositoryCache(object):
+    """Repository metadata looked up with GraphQL, cached in SQLite between runs with an
+        in-process LRU in front. Entries are keyed on the repository's GraphQL node ID.
+
+        GraphQL has no conditional requests, so stale entries are not revalidated with an ETag as
+        REST lookups were. They are looked up again with the rest of their batch, which costs one
+        request per 100 repositories where revalidating cost one per repository"""
+
+    def __init__(self, path=CACHE_PATH, ttl=REPOSITORY_TTL, max_age=REPOSITORY_MAX_AGE, lru_size=1024):
+        self.ttl = ttl
+        self.max_age = max_age
+        self.lru_size = lru_size
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(path, 'repositories.db'), check_same_thread=False)
+        with self.connection:
+            # Left by earlier versions, which kept REST lookups keyed on full name in the same table
+            self.connection.execute('DROP TABLE IF EXISTS repositories')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS repository_nodes '
+                                    '(node_id TEXT PRIMARY KEY, data TEXT, fetched REAL)')
+            self.connection.execute('DELETE FROM repository_nodes WHERE fetched < ?', (time.time() - self.max_age,))
+
+    def _remember(self, node_id, entry):
+        self.lru[node_id] = entry
+        self.lru.move_to_end(node_id)
+        if len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
+
+    def get(self, node_id):
+        """Return the CachedRepository for node_id, or None if it has never been looked up"""
+
+        with self.lock:
+            entry = self.lru.get(node_id)
+            if entry is not None:
+                self.lru.move_to_end(node_id)
+                return entry
+            row = self.connection.execute('SELECT data, fetched FROM repository_nodes WHERE node_id = ?',
+                                          (node_id,)).fetchone()
+            if row is None:
+                return None
+            entry = CachedRepository(json.loads(row[0]), row[1])
+            self._remember(node_id, entry)
+            return entry
+
+    def is_fresh(self, entry):
+        return time.time() - entry.fetched < self.ttl
+
+    def put(self, node_id, data):
+        entry = CachedRepository(data, time.time())
+        with self.lock:
+            self._remember(node_id, entry)
+            with self.connection:
+                self.connection.execute('INSERT OR REPLACE INTO repository_nodes VALUES (?, ?, ?)',
+                                        (node_id, json.dumps(data), entry.fetched))
+        return entry
+
+    def close(self):
+        self.connection.close()
+
+
+class CachedMatch(object):
+    __slots__ = ('pattern_id', 'matched', 'digest', 'fragments')
+
+    def __init__(self, pattern_id, matched, digest, fragments):
+        self.pattern_id = pattern_id
+        self.matched = matched
+        self.digest = digest
+        self.fragments = fragments
+
+
+def fragments_digest(fragments):
+    return hashlib.sha1('\0'.join(fragments).encode('utf-8')).hexdigest()
+
+
+class MatchCache(object):
+    """Whether a rule matched a blob, and the fragments it matched, keyed on the blob sha and rule.
+        Copies of a file in forks and vendored directories are then only matched once.
+
+        Search results for the same blob can carry different fragments depending on the query, so
+        a match is reused for any of them but a miss only for the same fragments. Entries for an
+        older version of a rule's pattern are ignored. Verdicts are kept in an LRU and, when a path
+        is given, in SQLite between runs"""
+
+    def __init__(self, path=None, size=MATCH_CACHE_SIZE, max_age=MATCH_MAX_AGE):
+        self.size = size
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+        self.pending = []
+        self.connection = None
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            self.connection = sqlite3.connect(os.path.join(path, 'matches.db'), check_same_thread=False)
+            with self.connection:
+                self.connection.execute('CREATE TABLE IF NOT EXISTS matches '
+                                        '(sha TEXT, rule TEXT, pattern_id TEXT, matched INTEGER, digest TEXT, '
+                                        'fragments TEXT, used REAL, PRIMARY KEY (sha, rule)) WITHOUT ROWID')
+                self.connection.execute('DELETE FROM matches WHERE used < ?', (time.time() - max_age,))
+
+    def _remember(self, key, entry):
+        self.lru[key] = entry
+        self.lru.move_to_end(key)
+        if len(self.lru) > self.size:
+            self.lru.popitem(last=False)
+
+    def get(self, sha, rule):
+        """Return the CachedMatch of the rule's current pattern for the blob, or None"""
+
+        key = (sha, rule.filename)
+        with self.lock:
+            entry = self.lru.get(key)
+            if entry is not None:
+                self.lru.move_to_end(key)
+            elif self.connection is not None:
+                row = self.connection.execute('SELECT pattern_id, matched, digest, fragments FROM matches '
+                                              'WHERE sha = ? AND rule = ?', key).fetchone()
+                if row is not None:
+                    entry = CachedMatch(row[0], bool(row[1]), row[2], tuple(json.loads(row[3])))
+                    self._remember(key, entry)
+        if entry is None or entry.pattern_id != rule.pattern_id:
+            return None
+        return entry
+
+    def put(self, sha, rule, matched, digest, fragments=()):
+        entry = CachedMatch(rule.pattern_id, matched, digest, tuple(fragments))
+        with self.lock:
+            self._remember((sha, rule.filename), entry)
+            if self.connection is not None:
+                self.pending.append((sha, rule.filename, entry.pattern_id, int(matched), digest,
+                                     json.dumps(entry.fragments), time.time()))
+                if len(self.pending) >= MATCH_FLUSH_SIZE:
+                    self._flush()
+        return entry
+
+    def _flush(self):
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO matches VALUES (?, ?, ?, ?, ?, ?, ?)', self.pending)
+        self.pending = []
+
+    def matches(self, rule, sha, text_matches):
+        """Check whether the rule matches any fragment of a search result for the blob, using the
+            cached verdict where there is one"""
+
+        fragments = [match.get('fragment') or '' for match in text_matches or []]
+        digest = fragments_digest(fragments)
+        entry = self.get(sha, rule)
+        if entry is not None and (entry.matched or entry.digest == digest):
+            return entry.matched
+        matched = tuple(fragment for fragment in fragments if rule.search(fragment))
+        self.put(sha, rule, bool(matched), digest, matched)
+        return bool(matched)
+
+    def invalidate(self, rules):
+        """Drop stored verdicts of the rules made with a different version of their pattern"""
+
+        pattern_ids = {rule.filename: rule.pattern_id for rule in rules}
+        with self.lock:
+            for key in [key for key, entry in self.lru.items()
+                        if pattern_ids.get(key[1], entry.pattern_id) != entry.pattern_id]:
+                del self.lru[key]
+            if self.connection is not None:
+                with self.connection:
+                    self.connection.executemany('DELETE FROM matches WHERE rule = ? AND pattern_id != ?',
+                                                pattern_ids.items())
+
+    def close(self):
+        if self.connection is not None:
+            with self.lock:
+                if self.pending:
+                    self._flush()
+            self.connection.close()
@@ -0,0 +1,410 @@
+import base64
+import os
+import re
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+from itertools import islice
+from termcolor import colored
+
+import github_watchman.config as cfg
+import github_watchman.github_wrapper as github
+import github_watchman.logger as logger
+import github_watchman.metrics as metrics
+from github_watchman.cache import CACHE_PATH
+from github_watchman.dedup import Deduplicator
+from github_watchman.rule_engine import RuleEngine
+
+MIRROR_PATH = os.path.join(CACHE_PATH, 'mirrors')
+# The scopes a local scan can cover, issues and repositories only exist in the API
+SCOPES = ('code', 'commits')
+# Larger blobs are skipped, like GitHub's code search does for files over 384 KB
+MAX_BLOB_SIZE = 1024 * 1024
+# Matches reported per rule for a single blob or commit message
+MAX_FRAGMENTS = 10
+# Characters kept either side of a match in its fragment
+FRAGMENT_CONTEXT = 80
+# Bytes read from git at a time when streaming its output
+READ_SIZE = 65536
+NULL_SHA = '0' * 40
+SUBMODULE_MODE = '160000'
+# git log separators between commits, the fields of a commit and its message and changed files
+COMMIT_SEPARATOR = '\x1e'
+FIELD_SEPARATOR = '\x1f'
+RAW_SEPARATOR = '\x1d'
+LOG_FORMAT = '%x1e%H%x1f%cn%x1f%ce%x1f%cI%x1f%B%x1d'
+# Blobs each worker process remembers the matching rules of, least recently seen are dropped
+BLOB_MATCH_CACHE_SIZE = 100000
+# The token is passed to git with GIT_CONFIG_COUNT, which git only reads from 2.31
+MIN_GIT_VERSION = (2, 31)
+
+# Each worker process builds its rule engines once, and remembers which rules matched each blob
+# it has scanned so a blob shared between commits, branches or repositories is only read once
+_ENGINES = {}
+# The rules and matcher the engines were built for
+_ENGINES_KEY = None
+_BLOB_MATCHES = OrderedDict()
+
+
+class MirrorRepository(object):
+    """A repository to mirror and scan, with the fields findings report it by"""
+
+    __slots__ = ('id', 'node_id', 'name', 'full_name', 'html_url', 'clone_url')
+
+    def __init__(self, full_name, clone_url, html_url=None, id=None, node_id=None, name=None):
+        self.full_name = full_name
+        self.clone_url = clone_url
+        self.html_url = html_url if html_url is not None else clone_url
+        self.id = id
+        self.node_id = node_id
+        self.name = name if name is not None else full_name.rsplit('/', 1)[-1]
+
+    def __repr__(self):
+        return 'MirrorRepository({!r})'.format(self.full_name)
+
+    @classmethod
+    def from_api(cls, repository):
+        """Create from a repository returned by the GitHub API"""
+
+        return cls(repository.get('full_name'), repository.get('clone_url'), repository.get('html_url'),
+                   repository.get('id'), repository.get('node_id'), repository.get('name'))
+
+    def result_fields(self):
+        return {
+            'repository_id': self.id,
+            'repository_node_id': self.node_id,
+            'repository_name': self.name,
+            'repository_url': self.html_url
+        }
+
+
+@lru_cache(maxsize=None)
+def git_version():
+    """The version of git installed, as a tuple of ints"""
+
+    output = subprocess.run(['git', '--version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout
+    match = re.search(r'(\d+)\.(\d+)', output.decode('utf-8', 'replace'))
+    return tuple(int(part) for part in match.groups()) if match else ()
+
+
+def _git_env(token=None):
+    env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+    if token:
+        if git_version() < MIN_GIT_VERSION:
+            raise Exception('Cloning with a token needs git {} or later, found {}'.format(
+                '.'.join(str(part) for part in MIN_GIT_VERSION),
+                '.'.join(str(part) for part in git_version()) or 'no version'))
+        # Passed through the environment rather than the command line so it doesn't show in ps
+        credentials = base64.b64encode('x-access-token:{}'.format(token).encode('utf-8')).decode('ascii')
+        env.update({
+            'GIT_CONFIG_COUNT': '1',
+            'GIT_CONFIG_KEY_0': 'http.extraHeader',
+            'GIT_CONFIG_VALUE_0': 'Authorization: Basic {}'.format(credentials)
+        })
+    return env
+
+
+def _git(git_dir, *args, env=None):
+    command = ['git'] if git_dir is None else ['git', '--git-dir', git_dir]
+    result = subprocess.run(command + list(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    if result.returncode:
+        raise Exception('git {} failed: {}'.format(args[0], result.stderr.decode('utf-8', 'replace').strip()))
+    return result.stdout
+
+
+def mirror_path(path, repository):
+    return os.path.join(path, '{}.git'.format(repository.full_name))
+
+
+def sync(repository, path=MIRROR_PATH, token=None):
+    """Mirror clone the repository under path, or fetch what has changed if it is already there.
+        Returns the path of the mirror"""
+
+    git_dir = mirror_path(path, repository)
+    env = _git_env(token)
+    if os.path.isdir(git_dir):
+        _git(git_dir, 'fetch', '--prune', '--quiet', 'origin', env=env)
+    else:
+        os.makedirs(os.path.dirname(git_dir), exist_ok=True)
+        _git(None, 'clone', '--mirror', '--quiet', repository.clone_url, git_dir, env=env)
+    return git_dir
+
+
+def _records(stream, separator):
+    """Split a text stream on separator without reading it all into memory"""
+
+    buffer = ''
+    for chunk in iter(lambda: stream.read(READ_SIZE), ''):
+        buffer += chunk
+        records = buffer.split(separator)
+        buffer = records.pop()
+        yield from records
+    if buffer:
+        yield buffer
+
+
+def iter_history(git_dir, since=None):
+    """Generator over every commit reachable from any ref, newest first, as (sha, committer name,
+        committer email, commit date, message, changes). changes is a list of the (blob sha, path)
+        the commit added or modified"""
+
+    args = ['git', '--git-dir', git_dir, '-c', 'core.quotePath=false', 'log', '--all', '--raw', '--no-abbrev',
+            '--no-renames', '--format={}'.format(LOG_FORMAT)]
+    if since is not None:
+        args.append('--since={}'.format(time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(since))))
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8',
+                               errors='replace')
+    try:
+        for record in _records(process.stdout, COMMIT_SEPARATOR):
+            if not record:
+                continue
+            header, _, raw = record.partition(RAW_SEPARATOR)
+            sha, name, email, date, message = header.split(FIELD_SEPARATOR, 4)
+            changes = []
+            for line in raw.splitlines():
+                if not line.startswith(':'):
+                    continue
+                meta, _, file_path = line.partition('\t')
+                _, new_mode, _, blob, status = meta.split()
+                if blob != NULL_SHA and new_mode != SUBMODULE_MODE and not status.startswith('D'):
+                    changes.append((blob, file_path))
+            yield sha, name, email, date, message.strip(), changes
+    finally:
+        process.stdout.close()
+        process.kill()
+        process.wait()
+
+
+def iter_blobs(git_dir, shas, max_size=MAX_BLOB_SIZE):
+    """Generator over (sha, content) for each blob in shas, streamed from a single
+        `git cat-file --batch`. Blobs over max_size are skipped without being held in memory"""
+
+    process = subprocess.Popen(['git', '--git-dir', git_dir, 'cat-file', '--batch'], stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def write():
+        try:
+            for sha in shas:
+                process.stdin.write('{}\n'.format(sha).encode('ascii'))
+            process.stdin.close()
+        except (BrokenPipeError, ValueError):
+            pass
+
+    writer = threading.Thread(target=write, daemon=True)
+    writer.start()
+    try:
+        for _ in range(len(shas)):
+            header = process.stdout.readline().split()
+            if len(header) < 3:
+                continue
+            sha, size = header[0].decode('ascii'), int(header[2])
+            if size > max_size:
+                while size > 0:
+                    skipped = process.stdout.read(min(size, READ_SIZE))
+                    if not skipped:
+                        break
+                    size -= len(skipped)
+                content = None
+            else:
+                content = process.stdout.read(size)
+            process.stdout.read(1)
+            if content is not None:
+                yield sha, content
+    finally:
+        process.stdout.close()
+        process.kill()
+        process.wait()
+        writer.join()
+
+
+def _fragment(text, match):
+    """The line around a match, trimmed to FRAGMENT_CONTEXT characters either side of it"""
+
+    start = max(text.rfind('\n', 0, match.start()) + 1, match.start() - FRAGMENT_CONTEXT)
+    end = text.find('\n', match.end())
+    end = len(text) if end == -1 else end
+    return text[start:min(end, match.end() + FRAGMENT_CONTEXT)]
+
+
+def _match(engine, text):
+    """(rule filename, fragments) for each rule matching text"""
+
+    matches = []
+    for rule in engine.matching_rules(text):
+        fragments = [_fragment(text, match) for match in islice(rule.finditer(text), MAX_FRAGMENTS)]
+        matches.append((rule.filename, fragments))
+    return tuple(matches)
+
+
+def scannable(rule):
+    """Whether a rule can be matched against cloned repositories. Rules whose pattern matches
+        anything, like interesting_files.yaml, find files through the qualifiers of their search
+        strings alone and would report every blob and commit"""
+
+    return rule.regex.fullmatch('') is None
+
+
+def _init_worker(rules, matcher='re'):
+    """Build the rule engines of this process, unless they were already built for these rules.
+        Called from each task rather than as the pool's initializer, which needs Python 3.7"""
+
+    global _ENGINES_KEY
+    key = (matcher, tuple((rule.filename, rule.pattern_id) for rule in rules))
+    if key == _ENGINES_KEY:
+        return
+    _ENGINES_KEY = key
+    _ENGINES.clear()
+    _BLOB_MATCHES.clear()
+    for scope in SCOPES:
+        _ENGINES[scope] = RuleEngine((rule for rule in rules if scope in rule.scope and scannable(rule)), matcher)
+
+
+def _code_result(repository, commit, blob, file_path, fragments):
+    file_url = '{}/blob/{}/{}'.format(repository.html_url, commit, file_path)
+    return {
+        'file_name': file_path.rsplit('/', 1)[-1],
+        'file_url': file_url,
+        'sha': blob,
+        'repository': repository.result_fields(),
+        'matches': [{
+            'object_url': file_url,
+            'object_type': 'FileContent',
+            'fragment': fragment
+        } for fragment in fragments]
+    }
+
+
+def _commit_result(repository, sha, name, email, date, message, fragments):
+    commit_url = '{}/commit/{}'.format(repository.html_url, sha)
+    return {
+        'commit_url': commit_url,
+        'sha': sha,
+        'comments_url': None,
+        'committer_name': name,
+        'committer_id': None,
+        'committer_email': email,
+        'committer_login': None,
+        'commit_date': date,
+        'message': message,
+        'repository': repository.result_fields(),
+        'matches': [{
+            'object_url': commit_url,
+            'object_type': 'Commit',
+            'fragment': fragment
+        } for fragment in fragments]
+    }
+
+
+def scan_repository(repository, path=MIRROR_PATH, token=None, since=None, scopes=SCOPES, rules=None, matcher='re'):
+    """Sync the mirror of a repository and match the rules against its history. Runs in a worker
+        process, returns a list of (rule filename, scope, finding). Without rules, the engines
+        already built in this process are used"""
+
+    if rules is not None:
+        _init_worker(rules, matcher)
+    git_dir = sync(repository, path, token)
+    findings = []
+    # Where each blob was first seen, the newest commit that added it
+    blobs = {}
+    for sha, name, email, date, message, changes in iter_history(git_dir, since):
+        if 'commits' in scopes:
+            for filename, fragments in _match(_ENGINES.get('commits'), message):
+                findings.append((filename, 'commits', _commit_result(repository, sha, name, email, date, message,
+                                                                     fragments)))
+        if 'code' in scopes:
+            for blob, file_path in changes:
+                blobs.setdefault(blob, (sha, file_path))
+
+    if 'code' in scopes:
+        matches = {}
+        for blob in blobs:
+            if blob in _BLOB_MATCHES:
+                _BLOB_MATCHES.move_to_end(blob)
+                matches[blob] = _BLOB_MATCHES[blob]
+        unscanned = [blob for blob in blobs if blob not in matches]
+        for blob in unscanned:
+            matches[blob] = ()
+        for blob, content in iter_blobs(git_dir, unscanned):
+            if b'\0' not in content:
+                matches[blob] = _match(_ENGINES.get('code'), content.decode('utf-8', 'replace'))
+        for blob in unscanned:
+            _BLOB_MATCHES[blob] = matches[blob]
+            if len(_BLOB_MATCHES) > BLOB_MATCH_CACHE_SIZE:
+                _BLOB_MATCHES.popitem(last=False)
+        for blob, (sha, file_path) in blobs.items():
+            for filename, fragments in matches.get(blob):
+                findings.append((filename, 'code', _code_result(repository, sha, blob, file_path, fragments)))
+    return findings
+
+
+class CloneScanner(object):
+    """Scans mirror clones of repositories instead of using the search API. This covers every
+        branch and the full commit history, and isn't limited by the search rate limit.
+
+        Each repository is cloned, or fetched if it was mirrored by an earlier run, and scanned on
+        a pool of worker processes. Findings have the same fields as those from the search API"""
+
+    def __init__(self, log_handler, path=MIRROR_PATH, timeframe=cfg.ALL_TIME, workers=4, token=None,
+                 deduplicator=None, matcher='re'):
+        self.log_handler = log_handler
+        self.matcher = matcher
+        self.path = path
+        self.timeframe = timeframe
+        self.workers = workers
+        self.token = token
+        # When set, findings are deduplicated across rules as well as within each rule
+        self.deduplicator = deduplicator
+
+    def run(self, repositories, jobs, output, complete=None):
+        """Scan repositories for each (rule, scope) pair in jobs. output(rule, scope, finding) is
+            called from this process for each new finding as each repository is scanned, and
+            complete(rule, scope, total) once every repository has been"""
+
+        jobs = [(rule, scope) for rule, scope in jobs if scope in SCOPES]
+        for rule in {rule.filename: rule for rule, _ in jobs if not scannable(rule)}.values():
+            logger.print_info(self.log_handler, colored(
+                '{} only finds results through search qualifiers, skipped in clone scans'.format(rule.name), 'yellow'))
+        jobs = [(rule, scope) for rule, scope in jobs if scannable(rule)]
+        rules = {rule.filename: rule for rule, _ in jobs}
+        scopes = tuple(scope for scope in SCOPES if any(scope == job_scope for _, job_scope in jobs))
+        totals = {(rule.filename, scope): 0 for rule, scope in jobs}
+        deduplicators = {key: self.deduplicator if self.deduplicator is not None else Deduplicator()
+                         for key in totals}
+        since = None if self.timeframe == cfg.ALL_TIME else int(time.time()) - self.timeframe
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(scan_repository, repository, self.path, self.token, since, scopes,
+                                       list(rules.values()), self.matcher): repository
+                       for repository in repositories}
+            for future in as_completed(futures):
+                repository = futures.get(future)
+                try:
+                    findings = future.result()
+                except Exception as e:
+                    logger.print_critical(self.log_handler, colored('{}: {}'.format(repository.full_name, e), 'red'))
+                    continue
+                logger.print_info(self.log_handler, colored('Scanned {}'.format(repository.full_name), 'yellow'))
+                for filename, scope, finding in findings:
+                    key = (filename, scope)
+                    if key not in totals:
+                        continue
+                    if not deduplicators.get(key).is_new(scope, finding):
+                        metrics.DEDUP_DROPS.inc(scope=scope)
+                        continue
+                    totals[key] += 1
+                    metrics.FINDINGS.inc(rule=filename, scope=scope)
+                    try:
+                        output(rules.get(filename), scope, finding)
+                    except Exception as e:
+                        logger.print_critical(self.log_handler, colored(e, 'red'))
+
+        for rule, scope in jobs:
+            github.report_total(self.log_handler, totals.get((rule.filename, scope)))
+            if complete is not None:
+                try:
+                    complete(rule, scope, totals.get((rule.filename, scope)))
+                except Exception as e:
+                    logger.print_critical(self.log_handler, colored(e, 'red'))
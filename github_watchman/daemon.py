@@ -0,0 +1,198 @@
+import random
+import re
+import threading
+import time
+from termcolor import colored
+
+import github_watchman.config as cfg
+import github_watchman.logger as logger
+import github_watchman.metrics as metrics
+import github_watchman.rule_engine as rule_engine
+from github_watchman.dedup import Deduplicator
+from github_watchman.scheduler import ScanScheduler
+
+# How often each rule and scope is scanned when neither the rule nor --interval say otherwise
+DEFAULT_INTERVAL = 3600
+# Each run is moved by up to this share of its interval either way, so rules on the same
+# interval drift apart instead of all searching at once
+JITTER = 0.1
+# How often the rule files are checked for changes
+RELOAD_INTERVAL = 30
+INTERVAL = re.compile(r'^(\d+)\s*([smhd]?)$')
+UNITS = {
+    '': 1,
+    's': 1,
+    'm': 60,
+    'h': 3600,
+    'd': 86400
+}
+
+
+def parse_interval(value):
+    """Seconds in an interval given in seconds, or as a number followed by s, m, h or d"""
+
+    match = INTERVAL.match(str(value).strip().lower())
+    if not match or not int(match.group(1)):
+        raise ValueError('Invalid interval: {}'.format(value))
+    return int(match.group(1)) * UNITS.get(match.group(2))
+
+
+class ScheduledJob(object):
+    """A rule and scope the daemon scans, when it is next due and whether a scan is running"""
+
+    __slots__ = ('rule', 'scope', 'interval', 'due', 'running')
+
+    def __init__(self, rule, scope, interval, due):
+        self.rule = rule
+        self.scope = scope
+        self.interval = interval
+        self.due = due
+        self.running = False
+
+
+class Daemon(object):
+    """Scans each rule and scope again and again on its own interval from one long running process,
+        so the GitHub connection, compiled rules and caches stay warm between scans.
+
+        Scans are incremental: each only searches for activity since the last one and skips
+        results already reported. Runs are jittered so they spread out over time, and a rule and
+        scope is never scanned twice at once, a run that comes due while the last is still going
+        is skipped. The rule files are checked every reload_interval seconds and reloaded when
+        they have changed"""
+
+    def __init__(self, github_connection, log_handler, rules_path, scopes, state, output, complete=None,
+                 rules=None, timeframe=cfg.ALL_TIME, interval=DEFAULT_INTERVAL, jitter=JITTER, workers=4,
+                 dedup_across_rules=False, merge_queries=True, cache_path=None, reload_interval=RELOAD_INTERVAL):
+        self.github = github_connection
+        self.log_handler = log_handler
+        self.rules_path = rules_path
+        self.scopes = scopes
+        self.output = output
+        self.complete = complete
+        self.interval = interval
+        self.jitter = jitter
+        self.dedup_across_rules = dedup_across_rules
+        self.cache_path = cache_path
+        self.reload_interval = reload_interval
+        # One scheduler for every run, the state makes each run after the first incremental
+        self.scheduler = ScanScheduler(github_connection, log_handler, timeframe, workers=workers, state=state,
+                                       merge_queries=merge_queries)
+        # (rule filename, scope) to ScheduledJob
+        self.jobs = {}
+        self.runs = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.stamps = rule_engine.rule_files(rules_path)
+        self.reload_at = time.monotonic() + reload_interval
+        if rules is None:
+            rules = rule_engine.load_rules(rules_path, cache_path)
+        self._schedule(rules)
+
+    def _jittered(self, interval):
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _schedule(self, rules):
+        """Schedule the rules, keeping when jobs already scheduled are due. Jobs of rules that are
+            gone are dropped, new ones start within the jitter of their interval"""
+
+        now = time.monotonic()
+        jobs = {}
+        for rule in rules:
+            interval = parse_interval(rule.interval) if rule.interval else self.interval
+            for scope in self.scopes:
+                if scope not in rule.scope:
+                    continue
+                job = self.jobs.get((rule.filename, scope))
+                if job is None:
+                    job = ScheduledJob(rule, scope, interval, now + random.uniform(0, interval * self.jitter))
+                elif job.interval != interval:
+                    job.due = min(job.due, now + self._jittered(interval))
+                job.rule = rule
+                job.interval = interval
+                jobs[(rule.filename, scope)] = job
+        with self.lock:
+            self.jobs = jobs
+
+    def _reload(self):
+        stamps = rule_engine.rule_files(self.rules_path)
+        if stamps == self.stamps:
+            return
+        try:
+            rules = rule_engine.load_rules(self.rules_path, self.cache_path)
+            self._schedule(rules)
+        except Exception as e:
+            logger.print_critical(self.log_handler, colored(
+                'Rules not reloaded, keeping the loaded rules: {}'.format(e), 'red'))
+            return
+        finally:
+            self.stamps = stamps
+        if self.github.match_cache is not None:
+            self.github.match_cache.invalidate(rules)
+        logger.print_info(self.log_handler, colored('{} rules reloaded'.format(len(rules)), 'magenta'))
+
+    def _due(self, now):
+        """Jobs due to run, marked as running. Jobs still running from their last run are skipped"""
+
+        due = []
+        with self.lock:
+            for job in self.jobs.values():
+                if job.due > now:
+                    continue
+                job.due = now + self._jittered(job.interval)
+                if job.running:
+                    metrics.SCHEDULED_RUNS.inc(outcome='skipped')
+                    logger.print_info(self.log_handler, colored('Skipping {} in {}, the last run is still going'.format(
+                        job.rule.name, job.scope), 'yellow'))
+                    continue
+                metrics.SCHEDULED_RUNS.inc(outcome='started')
+                job.running = True
+                due.append(job)
+        return due
+
+    def _finished(self, rule, scope):
+        with self.lock:
+            job = self.jobs.get((rule.filename, scope))
+            if job is not None:
+                job.running = False
+
+    def _run_jobs(self, jobs):
+        def complete(rule, scope, total):
+            try:
+                if self.complete is not None:
+                    self.complete(rule, scope, total)
+            finally:
+                self._finished(rule, scope)
+
+        try:
+            self.scheduler.run([(job.rule, job.scope) for job in jobs], self.output, complete,
+                               deduplicator=Deduplicator() if self.dedup_across_rules else None)
+        except Exception as e:
+            logger.print_critical(self.log_handler, colored(e, 'red'))
+        finally:
+            with self.lock:
+                for job in jobs:
+                    job.running = False
+
+    def run(self):
+        """Scan until stop() is called, then wait for the scans still running to finish"""
+
+        try:
+            while not self.stopped.is_set():
+                now = time.monotonic()
+                if now >= self.reload_at:
+                    self._reload()
+                    self.reload_at = now + self.reload_interval
+                jobs = self._due(now)
+                if jobs:
+                    thread = threading.Thread(target=self._run_jobs, args=(jobs,), name='DaemonRun', daemon=True)
+                    thread.start()
+                    self.runs = [run for run in self.runs if run.is_alive()] + [thread]
+                with self.lock:
+                    next_due = min([job.due for job in self.jobs.values()] + [self.reload_at])
+                self.stopped.wait(max(next_due - time.monotonic(), 0))
+        finally:
+            for thread in self.runs:
+                thread.join()
+
+    def stop(self):
+        self.stopped.set()
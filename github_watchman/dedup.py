@@ -0,0 +1,39 @@
+import threading
+
+# Fields that identify the same finding when it is returned by more than one query
+IDENTITY_KEYS = {
+    'code': ('sha', 'file_url'),
+    'commits': ('sha',),
+    'issues': ('issue_id',),
+    'repositories': ('repository_id',)
+}
+
+
+def identity(scope, result):
+    return (scope,) + tuple(result.get(key) for key in IDENTITY_KEYS.get(scope))
+
+
+class Deduplicator(object):
+    """Drops findings that have already been seen, as they arrive. Share one instance between
+        rules to deduplicate across rules as well as across the queries of a rule"""
+
+    def __init__(self):
+        self.seen = set()
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def is_new(self, scope, result):
+        key = identity(scope, result)
+        with self.lock:
+            if key in self.seen:
+                self.dropped += 1
+                return False
+            self.seen.add(key)
+            return True
+
+    def filter(self, scope, results):
+        """Yield the results not seen before, keeping their order"""
+
+        for result in results:
+            if self.is_new(scope, result):
+                yield result
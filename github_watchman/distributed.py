@@ -0,0 +1,747 @@
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import signal
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from termcolor import colored
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+import github_watchman.config as cfg
+import github_watchman.github_wrapper as github
+import github_watchman.logger as logger
+import github_watchman.metrics as metrics
+from github_watchman.cache import MatchCache
+from github_watchman.dedup import identity
+from github_watchman.query_planner import PlannedQuery
+from github_watchman.ratelimit import MAX_RETRIES, RateLimiter
+from github_watchman.rule_engine import Rule
+from github_watchman.scheduler import ScanScheduler, ScanStopped, put_event
+from github_watchman.state import result_fingerprint
+
+# How long a worker holds a leased item before another worker may take it over. Workers
+# extend their lease while they are still searching
+LEASE_SECONDS = 300
+# Times an item is leased before it is given up on
+MAX_ATTEMPTS = 3
+# How often the coordinator checks for findings and finished items, and idle workers for new items
+POLL_INTERVAL = 0.5
+# Findings a worker sends to the sink at once
+FINDINGS_BATCH = 100
+# Requests a worker takes from a token's shared quota at once, then hands out itself. A worker
+# holds back at most this many requests that others could have made
+QUOTA_BATCH = 10
+REDIS_PREFIX = 'github_watchman'
+
+
+def token_id(token):
+    """Identifies a token in the queue without storing the token itself"""
+
+    return hashlib.sha1(token.encode('utf-8')).hexdigest()[:12]
+
+
+def finding_key(rule, scope, finding):
+    """Key a finding is deduplicated on in the sink, the same for every worker that finds it"""
+
+    return hashlib.sha1(json.dumps([rule, identity(scope, finding)], default=str).encode('utf-8')).hexdigest()
+
+
+class SQLiteQueue(object):
+    """Work queue, findings sink and token quotas in a SQLite database, shared by the coordinator
+        and workers on one host, or on several through a shared filesystem that supports locking"""
+
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        # Transactions are begun explicitly, so leasing an item takes the write lock up front
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self._transaction() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS items '
+                               '(id INTEGER PRIMARY KEY, scan TEXT, payload TEXT, state TEXT, worker TEXT, '
+                               'expires REAL, attempts INTEGER, hits INTEGER, error TEXT)')
+            connection.execute('CREATE INDEX IF NOT EXISTS items_state ON items (state, id)')
+            connection.execute('CREATE TABLE IF NOT EXISTS findings '
+                               '(id INTEGER PRIMARY KEY, scan TEXT, key TEXT, rule TEXT, scope TEXT, finding TEXT, '
+                               'UNIQUE (scan, key))')
+            connection.execute('CREATE TABLE IF NOT EXISTS quotas '
+                               '(token TEXT, resource TEXT, remaining INTEGER, reset INTEGER, picked REAL, '
+                               'PRIMARY KEY (token, resource)) WITHOUT ROWID')
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+    def publish(self, scan, items):
+        """Add work items for a scan, returning their ids"""
+
+        with self._transaction() as connection:
+            return [connection.execute('INSERT INTO items (scan, payload, state, attempts) VALUES (?, ?, ?, 0)',
+                                       (scan, json.dumps(item), 'pending')).lastrowid for item in items]
+
+    def lease(self, worker, lease_seconds=LEASE_SECONDS):
+        """Lease the oldest item waiting to be run, or one whose lease has expired. Returns
+            (id, item) or None when there is nothing to do"""
+
+        now = time.time()
+        with self._transaction() as connection:
+            connection.execute('UPDATE items SET state = ?, error = ? '
+                               'WHERE state = ? AND expires < ? AND attempts >= ?',
+                               ('failed', 'Lease expired', 'leased', now, MAX_ATTEMPTS))
+            row = connection.execute('SELECT id, payload FROM items WHERE state = ? OR (state = ? AND expires < ?) '
+                                     'ORDER BY id LIMIT 1', ('pending', 'leased', now)).fetchone()
+            if row is None:
+                return None
+            connection.execute('UPDATE items SET state = ?, worker = ?, expires = ?, attempts = attempts + 1 '
+                               'WHERE id = ?', ('leased', worker, now + lease_seconds, row[0]))
+        return row[0], json.loads(row[1])
+
+    def _leased(self, connection, item_id, worker):
+        row = connection.execute('SELECT state, worker, attempts FROM items WHERE id = ?', (item_id,)).fetchone()
+        return row if row is not None and row[0] == 'leased' and row[1] == worker else None
+
+    def extend(self, item_id, worker, lease_seconds=LEASE_SECONDS):
+        """Extend a lease. Returns False if the worker has lost it"""
+
+        with self._transaction() as connection:
+            if self._leased(connection, item_id, worker) is None:
+                return False
+            connection.execute('UPDATE items SET expires = ? WHERE id = ?', (time.time() + lease_seconds, item_id))
+            return True
+
+    def complete(self, item_id, worker, hits):
+        with self._transaction() as connection:
+            if self._leased(connection, item_id, worker) is not None:
+                connection.execute('UPDATE items SET state = ?, hits = ? WHERE id = ?', ('done', hits, item_id))
+
+    def fail(self, item_id, worker, error):
+        """Put a failed item back in the queue, or give up on it once it has been tried MAX_ATTEMPTS times"""
+
+        with self._transaction() as connection:
+            leased = self._leased(connection, item_id, worker)
+            if leased is not None:
+                connection.execute('UPDATE items SET state = ?, error = ? WHERE id = ?',
+                                   ('failed' if leased[2] >= MAX_ATTEMPTS else 'pending', error, item_id))
+
+    def outstanding(self, scan=None):
+        """Items still to be run, for one scan or every scan"""
+
+        with self.lock:
+            if scan is None:
+                row = self.connection.execute('SELECT COUNT(*) FROM items WHERE state IN (?, ?)',
+                                              ('pending', 'leased')).fetchone()
+            else:
+                row = self.connection.execute('SELECT COUNT(*) FROM items WHERE scan = ? AND state IN (?, ?)',
+                                              (scan, 'pending', 'leased')).fetchone()
+        return row[0]
+
+    def finished(self, scan):
+        """(id, state, hits, error) of the items of a scan that are done or have failed"""
+
+        with self.lock:
+            return self.connection.execute('SELECT id, state, hits, error FROM items WHERE scan = ? AND state IN '
+                                           '(?, ?) ORDER BY id', (scan, 'done', 'failed')).fetchall()
+
+    def add_findings(self, scan, findings):
+        """Add (key, rule, scope, finding) findings to the sink. Findings with a key already in the
+            sink for the scan are dropped, returns how many were added"""
+
+        with self._transaction() as connection:
+            before = connection.total_changes
+            connection.executemany('INSERT OR IGNORE INTO findings (scan, key, rule, scope, finding) '
+                                   'VALUES (?, ?, ?, ?, ?)',
+                                   ((scan, key, rule, scope, json.dumps(finding, default=str))
+                                    for key, rule, scope, finding in findings))
+            return connection.total_changes - before
+
+    def findings(self, scan, after=0):
+        """(id, rule, scope, finding) of the findings of a scan added after the given id"""
+
+        with self.lock:
+            rows = self.connection.execute('SELECT id, rule, scope, finding FROM findings WHERE scan = ? AND id > ? '
+                                           'ORDER BY id', (scan, after)).fetchall()
+        return [(row[0], row[1], row[2], json.loads(row[3])) for row in rows]
+
+    def reserve_quota(self, token, resource, count=1):
+        """Take up to count requests from the quota recorded for a token. Returns how many were
+            taken, all of them if the quota isn't known, and when none were left how many seconds
+            until it resets"""
+
+        now = time.time()
+        with self._transaction() as connection:
+            row = connection.execute('SELECT remaining, reset FROM quotas WHERE token = ? AND resource = ?',
+                                     (token, resource)).fetchone()
+            if row is None or row[0] is None or row[1] <= now:
+                return count, 0
+            if row[0] > 0:
+                taken = min(count, row[0])
+                connection.execute('UPDATE quotas SET remaining = remaining - ? WHERE token = ? AND resource = ?',
+                                   (taken, token, resource))
+                return taken, 0
+            return 0, row[1] - now + 1
+
+    def update_quota(self, token, resource, remaining, reset):
+        """Record the quota GitHub reported for a token. As with RateLimitBudget, the lowest
+            remaining count reported for a window is the accurate one"""
+
+        with self._transaction() as connection:
+            row = connection.execute('SELECT remaining, reset FROM quotas WHERE token = ? AND resource = ?',
+                                     (token, resource)).fetchone()
+            if row is None:
+                connection.execute('INSERT INTO quotas VALUES (?, ?, ?, ?, 0)', (token, resource, remaining, reset))
+            elif row[1] is None or reset > row[1]:
+                connection.execute('UPDATE quotas SET remaining = ?, reset = ? WHERE token = ? AND resource = ?',
+                                   (remaining, reset, token, resource))
+            elif reset == row[1] and remaining < row[0]:
+                connection.execute('UPDATE quotas SET remaining = ? WHERE token = ? AND resource = ?',
+                                   (remaining, token, resource))
+
+    def pick_token(self, tokens, resource):
+        """The token with the most quota left for the resource, the least recently picked of
+            those with the same"""
+
+        now = time.time()
+        with self._transaction() as connection:
+            quotas = {row[0]: row[1:] for row in connection.execute(
+                'SELECT token, remaining, reset, picked FROM quotas WHERE resource = ? AND token IN ({})'.format(
+                    ','.join('?' * len(tokens))), [resource] + list(tokens))}
+            token = max(tokens, key=lambda token: _availability(quotas.get(token), now))
+            # Not an upsert, which needs SQLite 3.24
+            connection.execute('INSERT OR IGNORE INTO quotas VALUES (?, ?, NULL, NULL, NULL)', (token, resource))
+            connection.execute('UPDATE quotas SET picked = ? WHERE token = ? AND resource = ?', (now, token, resource))
+        return token
+
+    def close(self):
+        self.connection.close()
+
+
+def _availability(quota, now):
+    """Sort key for picking a token: requests left, then the earliest reset, then the least
+        recently picked. A token without a known quota for the current window is treated as full"""
+
+    remaining, reset, picked = quota if quota is not None else (None, None, 0)
+    if remaining is None or reset is None or reset <= now:
+        return float('inf'), 0, -(picked or 0)
+    return remaining, -reset, -(picked or 0)
+
+
+# Requeues items with expired leases, giving up on those tried MAX_ATTEMPTS times, then leases the
+# next item. KEYS: pending list, leases sorted set. ARGV: now, lease expiry, worker, max attempts, prefix
+LEASE_SCRIPT = '''
+for _, id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])) do
+    redis.call('ZREM', KEYS[2], id)
+    local item = ARGV[5] .. ':item:' .. id
+    if tonumber(redis.call('HGET', item, 'attempts')) >= tonumber(ARGV[4]) then
+        local scan = ARGV[5] .. ':scan:' .. redis.call('HGET', item, 'scan')
+        redis.call('HSET', item, 'state', 'failed', 'error', 'Lease expired')
+        redis.call('RPUSH', scan .. ':finished', id)
+        redis.call('DECR', scan .. ':outstanding')
+    else
+        redis.call('HSET', item, 'state', 'pending')
+        redis.call('RPUSH', KEYS[1], id)
+    end
+end
+local id = redis.call('RPOP', KEYS[1])
+if not id then
+    return false
+end
+local item = ARGV[5] .. ':item:' .. id
+redis.call('ZADD', KEYS[2], ARGV[2], id)
+redis.call('HSET', item, 'state', 'leased', 'worker', ARGV[3])
+redis.call('HINCRBY', item, 'attempts', 1)
+return {id, redis.call('HGET', item, 'payload')}
+'''
+# Finishes a leased item. KEYS: item hash, leases sorted set, pending list. ARGV: id, worker,
+# 'done' or 'failed', hits or error, max attempts, lease expiry for 'extend', prefix
+FINISH_SCRIPT = '''
+if redis.call('HGET', KEYS[1], 'state') ~= 'leased' or redis.call('HGET', KEYS[1], 'worker') ~= ARGV[2] then
+    return 0
+end
+if ARGV[3] == 'extend' then
+    redis.call('ZADD', KEYS[2], ARGV[6], ARGV[1])
+    return 1
+end
+redis.call('ZREM', KEYS[2], ARGV[1])
+local scan = ARGV[7] .. ':scan:' .. redis.call('HGET', KEYS[1], 'scan')
+if ARGV[3] == 'done' then
+    redis.call('HSET', KEYS[1], 'state', 'done', 'hits', ARGV[4])
+elseif tonumber(redis.call('HGET', KEYS[1], 'attempts')) < tonumber(ARGV[5]) then
+    redis.call('HSET', KEYS[1], 'state', 'pending', 'error', ARGV[4])
+    redis.call('RPUSH', KEYS[3], ARGV[1])
+    return 1
+else
+    redis.call('HSET', KEYS[1], 'state', 'failed', 'error', ARGV[4])
+end
+redis.call('RPUSH', scan .. ':finished', ARGV[1])
+redis.call('DECR', scan .. ':outstanding')
+return 1
+'''
+# Adds findings not already in the sink. KEYS: keys set, findings list. ARGV: key, finding pairs
+ADD_FINDINGS_SCRIPT = '''
+local added = 0
+for i = 1, #ARGV, 2 do
+    if redis.call('SADD', KEYS[1], ARGV[i]) == 1 then
+        redis.call('RPUSH', KEYS[2], ARGV[i + 1])
+        added = added + 1
+    end
+end
+return added
+'''
+# KEYS: quota hash. ARGV: now, count. Returns the requests taken and the seconds to wait as
+# strings, Lua numbers are truncated to integers on the way out
+RESERVE_SCRIPT = '''
+local remaining = tonumber(redis.call('HGET', KEYS[1], 'remaining'))
+local reset = tonumber(redis.call('HGET', KEYS[1], 'reset'))
+local count = tonumber(ARGV[2])
+if not remaining or not reset or reset <= tonumber(ARGV[1]) then
+    return {tostring(count), '0'}
+end
+if remaining > 0 then
+    local taken = math.min(count, remaining)
+    redis.call('HINCRBY', KEYS[1], 'remaining', -taken)
+    return {tostring(taken), '0'}
+end
+return {'0', tostring(reset - tonumber(ARGV[1]) + 1)}
+'''
+# KEYS: quota hash. ARGV: remaining, reset
+UPDATE_QUOTA_SCRIPT = '''
+local remaining = tonumber(redis.call('HGET', KEYS[1], 'remaining'))
+local reset = tonumber(redis.call('HGET', KEYS[1], 'reset'))
+if not reset or tonumber(ARGV[2]) > reset then
+    redis.call('HSET', KEYS[1], 'remaining', ARGV[1], 'reset', ARGV[2])
+elseif tonumber(ARGV[2]) == reset and (not remaining or tonumber(ARGV[1]) < remaining) then
+    redis.call('HSET', KEYS[1], 'remaining', ARGV[1])
+end
+return 1
+'''
+
+
+class RedisQueue(object):
+    """Work queue, findings sink and token quotas in Redis, for coordinators and workers on
+        several hosts. Install with `pip install github-watchman[redis]`"""
+
+    def __init__(self, url, prefix=REDIS_PREFIX):
+        if redis is None:
+            raise ImportError('redis is required for a Redis work queue: pip install github-watchman[redis]')
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self.pending = '{}:pending'.format(prefix)
+        self.leases = '{}:leases'.format(prefix)
+        self.lease_script = self.client.register_script(LEASE_SCRIPT)
+        self.finish_script = self.client.register_script(FINISH_SCRIPT)
+        self.add_findings_script = self.client.register_script(ADD_FINDINGS_SCRIPT)
+        self.reserve_script = self.client.register_script(RESERVE_SCRIPT)
+        self.update_quota_script = self.client.register_script(UPDATE_QUOTA_SCRIPT)
+
+    def _item(self, item_id):
+        return '{}:item:{}'.format(self.prefix, item_id)
+
+    def _scan(self, scan):
+        return '{}:scan:{}'.format(self.prefix, scan)
+
+    def _quota(self, token, resource):
+        return '{}:quota:{}:{}'.format(self.prefix, token, resource)
+
+    def publish(self, scan, items):
+        first = self.client.incrby('{}:next_item'.format(self.prefix), len(items)) - len(items) + 1
+        ids = list(range(first, first + len(items)))
+        pipeline = self.client.pipeline()
+        for item_id, item in zip(ids, items):
+            pipeline.hset(self._item(item_id), mapping={'scan': scan, 'payload': json.dumps(item),
+                                                        'state': 'pending', 'attempts': 0})
+        pipeline.incrby('{}:outstanding'.format(self._scan(scan)), len(ids))
+        # Leased from the other end, so items are run in the order they were published
+        pipeline.lpush(self.pending, *ids)
+        pipeline.execute()
+        return ids
+
+    def lease(self, worker, lease_seconds=LEASE_SECONDS):
+        now = time.time()
+        leased = self.lease_script(keys=[self.pending, self.leases],
+                                   args=[now, now + lease_seconds, worker, MAX_ATTEMPTS, self.prefix])
+        if not leased:
+            return None
+        return int(leased[0]), json.loads(leased[1])
+
+    def _finish(self, item_id, worker, outcome, value='', lease_seconds=LEASE_SECONDS):
+        return bool(self.finish_script(keys=[self._item(item_id), self.leases, self.pending],
+                                       args=[item_id, worker, outcome, value, MAX_ATTEMPTS,
+                                             time.time() + lease_seconds, self.prefix]))
+
+    def extend(self, item_id, worker, lease_seconds=LEASE_SECONDS):
+        return self._finish(item_id, worker, 'extend', lease_seconds=lease_seconds)
+
+    def complete(self, item_id, worker, hits):
+        self._finish(item_id, worker, 'done', hits)
+
+    def fail(self, item_id, worker, error):
+        self._finish(item_id, worker, 'failed', error)
+
+    def outstanding(self, scan=None):
+        if scan is None:
+            return self.client.llen(self.pending) + self.client.zcard(self.leases)
+        return int(self.client.get('{}:outstanding'.format(self._scan(scan))) or 0)
+
+    def finished(self, scan):
+        ids = [int(item_id) for item_id in self.client.lrange('{}:finished'.format(self._scan(scan)), 0, -1)]
+        pipeline = self.client.pipeline()
+        for item_id in ids:
+            pipeline.hmget(self._item(item_id), 'state', 'hits', 'error')
+        return [(item_id, state, int(hits) if hits else None, error)
+                for item_id, (state, hits, error) in zip(ids, pipeline.execute())]
+
+    def add_findings(self, scan, findings):
+        args = []
+        for key, rule, scope, finding in findings:
+            args.extend((key, json.dumps([rule, scope, finding], default=str)))
+        if not args:
+            return 0
+        return self.add_findings_script(keys=['{}:keys'.format(self._scan(scan)),
+                                              '{}:findings'.format(self._scan(scan))], args=args)
+
+    def findings(self, scan, after=0):
+        rows = self.client.lrange('{}:findings'.format(self._scan(scan)), after, -1)
+        return [(after + index + 1,) + tuple(json.loads(row)) for index, row in enumerate(rows)]
+
+    def reserve_quota(self, token, resource, count=1):
+        taken, wait = self.reserve_script(keys=[self._quota(token, resource)], args=[time.time(), count])
+        return int(taken), float(wait)
+
+    def update_quota(self, token, resource, remaining, reset):
+        self.update_quota_script(keys=[self._quota(token, resource)], args=[remaining, reset])
+
+    def pick_token(self, tokens, resource):
+        now = time.time()
+        pipeline = self.client.pipeline()
+        for token in tokens:
+            pipeline.hmget(self._quota(token, resource), 'remaining', 'reset', 'picked')
+        quotas = {token: tuple(float(value) if value is not None else None for value in quota)
+                  for token, quota in zip(tokens, pipeline.execute())}
+        token = max(tokens, key=lambda token: _availability(quotas.get(token), now))
+        self.client.hset(self._quota(token, resource), 'picked', now)
+        return token
+
+    def close(self):
+        self.client.close()
+
+
+def open_queue(url):
+    """Open the work queue at a URL: sqlite:///path/to/queue.db, redis://host:port/db or the path
+        of a SQLite database"""
+
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisQueue(url)
+    if url.startswith('sqlite:///'):
+        return SQLiteQueue(url[len('sqlite:///'):])
+    return SQLiteQueue(url)
+
+
+class PooledRateLimiter(RateLimiter):
+    """Rate limiter for one token of a pool shared by workers on several hosts. As well as being
+        paced in this process, every request is counted against the quota recorded for the token
+        in the queue, so workers sharing a token don't overrun it between them. Requests are
+        taken from the queue batch_size at a time and handed out from here"""
+
+    def __init__(self, work_queue, token, batch_size=QUOTA_BATCH, **kwargs):
+        super().__init__(**kwargs)
+        self.work_queue = work_queue
+        self.token = token
+        self.batch_size = batch_size
+        # Requests taken from the queue and not yet made, for each resource
+        self.reserved = {}
+        self.reserved_lock = threading.Lock()
+
+    def reserve(self, resource):
+        wait = super().reserve(resource)
+        if wait:
+            return wait
+        with self.reserved_lock:
+            if not self.reserved.get(resource):
+                taken, wait = self.work_queue.reserve_quota(self.token, resource, self.batch_size)
+                self.reserved[resource] = taken
+            if self.reserved.get(resource):
+                self.reserved[resource] -= 1
+                return 0
+        self.buckets[resource].release()
+        self.budgets[resource].release()
+        return wait
+
+    def update(self, resource, headers):
+        super().update(resource, headers)
+        if headers.get('X-RateLimit-Remaining') is None or headers.get('X-RateLimit-Reset') is None:
+            return
+        if headers.get('X-RateLimit-Resource') in self.budgets:
+            resource = headers.get('X-RateLimit-Resource')
+        self.work_queue.update_quota(self.token, resource, int(headers.get('X-RateLimit-Remaining')),
+                                     int(headers.get('X-RateLimit-Reset')))
+
+
+class TokenPool(object):
+    """GitHub clients for a pool of tokens. Each search is made with the token that has the most
+        search quota left, going by the quotas every worker records in the queue"""
+
+    def __init__(self, work_queue, tokens, url, max_workers=4, max_retries=MAX_RETRIES):
+        self.work_queue = work_queue
+        match_cache = MatchCache()
+        self.clients = {}
+        for token in tokens:
+            rate_limiter = PooledRateLimiter(work_queue, token_id(token), max_retries=max_retries)
+            self.clients[token_id(token)] = github.GitHubAPIClient(token, url, max_workers=max_workers,
+                                                                   rate_limiter=rate_limiter,
+                                                                   match_cache=match_cache)
+
+    def client(self, resource='search'):
+        return self.clients.get(self.work_queue.pick_token(list(self.clients), resource))
+
+
+class Collector(object):
+    """Passes the findings and finished items of a scan in the queue back to a ScanScheduler's
+        event loop, as its own workers would"""
+
+    def __init__(self, work_queue, scan, events, stopping, submissions):
+        self.work_queue = work_queue
+        self.scan = scan
+        self.events = events
+        # Item id to (planned query, groups)
+        self.submissions = submissions
+        self.groups = {(group.rule.filename, group.scope): group
+                       for _, groups in submissions.values() for group in groups}
+        self.reported = set()
+        self.after = 0
+        self.stopped = stopping
+        self.thread = threading.Thread(target=self._run, name='Collector', daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        try:
+            self._collect()
+        except ScanStopped:
+            pass
+
+    def _collect(self):
+        while not self.stopped.is_set() and len(self.reported) < len(self.submissions):
+            # Workers add their findings before finishing an item, so reading finished items first
+            # means every finding of those items is read below
+            finished = [row for row in self.work_queue.finished(self.scan) if row[0] not in self.reported]
+            for finding_id, rule, scope, finding in self.work_queue.findings(self.scan, self.after):
+                self.after = finding_id
+                group = self.groups.get((rule, scope))
+                if group is None:
+                    continue
+                if group.seen is not None and result_fingerprint(scope, finding) in group.seen:
+                    continue
+                put_event(self.events, self.stopped, ('finding', group, finding))
+            for item_id, state, hits, error in finished:
+                self.reported.add(item_id)
+                planned, groups = self.submissions.get(item_id)
+                if state == 'done':
+                    put_event(self.events, self.stopped, ('done', groups, (planned.query, hits)))
+                else:
+                    error = Exception('{} search for "{}" failed: {}'.format(planned.scope, planned.query, error))
+                    put_event(self.events, self.stopped, ('error', groups, error))
+            self.stopped.wait(POLL_INTERVAL)
+
+
+class DistributedScheduler(ScanScheduler):
+    """Runs the planned queries of a scan on `github-watchman worker` processes, on this host or
+        others, by publishing them to a work queue. Workers send findings to the queue's sink,
+        which drops those another worker has already sent. They are then output here, with the
+        scan state and deduplication across rules applied as for a local scan"""
+
+    def __init__(self, github_connection, log_handler, work_queue, timeframe=cfg.ALL_TIME, state=None,
+                 deduplicator=None, merge_queries=True):
+        super().__init__(github_connection, log_handler, timeframe, workers=1, state=state, deduplicator=deduplicator,
+                         merge_queries=merge_queries)
+        self.work_queue = work_queue
+        self.scan = uuid.uuid4().hex[:12]
+
+    def _start(self, events, stopping, submissions):
+        items = [{
+            'scan': self.scan,
+            'scope': planned.scope,
+            'query': planned.query,
+            'timeframe': self.timeframe,
+            'rules': [[rule.filename, rule.pattern] for rule in planned.rules]
+        } for planned, _ in submissions]
+        ids = self.work_queue.publish(self.scan, items)
+        logger.print_info(self.log_handler, colored(
+            '{} searches published to the work queue as scan {}'.format(len(ids), self.scan), 'magenta'))
+        return Collector(self.work_queue, self.scan, events, stopping, dict(zip(ids, submissions)))
+
+    def _report_rate_limits(self):
+        logger.print_info(self.log_handler, colored('Waiting for workers, {} searches still to run'.format(
+            self.work_queue.outstanding(self.scan)), 'yellow'))
+
+
+class Worker(object):
+    """Leases work items from the queue and runs them, `threads` at a time, sending findings to the
+        queue's sink. Stops when stop() is called, or once it has had nothing to do for max_idle
+        seconds"""
+
+    def __init__(self, work_queue, pool, threads=4, lease_seconds=LEASE_SECONDS, max_idle=None, worker_id=None):
+        self.work_queue = work_queue
+        self.pool = pool
+        self.threads = threads
+        self.lease_seconds = lease_seconds
+        self.max_idle = max_idle
+        self.worker_id = worker_id or '{}-{}'.format(socket.gethostname(), os.getpid())
+        # Rules rebuilt from the patterns in work items, keyed on filename and pattern
+        self.rules = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def _rule(self, filename, pattern):
+        with self.lock:
+            rule = self.rules.get((filename, pattern))
+            if rule is None:
+                rule = self.rules[(filename, pattern)] = Rule({'filename': filename, 'pattern': pattern})
+        return rule
+
+    def _keep_leased(self, item_id, done):
+        while not done.wait(self.lease_seconds / 3):
+            if not self.work_queue.extend(item_id, self.worker_id, self.lease_seconds):
+                return
+
+    def run_item(self, item_id, item):
+        scope = item.get('scope')
+        rules = [self._rule(filename, pattern) for filename, pattern in item.get('rules')]
+        planned = PlannedQuery(scope, item.get('query'), rules)
+        client = self.pool.client()
+        batch = []
+
+        def send():
+            if batch:
+                self.work_queue.add_findings(item.get('scan'), batch)
+                batch.clear()
+
+        def emit(rule, finding):
+            batch.append((finding_key(rule.filename, scope, finding), rule.filename, scope, finding))
+            if len(batch) >= FINDINGS_BATCH:
+                send()
+
+        def route(finding):
+            sha = finding.get('sha') if scope == 'code' else None
+            for rule in planned.matching_rules(finding.get('matches'), sha, client.match_cache):
+                emit(rule, finding)
+
+        done = threading.Event()
+        threading.Thread(target=self._keep_leased, args=(item_id, done), daemon=True).start()
+        try:
+            query_function = github.QUERY_FUNCTIONS.get(scope)
+            if len(rules) == 1:
+                hits = github.run_query(query_function(client, rules[0], planned.query, item.get('timeframe')),
+                                        lambda finding: emit(rules[0], finding))
+            else:
+                hits = github.run_query(query_function(client, planned, planned.query, item.get('timeframe')),
+                                        route)
+            send()
+            self.work_queue.complete(item_id, self.worker_id, hits)
+        except Exception as e:
+            self.work_queue.fail(item_id, self.worker_id, str(e))
+        finally:
+            done.set()
+
+    def _loop(self):
+        idle_since = time.monotonic()
+        while not self.stopped.is_set():
+            leased = self.work_queue.lease(self.worker_id, self.lease_seconds)
+            if leased is None:
+                if self.max_idle is not None and time.monotonic() - idle_since >= self.max_idle:
+                    return
+                self.stopped.wait(POLL_INTERVAL)
+                continue
+            item_id, item = leased
+            self.run_item(item_id, item)
+            idle_since = time.monotonic()
+
+    def run(self):
+        threads = [threading.Thread(target=self._loop, name='Worker', daemon=True) for _ in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def stop(self):
+        self.stopped.set()
+
+
+def _tokens_and_url():
+    """Tokens of the pool from GITHUB_WATCHMAN_TOKENS, comma separated, or GITHUB_WATCHMAN_TOKEN,
+        otherwise the tokens or token in watchman.conf"""
+
+    tokens = os.environ.get('GITHUB_WATCHMAN_TOKENS') or os.environ.get('GITHUB_WATCHMAN_TOKEN')
+    url = os.environ.get('GITHUB_WATCHMAN_URL')
+    if tokens and url:
+        return [token.strip() for token in tokens.split(',') if token.strip()], url
+    config = github.read_conf().get('github_watchman')
+    if not tokens:
+        tokens = config.get('tokens') or [config.get('token')]
+    else:
+        tokens = [token.strip() for token in tokens.split(',') if token.strip()]
+    return tokens, url or config.get('url')
+
+
+def main(argv=None):
+    """`github-watchman worker`"""
+
+    parser = argparse.ArgumentParser(prog='github-watchman worker',
+                                     description='Run searches published to a work queue by `github-watchman '
+                                                 '--queue`')
+    parser.add_argument('--queue', dest='queue', required=True,
+                        help='Work queue to lease searches from: sqlite:///path/to/queue.db or redis://host:port/db')
+    parser.add_argument('--workers', dest='workers', type=int, default=4,
+                        help='Number of searches to run in parallel (default: 4)')
+    parser.add_argument('--max-retries', dest='max_retries', type=int, default=MAX_RETRIES,
+                        help='Times to retry a failed request, with backoff, before giving up '
+                             '(default: {})'.format(MAX_RETRIES))
+    parser.add_argument('--lease', dest='lease', type=int, default=LEASE_SECONDS,
+                        help='Seconds a search is leased for before another worker may take it over if this one '
+                             'stops responding (default: {})'.format(LEASE_SECONDS))
+    parser.add_argument('--max-idle', dest='max_idle', type=float,
+                        help='Exit after this many seconds without a search to run (default: keep waiting)')
+    parser.add_argument('--metrics-port', dest='metrics_port', type=int, metavar='PORT',
+                        help='Serve request, timing and finding metrics for Prometheus at '
+                             'http://127.0.0.1:PORT/metrics')
+    args = parser.parse_args(argv)
+
+    tokens, url = _tokens_and_url()
+    work_queue = open_queue(args.queue)
+    metrics_server = metrics.MetricsServer(args.metrics_port) if args.metrics_port else None
+    worker = Worker(work_queue, TokenPool(work_queue, tokens, url, max_workers=args.workers,
+                                          max_retries=args.max_retries),
+                    threads=args.workers, lease_seconds=args.lease, max_idle=args.max_idle)
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+    print('Worker {} running searches from {} with {} tokens'.format(worker.worker_id, args.queue, len(tokens)))
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        worker.stop()
+    finally:
+        work_queue.close()
+        if metrics_server is not None:
+            metrics_server.close()
+    return 0
@@ -0,0 +1,98 @@
+from itertools import islice
+
+# The most node IDs GitHub accepts in a single nodes(ids:) lookup
+BATCH_SIZE = 100
+
+REPOSITORY_QUERY = '''
+query($ids: [ID!]!) {
+  nodes(ids: $ids) {
+    ... on Repository {
+      id
+      pushedAt
+      updatedAt
+      visibility
+      defaultBranchRef { name }
+    }
+  }
+}'''
+
+COMMIT_QUERY = '''
+query($ids: [ID!]!) {
+  nodes(ids: $ids) {
+    ... on Commit {
+      id
+      committer {
+        name
+        email
+        user { login databaseId }
+      }
+    }
+  }
+}'''
+
+
+def batches(iterable, size=BATCH_SIZE):
+    """Split an iterable into lists of up to size items"""
+
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
+
+def resolve_nodes(github, query, node_ids):
+    """Look up GraphQL nodes by ID, BATCH_SIZE at a time. Returns a dict of the nodes found
+        keyed on ID, IDs GitHub can't resolve are left out"""
+
+    nodes = {}
+    for batch in batches(sorted(set(node_ids))):
+        data = github.graphql(query, {'ids': batch})
+        for node in data.get('nodes'):
+            if node:
+                nodes[node.get('id')] = node
+    return nodes
+
+
+def repositories(github, node_ids):
+    """Timestamps, visibility and default branch for each repository node ID. Entries are kept in
+        the client's repository cache, when it has one, so only unknown or stale repositories are
+        looked up"""
+
+    cache = github.repository_cache
+    found = {}
+    missing = []
+    for node_id in set(node_ids):
+        cached = cache.get(node_id) if cache is not None else None
+        if cached is not None and cache.is_fresh(cached):
+            found[node_id] = cached.data
+        else:
+            missing.append(node_id)
+
+    for node_id, node in resolve_nodes(github, REPOSITORY_QUERY, missing).items():
+        repository = {
+            'pushed_at': node.get('pushedAt'),
+            'updated_at': node.get('updatedAt'),
+            'visibility': node.get('visibility'),
+            'default_branch': (node.get('defaultBranchRef') or {}).get('name')
+        }
+        if cache is not None:
+            cache.put(node_id, repository)
+        found[node_id] = repository
+    return found
+
+
+def committers(github, node_ids):
+    """The committer of each commit node ID, with their GitHub account when the email matched one"""
+
+    found = {}
+    for node_id, node in resolve_nodes(github, COMMIT_QUERY, node_ids).items():
+        committer = node.get('committer') or {}
+        user = committer.get('user') or {}
+        found[node_id] = {
+            'name': committer.get('name'),
+            'email': committer.get('email'),
+            'login': user.get('login'),
+            'id': user.get('databaseId')
+        }
+    return found
@@ -1,27 +1,40 @@
-import builtins
 import calendar
 import json
 import os
-import re
 import time
 import requests
-import yaml
-from requests.exceptions import HTTPError
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs
 from requests.packages.urllib3.util import Retry
 from requests.adapters import HTTPAdapter
 
 import github_watchman.config as cfg
+import github_watchman.enrichment as enrichment
 import github_watchman.logger as logger
+import github_watchman.metrics as metrics
+from github_watchman.dedup import Deduplicator
+from github_watchman.query_planner import PlannedQuery
+from github_watchman.ratelimit import RateLimiter, retry_message
+from github_watchman.sharding import SEARCH_RESULT_CAP, Shard
+from github_watchman.state import fingerprint
 
 
 class GitHubAPIClient(object):
 
-    def __init__(self, token, base_url):
+    def __init__(self, token, base_url, max_workers=4, rate_limiter=None, repository_cache=None, match_cache=None,
+                 log_handler=None):
         self.token = token
         self.base_url = base_url.rstrip('\\')
         self.per_page = 100
+        self.max_workers = max_workers
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.repository_cache = repository_cache
+        self.match_cache = match_cache
+        # Messages about requests go through the output logger, see logger.print_info
+        self.log_handler = log_handler
         self.session = session = requests.session()
-        session.mount(self.base_url, HTTPAdapter(max_retries=Retry(connect=3, backoff_factor=1)))
+        session.mount(self.base_url, HTTPAdapter(max_retries=Retry(connect=3, backoff_factor=1),
+                                                 pool_maxsize=max(max_workers, 10)))
         session.headers.update({
             'Authorization': 'token {}'.format(self.token),
             'Accept': 'application/vnd.github.v3.text-match+json'
@@ -32,102 +45,188 @@ class GitHubAPIClient(object):
         else:
             self.base_url = base_url.rstrip('/')
 
-    def make_request(self, url, params=None, data=None, method='GET', verify_ssl=True):
-        try:
-            response = self.session.request(method, url, params=params, data=data, verify=verify_ssl)
-            response.raise_for_status()
-
-            return response
-
-        except HTTPError as http_error:
-            if response.status_code == 400:
-                if response.json().get('message').get('error'):
-                    raise Exception(response.json().get('message').get('error'))
-                else:
-                    raise http_error
-            elif response.status_code == 502 or response.status_code == 500:
-                print('Retrying...')
-                time.sleep(30)
-                response = self.session.request(method, url, params=params, data=data, verify=verify_ssl)
-                response.raise_for_status()
-                return response
-            elif response.status_code == 403:
-                if response.headers.get('Retry-After'):
-                    print('GitHub API abuse limit hit - retrying in {} seconds'.format(
-                        (response.headers.get('Retry-After'))))
-                    time.sleep(int(response.headers.get('Retry-After')) + 2)
-                    response = self.session.request(method, url, params=params, data=data, verify=verify_ssl)
-                    response.raise_for_status()
+    def _send(self, method, url, params, data, verify_ssl, headers):
+        resource = self.rate_limiter.resource(url)
+        self.rate_limiter.acquire(resource)
+        endpoint = metrics.endpoint(url)
+        started = time.perf_counter()
+        response = self.session.request(method, url, params=params, data=data, verify=verify_ssl, headers=headers)
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint)
+        metrics.RESPONSES.inc(endpoint=endpoint, status=response.status_code)
+        self.rate_limiter.update(resource, response.headers)
+        return response
+
+    def make_request(self, url, params=None, data=None, method='GET', verify_ssl=True, headers=None):
+        """Make a request, retrying with backoff as the rate limiter allows. Raises an exception
+            if the request still fails"""
+
+        resource = self.rate_limiter.resource(url)
+        attempt = 0
+        while True:
+            try:
+                response = self._send(method, url, params, data, verify_ssl, headers)
+            except requests.exceptions.ConnectionError as connection_error:
+                delay = self.rate_limiter.retry_delay(resource, attempt)
+                if delay is None:
+                    raise connection_error
+                logger.print_info(self.log_handler, retry_message(None, {}))
+            else:
+                if response.status_code < 400:
                     return response
-                elif int(response.headers.get('X-RateLimit-Remaining')) == 0:
-                    print('GitHub API rate limit reached - cooling off')
-                    time.sleep(int(response.headers.get('X-RateLimit-Reset')) - int(time.time()) + 5)
-                    response = self.session.request(method, url, params=params, data=data, verify=verify_ssl)
+                delay = self.rate_limiter.retry_delay(resource, attempt, response.status_code, response.headers,
+                                                      response.text)
+                if delay is None:
+                    message = _error_message(response)
+                    if message:
+                        raise Exception(message)
                     response.raise_for_status()
-                    return response
-                else:
-                    print(response.headers)
-            else:
-                raise http_error
-        except Exception as e:
-            print(e)
+                logger.print_info(self.log_handler, retry_message(response.status_code, response.headers))
+            metrics.SLEEP_SECONDS.inc(delay, reason='backoff')
+            time.sleep(delay)
+            attempt += 1
 
-    def multipage_search(self, url, query, media_type=None):
-        """Wrapper for GitHub API methods that use pagination"""
+    def iter_search(self, url, query, media_type=None):
+        """Generator over the items of a paginated search. The first page is fetched to find
+            the total number of pages, the rest are then fetched concurrently and yielded in order.
+
+            The API returns at most 1000 results for a search. Searches matching more than that
+            are split into shards on a size or date qualifier, and split again until every shard
+            is under the cap. The first pages of each round of shards are fetched concurrently"""
 
         if media_type is None:
             media_type = 'application/vnd.github.v3.text-match+json'
 
-        results = []
-        params = {
-            'per_page': self.per_page,
-            'q': query,
-            'page': 1
-        }
-        self.session.headers.update({'Accept': media_type})
+        headers = {'Accept': media_type}
+        endpoint = '/'.join((self.base_url, url))
+
+        def get_page(search):
+            search_query, page = search
+            params = {
+                'per_page': self.per_page,
+                'q': search_query,
+                'page': page
+            }
+            metrics.PAGES.inc(endpoint=url)
+            return self.make_request(endpoint, params=params, headers=headers)
+
+        searches = [(query, None)]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while searches:
+                next_searches = []
+                first_pages = executor.map(get_page, [(search_query, 1) for search_query, _ in searches])
+                for (search_query, shard), response in zip(searches, first_pages):
+                    body = response.json()
+                    if body.get('total_count', 0) > SEARCH_RESULT_CAP:
+                        if shard is None:
+                            shard = Shard.for_endpoint(url, query)
+                        if shard is not None and shard.splittable():
+                            next_searches.extend((part.query, part) for part in shard.split())
+                            continue
+                        logger.print_info(self.log_handler, '{} results for {}, only the first {} can be returned'
+                                          .format(body.get('total_count'), search_query, SEARCH_RESULT_CAP))
+
+                    yield from body.get('items')
+                    if response.links.get('last'):
+                        last_url = response.links.get('last').get('url')
+                        total_pages = int(parse_qs(urlparse(last_url).query).get('page')[0])
+                        pages = [(search_query, page) for page in range(2, total_pages + 1)]
+                        for page_response in executor.map(get_page, pages):
+                            yield from page_response.json().get('items')
+                searches = next_searches
+
+    def multipage_search(self, url, query, media_type=None):
+        """Wrapper for GitHub API methods that use pagination"""
 
-        response = self.make_request('/'.join((self.base_url, url)), params=params)
-        for value in response.json().get('items'):
-            results.append(value)
+        return list(self.iter_search(url, query, media_type))
 
-        if response.links.get('last'):
-            total_pages = response.links.get('last').get('url')[response.links.get('last').get('url').rindex('=') + 1:]
-            for page in range(2, int(total_pages) + 1):
-                time.sleep(2)
-                params['page'] = str(page)
-                response = self.make_request('/'.join((self.base_url, url)), params=params)
-                for value in response.json().get('items'):
-                    results.append(value)
+    @property
+    def graphql_url(self):
+        # GitHub Enterprise serves GraphQL from /api/graphql rather than under /api/v3
+        if self.base_url.endswith('/api/v3'):
+            return '{}/graphql'.format(self.base_url[:-len('/v3')])
+        return '/'.join((self.base_url, 'graphql'))
 
-        return results
+    def graphql(self, query, variables=None):
+        """Run a GraphQL query and return its data. Raises an exception if GitHub returned
+            errors and no data"""
+
+        response = self.make_request(self.graphql_url, data=json.dumps({'query': query, 'variables': variables or {}}),
+                                     method='POST', headers={'Accept': 'application/json'})
+        body = response.json()
+        if body.get('errors') and not body.get('data'):
+            raise Exception('GraphQL Error: {}'.format(body.get('errors')[0].get('message')))
+        return body.get('data')
 
     def get_user(self):
         return self.make_request('/'.join((self.base_url, 'user'))).json()
 
-    def get_repository(self, fullname):
-        return self.make_request('/'.join((self.base_url, 'repos/{}'.format(fullname)))).json()
+    def get_repositories(self, owner):
+        """Every repository of an organisation or user that the token can see"""
+
+        account = self.make_request('/'.join((self.base_url, 'users', owner))).json()
+        kind = 'orgs' if account.get('type') == 'Organization' else 'users'
+        url = '/'.join((self.base_url, kind, owner, 'repos'))
+        params = {'per_page': self.per_page, 'type': 'all'}
+        repositories = []
+        while url:
+            response = self.make_request(url, params=params)
+            repositories.extend(response.json())
+            # The next link already carries the query string
+            url = response.links.get('next', {}).get('url')
+            params = None
+        return repositories
 
+    def close(self):
+        self.session.close()
 
-def initiate_github_connection():
-    """Create a GitHub API client object"""
+
+def read_conf():
+    # yaml is only imported when settings aren't given in the environment
+    import yaml
+
+    with open('{}/watchman.conf'.format(os.path.expanduser('~'))) as yaml_file:
+        return yaml.safe_load(yaml_file)
+
+
+def initiate_github_connection(max_workers=4, repository_cache=None, rate_limiter=None, match_cache=None,
+                               event_loop=False):
+    """Create a GitHub API client object. With event_loop, its requests are sent from one
+        asyncio event loop"""
 
     try:
         token = os.environ['GITHUB_WATCHMAN_TOKEN']
     except KeyError:
-        with open('{}/watchman.conf'.format(os.path.expanduser('~'))) as yaml_file:
-            config = yaml.safe_load(yaml_file)
+        config = read_conf()
 
         token = config.get('github_watchman').get('token')
 
     try:
         url = os.environ['GITHUB_WATCHMAN_URL']
     except KeyError:
-        with open('{}/watchman.conf'.format(os.path.expanduser('~'))) as yaml_file:
-            config = yaml.safe_load(yaml_file)
+        config = read_conf()
 
         url = config.get('github_watchman').get('url')
 
-    return GitHubAPIClient(token, url)
+    if event_loop:
+        # aiohttp is only imported when the asyncio client is used
+        from github_watchman.async_client import EventLoopGitHubAPIClient
+        return EventLoopGitHubAPIClient(token, url, max_workers=max_workers, rate_limiter=rate_limiter,
+                                        repository_cache=repository_cache, match_cache=match_cache)
+    return GitHubAPIClient(token, url, max_workers=max_workers, rate_limiter=rate_limiter,
+                           repository_cache=repository_cache, match_cache=match_cache)
+
+
+def _error_message(response):
+    """The error message GitHub gave for a failed request, if any"""
+
+    try:
+        message = response.json().get('message')
+    except ValueError:
+        return None
+    if isinstance(message, dict):
+        message = message.get('error')
+    if message:
+        return '{} Error: {} for url: {}'.format(response.status_code, message, response.url)
 
 
 def convert_time(timestamp):
@@ -137,246 +236,303 @@ def convert_time(timestamp):
     return int(time.mktime(time.strptime(timestamp, pattern)))
 
 
-def deduplicate(input_list):
-    """Removes duplicates where results are returned by multiple queries"""
+def _match_list(item):
+    match_list = []
+    for match in item.get('text_matches'):
+        match_list.append({
+            'object_url': match.get('object_url'),
+            'object_type': match.get('object_type'),
+            'fragment': match.get('fragment')
+        })
+    return match_list
+
+
+def _code_result(code):
+    return {
+        'file_name': code.get('name'),
+        'file_url': code.get('html_url'),
+        'sha': code.get('sha'),
+        'repository': {
+            'repository_id': code.get('repository').get('id'),
+            'repository_node_id': code.get('repository').get('node_id'),
+            'repository_name': code.get('repository').get('name'),
+            'repository_url': code.get('repository').get('html_url'),
+        },
+        'matches': _match_list(code)
+    }
+
+
+def _recent_code(github: GitHubAPIClient, batch, since):
+    """The code results in batch whose repository was updated after since, with the
+        repositories looked up in one batched GraphQL query"""
+
+    repositories = enrichment.repositories(github, [code.get('repository').get('node_id') for code in batch])
+    for code in batch:
+        repository = repositories.get(code.get('repository').get('node_id'))
+        if repository is not None and convert_time(repository.get('updated_at')) > since:
+            yield _code_result(code)
+        else:
+            metrics.TIMEFRAME_FILTERED.inc(scope='code')
+
+
+def _code_matches(github: GitHubAPIClient, rule, code):
+    """Whether the rule, or any rule of a PlannedQuery, matches a code result, using cached
+        verdicts for the blob when there is a match cache"""
+
+    if isinstance(rule, PlannedQuery):
+        return rule.matches(code.get('text_matches'), code.get('sha'), github.match_cache)
+    if github.match_cache is not None:
+        return github.match_cache.matches(rule, code.get('sha'), code.get('text_matches'))
+    return rule.matches(code.get('text_matches'))
+
+
+def query_code(github: GitHubAPIClient, rule, query, timeframe=cfg.ALL_TIME, seen=None):
+    """Generator over the results of the Search API for a single search term of a rule that
+        pass the timeframe and regex filters, skipping any whose fingerprint is in seen.
+        Returns the number of code fragments the search found.
+
+        When filtering by timeframe, matching results are held back until enrichment.BATCH_SIZE
+        of them have their repositories looked up together"""
+
+    hits = 0
+    since = calendar.timegm(time.gmtime()) - timeframe
+    batch = []
+
+    for code in github.iter_search('search/code', query):
+        hits += 1
+        if seen is not None and fingerprint(code.get('sha'), code.get('html_url')) in seen:
+            continue
+        if not _code_matches(github, rule, code):
+            continue
+        if timeframe == cfg.ALL_TIME:
+            yield _code_result(code)
+            continue
+        batch.append(code)
+        if len(batch) == enrichment.BATCH_SIZE:
+            yield from _recent_code(github, batch, since)
+            batch = []
+    if batch:
+        yield from _recent_code(github, batch, since)
+
+    return hits
+
+
+def _commit_results(github: GitHubAPIClient, batch):
+    """Results for the commits in batch. The committer's name and email come from the commit and
+        their account from the search result. Commits the search didn't link to an account are
+        looked up in one batched GraphQL query, and keep what the search gave if that fails"""
+
+    unlinked = [commit.get('node_id') for commit in batch if commit.get('node_id') and not commit.get('committer')]
+    committers = {}
+    if unlinked:
+        try:
+            committers = enrichment.committers(github, unlinked)
+        except Exception:
+            pass
+    for commit in batch:
+        account = commit.get('committer') or {}
+        signature = commit.get('commit').get('committer')
+        committer = committers.get(commit.get('node_id')) or {}
+        yield {
+            'commit_url': commit.get('html_url'),
+            'sha': commit.get('sha'),
+            'comments_url': commit.get('comments_url'),
+            'committer_name': signature.get('name') or committer.get('name'),
+            'committer_id': account.get('id') or committer.get('id'),
+            'committer_email': signature.get('email') or committer.get('email'),
+            'committer_login': account.get('login') or committer.get('login'),
+            'commit_date': commit.get('commit').get('committer').get('date'),
+            'message': commit.get('message'),
+            'repository': {
+                'repository_id': commit.get('repository').get('id'),
+                'repository_node_id': commit.get('repository').get('node_id'),
+                'repository_name': commit.get('repository').get('name'),
+                'repository_url': commit.get('repository').get('html_url'),
+            },
+            'matches': _match_list(commit)
+        }
 
-    list_of_strings = [json.dumps(d, sort_keys=True) for d in input_list]
-    list_of_strings = set(list_of_strings)
-    return [json.loads(s) for s in list_of_strings]
 
+def query_commits(github: GitHubAPIClient, rule, query, timeframe=cfg.ALL_TIME, seen=None):
+    """Generator over the results of the Search API for a single search term of a rule that
+        pass the timeframe and regex filters, skipping any whose fingerprint is in seen.
+        Returns the number of commits the search found.
 
-def search_code(github: GitHubAPIClient, log_handler, rule, timeframe=cfg.ALL_TIME):
-    """Uses the Search API to get code fragments matching a search term.
-        This is then filtered by regex to find true matches"""
+        Matching results are held back until enrichment.BATCH_SIZE of them can have the
+        committers the search didn't link to an account looked up together"""
 
-    results = []
+    hits = 0
+    now = calendar.timegm(time.gmtime())
+    pattern = '%Y-%m-%dT%H:%M:%S.%f%z'
+    batch = []
+
+    for commit in github.iter_search('search/commits', query, 'application/vnd.github.cloak-preview.text-match+json'):
+        hits += 1
+        if seen is not None and fingerprint(commit.get('sha'), commit.get('html_url')) in seen:
+            continue
+        commit_time = int(time.mktime(time.strptime(commit.get('commit').get('committer').get('date'), pattern)))
+        if commit_time <= (now - timeframe):
+            metrics.TIMEFRAME_FILTERED.inc(scope='commits')
+            continue
+        if rule.matches(commit.get('text_matches')):
+            batch.append(commit)
+            if len(batch) == enrichment.BATCH_SIZE:
+                yield from _commit_results(github, batch)
+                batch = []
+    if batch:
+        yield from _commit_results(github, batch)
+
+    return hits
+
+
+def query_issues(github: GitHubAPIClient, rule, query, timeframe=cfg.ALL_TIME, seen=None):
+    """Generator over the results of the Search API for a single search term of a rule that
+        pass the timeframe and regex filters, skipping any whose fingerprint is in seen.
+        Returns the number of issues the search found"""
+
+    hits = 0
+    now = calendar.timegm(time.gmtime())
+
+    for issue in github.iter_search('search/issues', query):
+        hits += 1
+        if seen is not None and fingerprint(issue.get('updated_at'), issue.get('html_url')) in seen:
+            continue
+        if convert_time(issue.get('updated_at')) <= (now - timeframe):
+            metrics.TIMEFRAME_FILTERED.inc(scope='issues')
+            continue
+        if rule.matches(issue.get('text_matches')):
+            yield {
+                'issue_id': issue.get('id'),
+                'issue_title': issue.get('title'),
+                'issue_body': issue.get('body'),
+                'issue_url': issue.get('html_url'),
+                'sha': issue.get('sha'),
+                'user_login': issue.get('user').get('login'),
+                'user_id': issue.get('user').get('id'),
+                'state': issue.get('state'),
+                'updated_at': issue.get('updated_at'),
+                'repository_url': issue.get('repository_url'),
+                'matches': _match_list(issue)
+            }
+
+    return hits
+
+
+def query_repositories(github: GitHubAPIClient, rule, query, timeframe=cfg.ALL_TIME, seen=None):
+    """Generator over the results of the Search API for a single search term of a rule that
+        pass the timeframe and regex filters, skipping any whose fingerprint is in seen.
+        Returns the number of repositories the search found"""
+
+    hits = 0
     now = calendar.timegm(time.gmtime())
-    if isinstance(log_handler, logger.StdoutLogger):
-        print = log_handler.log_info
+
+    for repo in github.iter_search('search/repositories', query):
+        hits += 1
+        if seen is not None and fingerprint(repo.get('updated_at'), repo.get('html_url')) in seen:
+            continue
+        if convert_time(repo.get('updated_at')) <= (now - timeframe):
+            metrics.TIMEFRAME_FILTERED.inc(scope='repositories')
+            continue
+        if rule.matches(repo.get('text_matches')):
+            yield {
+                'repository_id': repo.get('id'),
+                'repository_name': repo.get('full_name'),
+                'repository_description': repo.get('description'),
+                'repository_url': repo.get('html_url'),
+                'updated_at': repo.get('updated_at'),
+                'owner_login': repo.get('owner').get('login'),
+                'owner_id': repo.get('owner').get('id'),
+                'issue_url': repo.get('html_url'),
+                'matches': _match_list(repo)
+            }
+
+    return hits
+
+
+QUERY_FUNCTIONS = {
+    'code': query_code,
+    'commits': query_commits,
+    'issues': query_issues,
+    'repositories': query_repositories
+}
+
+SCOPE_DESCRIPTIONS = {
+    'code': 'code fragments',
+    'commits': 'commits',
+    'issues': 'issues',
+    'repositories': 'repositories'
+}
+
+
+def report_query(log_handler, scope, query, hits):
+    """Output how many raw search results a query returned"""
+
+    description = SCOPE_DESCRIPTIONS.get(scope)
+    if hits:
+        logger.print_info(log_handler, '{} {} found matching: {}'.format(hits, description, query.replace('"', '')))
     else:
-        print = builtins.print
-
-    for query in rule.get('strings'):
-        code_list = github.multipage_search('search/code', query)
-        if code_list:
-            print('{} code fragments found matching: {}'.format(len(code_list), query.replace('"', '')))
-            if timeframe != cfg.ALL_TIME:
-                for code in code_list:
-                    r = re.compile(rule.get('pattern'))
-                    repository = github.get_repository(code.get('repository').get('full_name'))
-                    if convert_time(repository.get('updated_at')) > (now - timeframe) and r.search(str(code.get('text_matches'))):
-                        match_list = []
-                        for match in code.get('text_matches'):
-                            match_list.append({
-                                'object_url': match.get('object_url'),
-                                'object_type': match.get('object_type'),
-                                'fragment': match.get('fragment')
-                            })
-
-                        results_dict = {
-                            'file_name': code.get('name'),
-                            'file_url': code.get('html_url'),
-                            'sha': code.get('sha'),
-                            'repository': {
-                                'repository_id': code.get('repository').get('id'),
-                                'repository_node_id': code.get('repository').get('node_id'),
-                                'repository_name': code.get('repository').get('name'),
-                                'repository_url': code.get('repository').get('html_url'),
-                            },
-                            'matches': match_list
-                        }
-
-                        results.append(results_dict)
-            else:
-                for code in code_list:
-                    r = re.compile(rule.get('pattern'))
-                    if r.search(str(code.get('text_matches'))):
-                        match_list = []
-                        for match in code.get('text_matches'):
-                            match_list.append({
-                                'object_url': match.get('object_url'),
-                                'object_type': match.get('object_type'),
-                                'fragment': match.get('fragment')
-                            })
-
-                        results_dict = {
-                            'file_name': code.get('name'),
-                            'file_url': code.get('html_url'),
-                            'sha': code.get('sha'),
-                            'repository': {
-                                'repository_id': code.get('repository').get('id'),
-                                'repository_node_id': code.get('repository').get('node_id'),
-                                'repository_name': code.get('repository').get('name'),
-                                'repository_url': code.get('repository').get('html_url'),
-                            },
-                            'matches': match_list
-                        }
-
-                        results.append(results_dict)
-        else:
-            print('No code fragments found matching: {}'.format(query.replace('"', '')))
-    if results:
-        results = deduplicate(results)
-        print('{} total matches found after filtering'.format(len(results)))
-        return results
+        logger.print_info(log_handler, 'No {} found matching: {}'.format(description, query.replace('"', '')))
+
+
+def report_total(log_handler, total):
+    """Output the total number of deduplicated results for a rule"""
+
+    if total:
+        logger.print_info(log_handler, '{} total matches found after filtering'.format(total))
     else:
-        print('No matches found after filtering')
+        logger.print_info(log_handler, 'No matches found after filtering')
 
 
-def search_commits(github: GitHubAPIClient, log_handler, rule, timeframe=cfg.ALL_TIME):
-    """Uses the Search API to get commits matching a search term.
-        This is then filtered by regex to find true matches"""
+def run_query(query_results, emit):
+    """Pass each result of a query_* generator to emit, returning the number of search hits"""
+
+    while True:
+        try:
+            result = next(query_results)
+        except StopIteration as stop:
+            return stop.value
+        emit(result)
 
+
+def _search(scope, github: GitHubAPIClient, log_handler, rule, timeframe):
     results = []
-    now = calendar.timegm(time.gmtime())
-    if isinstance(log_handler, logger.StdoutLogger):
-        print = log_handler.log_info
-    else:
-        print = builtins.print
+    deduplicator = Deduplicator()
 
-    pattern = '%Y-%m-%dT%H:%M:%S.%f%z'
+    def emit(result):
+        if deduplicator.is_new(scope, result):
+            results.append(result)
 
-    for query in rule.get('strings'):
-        commit_list = github.multipage_search('search/commits', query, 'application/vnd.github.cloak-preview.text-match+json')
-        if commit_list:
-            print('{} commits found matching: {}'.format(len(commit_list), query.replace('"', '')))
-            for commit in commit_list:
-                r = re.compile(rule.get('pattern'))
-                commit_time = int(time.mktime(time.strptime(commit.get('commit').get('committer').get('date'), pattern)))
-                if commit_time > (now - timeframe) and r.search(str(commit.get('text_matches'))):
-                    match_list = []
-                    for match in commit.get('text_matches'):
-                        match_list.append({
-                            'object_url': match.get('object_url'),
-                            'object_type': match.get('object_type'),
-                            'fragment': match.get('fragment')
-                        })
-
-                    results_dict = {
-                        'commit_url': commit.get('html_url'),
-                        'sha': commit.get('sha'),
-                        'comments_url': commit.get('comments_url'),
-                        'committer_name': commit.get('committer').get('name'),
-                        'committer_id': commit.get('committer').get('id'),
-                        'committer_email': commit.get('committer').get('email'),
-                        'committer_login': commit.get('committer').get('email'),
-                        'commit_date': commit.get('commit').get('committer').get('date'),
-                        'message': commit.get('message'),
-                        'repository': {
-                            'repository_id': commit.get('repository').get('id'),
-                            'repository_node_id': commit.get('repository').get('node_id'),
-                            'repository_name': commit.get('repository').get('name'),
-                            'repository_url': commit.get('repository').get('html_url'),
-                        },
-                        'matches': match_list
-                    }
-
-                    results.append(results_dict)
-        else:
-            print('No commits found matching: {}'.format(query.replace('"', '')))
+    for query in rule.strings:
+        hits = run_query(QUERY_FUNCTIONS.get(scope)(github, rule, query, timeframe), emit)
+        report_query(log_handler, scope, query, hits)
+    report_total(log_handler, len(results))
     if results:
-        results = deduplicate(results)
-        print('{} total matches found after filtering'.format(len(results)))
         return results
-    else:
-        print('No matches found after filtering')
+
+
+def search_code(github: GitHubAPIClient, log_handler, rule, timeframe=cfg.ALL_TIME):
+    """Uses the Search API to get code fragments matching a search term.
+        This is then filtered by regex to find true matches"""
+
+    return _search('code', github, log_handler, rule, timeframe)
+
+
+def search_commits(github: GitHubAPIClient, log_handler, rule, timeframe=cfg.ALL_TIME):
+    """Uses the Search API to get commits matching a search term.
+        This is then filtered by regex to find true matches"""
+
+    return _search('commits', github, log_handler, rule, timeframe)
 
 
 def search_issues(github: GitHubAPIClient, log_handler, rule, timeframe=cfg.ALL_TIME):
     """Uses the Search API to get issues matching a search term.
         This is then filtered by regex to find true matches"""
 
-    results = []
-    now = calendar.timegm(time.gmtime())
-    if isinstance(log_handler, logger.StdoutLogger):
-        print = log_handler.log_info
-    else:
-        print = builtins.print
-
-    for query in rule.get('strings'):
-        issue_list = github.multipage_search('search/issues', query)
-        if issue_list:
-            print('{} issues found matching: {}'.format(len(issue_list), query.replace('"', '')))
-            for issue in issue_list:
-                r = re.compile(rule.get('pattern'))
-                if convert_time(issue.get('updated_at')) > (now - timeframe) and r.search(str(issue.get('text_matches'))):
-                    match_list = []
-                    for match in issue.get('text_matches'):
-                        match_list.append({
-                            'object_url': match.get('object_url'),
-                            'object_type': match.get('object_type'),
-                            'fragment': match.get('fragment')
-                        })
-
-                    results_dict = {
-                        'issue_id': issue.get('id'),
-                        'issue_title': issue.get('title'),
-                        'issue_body': issue.get('body'),
-                        'issue_url': issue.get('html_url'),
-                        'sha': issue.get('sha'),
-                        'user_login': issue.get('user').get('login'),
-                        'user_id': issue.get('user').get('id'),
-                        'state': issue.get('state'),
-                        'updated_at': issue.get('updated_at'),
-                        'repository_url': issue.get('repository_url'),
-                        'matches': match_list
-                    }
-
-                    results.append(results_dict)
-        else:
-            print('No issues found matching: {}'.format(len(issue_list), query.replace('"', '')))
-    if results:
-        results = deduplicate(results)
-        print('{} total matches found after filtering'.format(len(results)))
-        return results
-    else:
-        print('No matches found after filtering')
+    return _search('issues', github, log_handler, rule, timeframe)
 
 
 def search_repositories(github: GitHubAPIClient, log_handler, rule, timeframe=cfg.ALL_TIME):
     """Uses the Search API to get repositories matching a search term.
         This is then filtered by regex to find true matches"""
 
-    results = []
-    now = calendar.timegm(time.gmtime())
-    if isinstance(log_handler, logger.StdoutLogger):
-        print = log_handler.log_info
-    else:
-        print = builtins.print
-
-    for query in rule.get('strings'):
-        repo_list = github.multipage_search('search/repositories', query)
-        if repo_list:
-            print('{} repositories found matching: {}'.format(len(repo_list), query.replace('"', '')))
-            for repo in repo_list:
-                r = re.compile(rule.get('pattern'))
-                if convert_time(repo.get('updated_at')) > (now - timeframe) and r.search(str(repo.get('text_matches'))):
-                    match_list = []
-                    for match in repo.get('text_matches'):
-                        match_list.append({
-                            'object_url': match.get('object_url'),
-                            'object_type': match.get('object_type'),
-                            'fragment': match.get('fragment')
-                        })
-
-                    results_dict = {
-                        'repository_id': repo.get('id'),
-                        'repository_name': repo.get('full_name'),
-                        'repository_description': repo.get('description'),
-                        'repository_url': repo.get('html_url'),
-                        'updated_at': repo.get('updated_at'),
-                        'owner_login': repo.get('owner').get('login'),
-                        'owner_id': repo.get('owner').get('id'),
-                        'issue_url': repo.get('html_url'),
-                        'matches': match_list
-                    }
-
-                    results.append(results_dict)
-        else:
-            print('No repositories found matching: {}'.format(query.replace('"', '')))
-    if results:
-        results = deduplicate(results)
-        print('{} total matches found after filtering'.format(len(results)))
-        return results
-    else:
-        print('No matches found after filtering')
+    return _search('repositories', github, log_handler, rule, timeframe)
@@ -1,17 +1,68 @@
+import atexit
+import builtins
 import json
 import os
 import csv
-import logging
+import gzip
+import queue
+import random
 import socket
 import sys
-import logging.handlers
+import threading
+import time
 from datetime import datetime
-from logging import Logger
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from github_watchman.cache import CACHE_PATH
+
+# Findings waiting to be sent to the TCP collector are spooled here while it can't be reached
+SPOOL_PATH = os.path.join(CACHE_PATH, 'stream-spool.ndjson')
+# Messages are sent to the collector once this much is queued, or FLUSH_INTERVAL seconds after
+# the first of them
+BATCH_BYTES = 65536
+FLUSH_INTERVAL = 1.0
+# Log files and stdout are written to once this much is buffered, or every FLUSH_INTERVAL seconds
+WRITE_BUFFER_BYTES = 65536
+# File extension of CSV output for each compression option
+CSV_EXTENSIONS = {
+    None: '',
+    'gzip': '.gz',
+    'zstd': '.zst'
+}
+# Messages queued before they are spooled to disk instead
+MAX_PENDING_MESSAGES = 10000
+CONNECT_TIMEOUT = 10
+# Reconnection backoff starts at this many seconds and is capped at RECONNECT_CAP
+RECONNECT_BASE = 1
+RECONNECT_CAP = 60
 
 
 class CSVLogger(object):
-    def __init__(self):
-        self.base_out_path = os.getcwd()
+    """Appends findings to one CSV file per rule and scope as they are found.
+
+        Files are opened the first time a rule finds something in a scope and closed once its
+        search has completed, so only the rows written since the last flush are held in memory.
+        Nested repository fields are flattened into their own columns and matches are JSON
+        encoded. Files can be gzip or zstd compressed, each run is appended as a new member"""
+
+    def __init__(self, out_path=None, compression=None, flush_interval=FLUSH_INTERVAL):
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError('zstandard is required for zstd compressed CSV: pip install github-watchman[zstd]')
+        self.base_out_path = out_path or os.getcwd()
+        self.compression = compression
+        self.flush_interval = flush_interval
+        # (filename, scope) to (path, file, csv.DictWriter)
+        self.writers = {}
+        self.flushed_at = time.monotonic()
+        self.lock = threading.Lock()
         self.headers = {
             'code': [
                 'file_name',
@@ -65,123 +116,384 @@ class CSVLogger(object):
             ]
         }
 
-    def write_csv(self, filename, scope, input_list):
-        """Writes input list to .csv. The headers and output path are passed as variables"""
+    def _open(self, filename, scope):
+        path = '{}/{}_{}.csv{}'.format(self.base_out_path, filename, scope, CSV_EXTENSIONS.get(self.compression))
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        if self.compression == 'gzip':
+            csv_file = gzip.open(path, mode='at', encoding='utf-8', newline='')
+        elif self.compression == 'zstd':
+            csv_file = zstandard.open(path, mode='at', encoding='utf-8', newline='')
+        else:
+            csv_file = open(path, mode='a', encoding='utf-8', newline='')
+        writer = csv.DictWriter(csv_file, fieldnames=self.headers.get(scope))
+        if new_file:
+            writer.writeheader()
+        return path, csv_file, writer
 
-        path = '{}/{}_{}.csv'.format(self.base_out_path, filename, scope)
+    @staticmethod
+    def _row(finding):
+        row = {}
+        for key, value in finding.items():
+            if key == 'matches':
+                row[key] = json.dumps(value)
+            elif isinstance(value, dict):
+                row.update(value)
+            else:
+                row[key] = value
+        return row
 
-        with open(path, mode='w+', encoding='utf-8') as csv_file:
-            writer = csv.DictWriter(csv_file, fieldnames=self.headers.get(scope))
-            writer.writeheader()
-            for data in input_list:
-                writer.writerow(data)
+    def write_row(self, filename, scope, finding):
+        """Append a finding to the CSV file for the rule and scope, opening it if needed"""
+
+        with self.lock:
+            entry = self.writers.get((filename, scope))
+            if entry is None:
+                entry = self.writers[(filename, scope)] = self._open(filename, scope)
+            entry[2].writerow(self._row(finding))
+            if time.monotonic() - self.flushed_at >= self.flush_interval:
+                for _, csv_file, _ in self.writers.values():
+                    csv_file.flush()
+                self.flushed_at = time.monotonic()
+
+    def complete(self, filename, scope):
+        """Close the CSV file for the rule and scope. Returns its path, or None if nothing was found"""
+
+        with self.lock:
+            entry = self.writers.pop((filename, scope), None)
+        if entry is None:
+            return None
+        entry[1].close()
+        return entry[0]
+
+    def close(self):
+        for filename, scope in list(self.writers):
+            self.complete(filename, scope)
+
+
+def dumps(data):
+    """Serialise to compact JSON bytes, with orjson when it is installed"""
+
+    if orjson is not None:
+        return orjson.dumps(data, default=str)
+    return json.dumps(data, separators=(',', ':'), default=str).encode('utf-8')
 
-        csv_file.close()
-        print('CSV written: {}'.format(path))
 
+class JSONLogger(object):
+    """Formats findings and messages as one line of JSON each.
+
+        The fields of a finding other than the time and the finding itself only depend on the
+        scope and rule, so they are serialised once and reused for every finding of that rule"""
+
+    # Digits of the fraction of a second in localtime
+    TIME_DIGITS = 3
+
+    def __init__(self, source='GitHub Watchman'):
+        self.source = source
+        self.envelopes = {}
+
+    def localtime(self):
+        return datetime.now().strftime('%Y-%m-%d %H:%M:%S,%f')[:20 + self.TIME_DIGITS]
+
+    def _envelope(self, scope, detect_type, severity):
+        key = (scope, detect_type, severity)
+        envelope = self.envelopes.get(key)
+        if envelope is None:
+            fields = dumps({
+                'level': 'NOTIFY',
+                'source': self.source,
+                'scope': scope,
+                'severity': severity,
+                'detection_type': detect_type
+            })
+            envelope = self.envelopes[key] = b',' + fields[1:-1] + b',"detection_data":'
+        return envelope
+
+    def notification(self, log_data, scope, detect_type, severity):
+        return b''.join((b'{"localtime":"', self.localtime().encode('ascii'), b'"',
+                         self._envelope(scope, detect_type, severity), dumps(log_data), b'}\n'))
+
+    def message(self, level, log_data):
+        return dumps({
+            'localtime': self.localtime(),
+            'level': level,
+            'source': self.source,
+            'message': log_data
+        }) + b'\n'
+
+
+class NDJSONWriter(object):
+    """Buffered, thread safe writer of newline delimited JSON to a binary stream.
+
+        Lines are written out once flush_bytes have been buffered, and at least every
+        flush_interval seconds by a background thread. When writing to a path, the file is
+        reopened if it is moved, so it can be rotated by logrotate"""
+
+    def __init__(self, stream=None, path=None, flush_bytes=WRITE_BUFFER_BYTES, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.stream = stream if stream is not None else self._open()
+        self.flush_bytes = flush_bytes
+        self.buffer = []
+        self.size = 0
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self._flush_periodically, args=(flush_interval,),
+                                       name='NDJSONWriter', daemon=True)
+        self.thread.start()
+        # Lines still buffered if the process exits without closing the writer
+        atexit.register(self.flush)
+
+    def _open(self):
+        stream = open(self.path, 'ab')
+        self.inode = os.fstat(stream.fileno()).st_ino
+        return stream
+
+    def _reopen_if_moved(self):
+        try:
+            moved = os.stat(self.path).st_ino != self.inode
+        except FileNotFoundError:
+            moved = True
+        if moved:
+            self.stream.close()
+            self.stream = self._open()
 
-class LoggingBase(Logger):
-    def __init__(self, name='GitHub Watchman'):
-        super().__init__(name)
-        self.notify_format = logging.Formatter(
-            '{"localtime": "%(asctime)s", "level": "NOTIFY", "source": "%(name)s", "scope": "%(scope)s",'
-            ' "severity": "%(severity)s", "detection_type": "%(type)s", "detection_data": %(message)s}')
-        self.info_format = logging.Formatter(
-            '{"localtime": "%(asctime)s", "level": "%(levelname)s", "source": "%(name)s", "message":'
-            ' "%(message)s"}')
-        self.log_path = ''
-        self.logger = logging.getLogger(self.name)
-        self.logger.setLevel(logging.DEBUG)
+    def _flush_periodically(self, interval):
+        while not self.closed.wait(interval):
+            self.flush()
 
+    def _write_buffer(self):
+        if self.path is not None:
+            self._reopen_if_moved()
+        self.stream.write(b''.join(self.buffer))
+        self.stream.flush()
+        self.buffer = []
+        self.size = 0
 
-class FileLogger(LoggingBase):
+    def write(self, line, flush=False):
+        with self.lock:
+            self.buffer.append(line)
+            self.size += len(line)
+            if flush or self.size >= self.flush_bytes:
+                self._write_buffer()
+
+    def flush(self):
+        with self.lock:
+            if self.buffer and not self.stream.closed:
+                self._write_buffer()
+
+    def close(self):
+        self.closed.set()
+        self.thread.join()
+        self.flush()
+        atexit.unregister(self.flush)
+        if self.path is not None:
+            self.stream.close()
+
+
+class FileLogger(JSONLogger):
     def __init__(self, log_path):
-        LoggingBase.__init__(self)
-        self.handler = logging.handlers.WatchedFileHandler(os.path.join(log_path, 'github_watchman.log'))
-        self.logger.addHandler(self.handler)
+        super().__init__()
+        self.log_path = os.path.join(log_path, 'github_watchman.log')
+        self.writer = NDJSONWriter(path=self.log_path)
 
     def log_notification(self, log_data, scope, detect_type, severity):
-        self.handler.setFormatter(self.notify_format)
-        self.logger.warning(json.dumps(log_data), extra={
-            'scope': scope,
-            'type': detect_type,
-            'severity': severity
-        })
+        self.writer.write(self.notification(log_data, scope, detect_type, severity))
 
     def log_info(self, log_data):
-        self.handler.setFormatter(self.info_format)
-        self.logger.info(log_data)
+        self.writer.write(self.message('INFO', log_data))
 
     def log_critical(self, log_data):
-        self.handler.setFormatter(self.info_format)
-        self.logger.critical(log_data)
+        self.writer.write(self.message('CRITICAL', log_data))
 
+    def close(self):
+        self.writer.close()
 
-class StdoutLogger(LoggingBase):
+
+class StdoutLogger(JSONLogger):
     def __init__(self):
-        LoggingBase.__init__(self)
-        self.handler = logging.StreamHandler(sys.stdout)
-        self.logger.addHandler(self.handler)
+        super().__init__()
+        self.writer = NDJSONWriter(sys.stdout.buffer)
 
     def log_notification(self, log_data, scope, detect_type, severity):
-        self.handler.setFormatter(self.notify_format)
-        self.logger.warning(json.dumps(log_data), extra={
-            'scope': scope,
-            'type': detect_type,
-            'severity': severity
-        })
+        self.writer.write(self.notification(log_data, scope, detect_type, severity))
 
     def log_info(self, log_data):
-        self.handler.setFormatter(self.info_format)
-        self.logger.info(log_data)
+        # Progress messages are shown straight away, findings are written out in batches
+        self.writer.write(self.message('INFO', log_data), flush=True)
 
     def log_critical(self, log_data):
-        self.handler.setFormatter(self.info_format)
-        self.logger.critical(log_data)
+        self.writer.write(self.message('CRITICAL', log_data), flush=True)
+
+    def close(self):
+        self.writer.close()
+
+
+def print_info(log_handler, message):
+    """Show a progress message. It goes through the stdout logger when findings are output to
+        stdout, so the two don't interleave, and is printed otherwise"""
+
+    if isinstance(log_handler, StdoutLogger):
+        log_handler.log_info(message)
+    else:
+        builtins.print(message)
+
+
+def print_critical(log_handler, message):
+    """Show an error message the way print_info shows progress messages"""
+
+    if isinstance(log_handler, StdoutLogger):
+        log_handler.log_critical(message)
+    else:
+        builtins.print(message)
+
+
+class SocketJSONLogger(JSONLogger):
+    """Sends findings as newline delimited JSON to a TCP collector.
+
+        Messages are queued and sent from a background thread in batches of up to BATCH_BYTES,
+        or whatever has arrived after FLUSH_INTERVAL seconds, so logging doesn't wait on the
+        network. While the collector can't be reached, or can't keep up with the queue, messages
+        are spooled to a file, and the connection is retried with backoff. The spool is replayed
+        before any newer messages are sent, so findings arrive in order. Anything still spooled
+        when the scan ends is sent on the next run"""
 
+    STOP = object()
+    TIME_DIGITS = 6
 
-class SocketJSONLogger(object):
-    def __init__(self, host, port):
+    def __init__(self, host, port, spool_path=SPOOL_PATH, batch_bytes=BATCH_BYTES, flush_interval=FLUSH_INTERVAL,
+                 max_pending=MAX_PENDING_MESSAGES):
+        super().__init__()
         self.host = host
-        self.port = port
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.port = int(port)
+        self.spool_path = spool_path
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.sock = None
+        self.backoff = 0
+        self.retry_at = 0
+        self.spool_lock = threading.Lock()
+        os.makedirs(os.path.dirname(spool_path), exist_ok=True)
+        self.thread = threading.Thread(target=self._run, name='SocketJSONLogger', daemon=True)
+        self.thread.start()
+
+    def _connected(self):
+        """Connect if not already connected and the backoff allows another attempt"""
+
+        if self.sock is not None:
+            return True
+        if time.monotonic() < self.retry_at:
+            return False
         try:
-            self.sock.connect((self.host, self.port))
-        except socket.error as error:
-            print(error)
+            self.sock = socket.create_connection((self.host, self.port), timeout=CONNECT_TIMEOUT)
+        except OSError as error:
+            if not self.backoff:
+                print('Can\'t reach {}:{} ({}), spooling findings to {}'.format(self.host, self.port, error,
+                                                                              self.spool_path))
+            self.backoff = min(RECONNECT_CAP, self.backoff * 2 or RECONNECT_BASE)
+            self.retry_at = time.monotonic() + random.uniform(self.backoff / 2, self.backoff)
+            return False
+        self.backoff = 0
+        return True
+
+    def _disconnect(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _spool(self, data):
+        with self.spool_lock, open(self.spool_path, 'ab') as spool:
+            spool.write(data)
+
+    def _spooled(self):
+        return os.path.exists(self.spool_path) and os.path.getsize(self.spool_path) > 0
+
+    def _replay(self):
+        """Send everything in the spool. Whatever could not be sent is kept in it"""
+
+        with self.spool_lock:
+            if not self._spooled():
+                return
+            sent = 0
+            with open(self.spool_path, 'rb') as spool:
+                try:
+                    for chunk in iter(lambda: spool.read(self.batch_bytes), b''):
+                        self.sock.sendall(chunk)
+                        sent += len(chunk)
+                except OSError:
+                    spool.seek(sent)
+                    unsent = spool.read()
+                    with open(self.spool_path, 'wb') as remaining:
+                        remaining.write(unsent)
+                    raise
+            open(self.spool_path, 'wb').close()
+
+    def _send(self, data):
+        if self._connected():
+            try:
+                self._replay()
+                if data:
+                    self.sock.sendall(data)
+                return
+            except OSError:
+                self._disconnect()
+                self.retry_at = time.monotonic() + RECONNECT_BASE
+        if data:
+            self._spool(data)
+
+    def _run(self):
+        batch = []
+        size = 0
+        deadline = None
+        # Whether the queue filled up while the batch was collected
+        backlogged = False
+        while True:
+            waits = []
+            if deadline is not None:
+                waits.append(deadline - time.monotonic())
+            if self.sock is None and self._spooled():
+                waits.append(self.retry_at - time.monotonic())
+            backlogged = backlogged or self.queue.full()
+            try:
+                message = self.queue.get(timeout=max(min(waits), 0) if waits else None)
+            except queue.Empty:
+                message = None
+            if message is not None and message is not self.STOP:
+                batch.append(message)
+                size += len(message)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+                if size < self.batch_bytes:
+                    continue
+            if backlogged and message is not self.STOP:
+                # The collector can't keep up, spool the batch to keep the queue moving. It is
+                # still sent ahead of everything queued after it
+                self._spool(b''.join(batch))
+            else:
+                self._send(b''.join(batch))
+            batch, size, deadline, backlogged = [], 0, None, False
+            if message is self.STOP:
+                return
 
     def send(self, data):
-        try:
-            self.sock.sendall(bytes(data, encoding="utf-8"))
-        except Exception as e:
-            print(e)
+        # Spooling here would put the message ahead of those still queued. Waiting is brief, the
+        # background thread spools what it takes off a full queue instead of sending it
+        self.queue.put(data)
+
+    def close(self):
+        """Send whatever is queued and stop the background thread"""
+
+        self.queue.put(self.STOP)
+        self.thread.join()
+        self._disconnect()
+        if self._spooled():
+            print('Findings not sent to {}:{} are spooled in {}, they will be sent on the next run'.format(
+                self.host, self.port, self.spool_path))
 
     def log_notification(self, log_data, scope, detect_type, severity):
-        message = json.dumps({
-            'localtime': datetime.now().strftime('%Y-%m-%d %H:%M:%S,%f'),
-            'level': 'NOTIFY',
-            'source': 'GitHub Watchman',
-            'scope': scope,
-            'severity': severity,
-            'detection_type': detect_type,
-            'detection_data': log_data
-        }) + '\n'
-        self.send(message)
+        self.send(self.notification(log_data, scope, detect_type, severity))
 
     def log_info(self, log_data):
-        message = json.dumps({
-            'localtime': datetime.now().strftime('%Y-%m-%d %H:%M:%S,%f'),
-            'level': 'INFO',
-            'source': 'GitHub Watchman',
-            'message': log_data
-        }) + '\n'
-        self.send(message)
+        self.send(self.message('INFO', log_data))
 
     def log_critical(self, log_data):
-        message = json.dumps({
-            'localtime': datetime.now().strftime('%Y-%m-%d %H:%M:%S,%f'),
-            'level': 'CRITICAL',
-            'source': 'GitHub Watchman',
-            'message': log_data
-        }) + '\n'
-        self.send(message)
+        self.send(self.message('CRITICAL', log_data))
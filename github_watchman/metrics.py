@@ -0,0 +1,219 @@
+import json
+import threading
+from urllib.parse import urlparse
+
+# Upper bounds, in seconds, of the buckets request latencies are counted in
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    """A count that only goes up, for each combination of label values"""
+
+    kind = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name) for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.values.get(tuple(labels.get(name) for name in self.labels), 0)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for key, value in sorted(self.values.items(), key=lambda item: str(item[0])):
+                lines.append('{}_total{} {}'.format(self.name, _labels(self.labels, key), _number(value)))
+        return lines
+
+    def summary(self):
+        with self.lock:
+            return {','.join(str(value) for value in key) or 'total': value for key, value in self.values.items()}
+
+
+class Histogram(object):
+    """Counts of observations in cumulative buckets, with their sum, for each combination of
+        label values"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # Label values to [count in each bucket, sum]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, amount, **labels):
+        key = tuple(labels.get(name) for name in self.labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0]
+            for index, bound in enumerate(self.buckets):
+                if amount <= bound:
+                    entry[0][index] += 1
+            entry[1] += amount
+
+    def count(self, **labels):
+        entry = self.values.get(tuple(labels.get(name) for name in self.labels))
+        return entry[0][-1] if entry else 0
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items(), key=lambda item: str(item[0])):
+                for bound, count in zip(self.buckets, counts):
+                    lines.append('{}_bucket{} {}'.format(self.name, _labels(self.labels, key, [('le', _number(bound))]),
+                                                         count))
+                lines.append('{}_count{} {}'.format(self.name, _labels(self.labels, key), counts[-1]))
+                lines.append('{}_sum{} {}'.format(self.name, _labels(self.labels, key), _number(total)))
+        return lines
+
+    def summary(self):
+        with self.lock:
+            return {','.join(str(value) for value in key) or 'total': {
+                'count': counts[-1],
+                'sum': total,
+                'mean': total / counts[-1] if counts[-1] else 0
+            } for key, (counts, total) in self.values.items()}
+
+
+class Registry(object):
+    """The metrics of a scan, rendered in the OpenMetrics text format or as a JSON summary"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, description, labels=()):
+        metric = Counter(name, description, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, description, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            lines.append('# HELP {} {}'.format(metric.name, metric.description))
+            lines.extend(metric.render())
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        return {metric.name: metric.summary() for metric in self.metrics}
+
+    def write_summary(self, path):
+        with open(path, 'w') as summary_file:
+            json.dump(self.summary(), summary_file, indent=2, sort_keys=True)
+
+
+REGISTRY = Registry()
+REQUEST_SECONDS = REGISTRY.histogram('github_watchman_request_seconds', 'Time taken by GitHub API requests',
+                                     ['endpoint'])
+RESPONSES = REGISTRY.counter('github_watchman_responses', 'GitHub API responses by status code',
+                             ['endpoint', 'status'])
+SLEEP_SECONDS = REGISTRY.counter('github_watchman_sleep_seconds',
+                                 'Time spent waiting on rate limits and backing off before retries', ['reason'])
+PAGES = REGISTRY.counter('github_watchman_pages', 'Search result pages fetched', ['endpoint'])
+TIMEFRAME_FILTERED = REGISTRY.counter('github_watchman_timeframe_filtered',
+                                      'Search results dropped for being outside the timeframe', ['scope'])
+REGEX_EVALUATIONS = REGISTRY.counter('github_watchman_regex_evaluations',
+                                     'Fragments matched against each rule\'s pattern', ['rule'])
+REGEX_SECONDS = REGISTRY.counter('github_watchman_regex_seconds',
+                                 'Time spent matching fragments against each rule\'s pattern', ['rule'])
+DEDUP_DROPS = REGISTRY.counter('github_watchman_dedup_drops', 'Findings dropped as duplicates', ['scope'])
+FINDINGS = REGISTRY.counter('github_watchman_findings', 'Findings output for each rule and scope',
+                            ['rule', 'scope'])
+SCHEDULED_RUNS = REGISTRY.counter('github_watchman_scheduled_runs',
+                                  'Runs of a rule and scope by the daemon, started or skipped because the last '
+                                  'run was still going', ['outcome'])
+
+
+def endpoint(url):
+    """The API endpoint of a request URL, without ids or names so requests can be grouped"""
+
+    parts = [part for part in urlparse(url).path.split('/') if part]
+    if parts[:2] == ['api', 'v3']:
+        parts = parts[2:]
+    elif parts[:1] == ['api']:
+        parts = parts[1:]
+    if parts[:1] == ['search']:
+        return '/'.join(parts[:2])
+    return parts[0] if parts else ''
+
+
+class MetricsServer(object):
+    """Serves the metrics of a running scan at http://host:port/metrics for Prometheus to scrape"""
+
+    def __init__(self, port, host='127.0.0.1', registry=REGISTRY):
+        # Only imported when metrics are served
+        from http.server import HTTPServer
+        from socketserver import ThreadingMixIn
+
+        # http.server.ThreadingHTTPServer only exists from Python 3.7
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.registry = registry
+        self.server = Server((host, port), self._handler())
+        self.port = self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever, name='MetricsServer', daemon=True)
+        self.thread.start()
+
+    def _handler(self):
+        from http.server import BaseHTTPRequestHandler
+
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if urlparse(self.path).path != '/metrics':
+                    self.send_error(404)
+                    return
+                payload = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        return Handler
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
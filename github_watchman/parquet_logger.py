@@ -0,0 +1,216 @@
+import os
+import re
+import threading
+import time
+from datetime import datetime, timezone
+
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:
+    pyarrow = None
+    parquet = None
+
+# ISO 8601 date and time as given by GitHub and git, with optional fractions of a second and a Z
+# or an offset with or without a colon
+ISO_DATE = re.compile(r'^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(?:\.(\d+))?(?:Z|([+-]\d{2}):?(\d{2}))$')
+# Findings for a rule and scope are buffered until there are this many, then written as one
+# row group
+ROW_GROUP_SIZE = 10000
+# Directory findings are written to when no path is configured
+FINDINGS_DIRECTORY = 'github_watchman_findings'
+# Fields of findings that are not strings, every other field is stored as a string
+FIELD_TYPES = {
+    'repository_id': 'int64',
+    'committer_id': 'int64',
+    'issue_id': 'int64',
+    'user_id': 'int64',
+    'owner_id': 'int64',
+    'commit_date': 'timestamp',
+    'updated_at': 'timestamp',
+    'matches': 'matches'
+}
+FIELDS = {
+    'code': [
+        'file_name',
+        'file_url',
+        'sha',
+        'repository_id',
+        'repository_node_id',
+        'repository_name',
+        'repository_url',
+        'matches'
+    ],
+    'commits': [
+        'commit_url',
+        'sha',
+        'comments_url',
+        'committer_name',
+        'committer_id',
+        'committer_email',
+        'committer_login',
+        'commit_date',
+        'message',
+        'repository_id',
+        'repository_node_id',
+        'repository_name',
+        'repository_url',
+        'matches'
+    ],
+    'issues': [
+        'issue_id',
+        'issue_title',
+        'issue_body',
+        'issue_url',
+        'sha',
+        'user_login',
+        'user_id',
+        'state',
+        'updated_at',
+        'repository_url',
+        'matches'
+    ],
+    'repositories': [
+        'repository_id',
+        'repository_name',
+        'repository_description',
+        'repository_url',
+        'updated_at',
+        'owner_login',
+        'owner_id',
+        'issue_url',
+        'matches'
+    ]
+}
+
+
+def _arrow_type(field):
+    field_type = FIELD_TYPES.get(field)
+    if field_type == 'int64':
+        return pyarrow.int64()
+    if field_type == 'timestamp':
+        return pyarrow.timestamp('ms', tz='UTC')
+    if field_type == 'matches':
+        return pyarrow.list_(pyarrow.struct([
+            ('object_url', pyarrow.string()),
+            ('object_type', pyarrow.string()),
+            ('fragment', pyarrow.string())
+        ]))
+    return pyarrow.string()
+
+
+def schema(scope):
+    """Arrow schema of findings for a scope. Every finding also records when it was found and
+        the rule's name and severity. The scope and rule are the partitions findings are written to"""
+
+    return pyarrow.schema([
+        ('found_at', pyarrow.timestamp('ms', tz='UTC')),
+        ('detection_type', pyarrow.string()),
+        ('severity', pyarrow.int64())
+    ] + [(field, _arrow_type(field)) for field in FIELDS.get(scope)])
+
+
+def _timestamp(value):
+    """GitHub and git dates are ISO 8601, with a Z or an offset. Parsed with strptime, as
+        datetime.fromisoformat needs Python 3.7 and %z only accepts a colon from 3.7"""
+
+    if not value:
+        return None
+    match = ISO_DATE.match(value)
+    if match is None:
+        raise ValueError('Invalid date: {}'.format(value))
+    date, fraction, hours, minutes = match.groups()
+    parsed = datetime.strptime('{}{}{}'.format(date, hours or '+00', minutes or '00'), '%Y-%m-%dT%H:%M:%S%z')
+    if fraction:
+        parsed = parsed.replace(microsecond=int(fraction[:6].ljust(6, '0')))
+    return parsed.astimezone(timezone.utc)
+
+
+def _int(value):
+    return None if value is None or value == '' else int(value)
+
+
+def _row(finding, detect_type, severity, found_at):
+    row = {
+        'found_at': found_at,
+        'detection_type': detect_type,
+        'severity': _int(severity)
+    }
+    for key, value in finding.items():
+        if isinstance(value, dict):
+            row.update(value)
+        else:
+            row[key] = value
+    for field, field_type in FIELD_TYPES.items():
+        if field in row:
+            if field_type == 'int64':
+                row[field] = _int(row.get(field))
+            elif field_type == 'timestamp':
+                row[field] = _timestamp(row.get(field))
+    return row
+
+
+class ParquetLogger(object):
+    """Writes findings as Parquet files partitioned by scope and rule, for loading into a warehouse
+        or querying with Arrow, DuckDB, Spark and the like.
+
+        Each run writes one file per rule and scope to <path>/scope=<scope>/rule=<rule>/. Findings
+        are buffered ROW_GROUP_SIZE at a time and written as typed row groups, the file is closed
+        once the search for the rule and scope has completed. Install with
+        `pip install github-watchman[parquet]`"""
+
+    def __init__(self, out_path=None, row_group_size=ROW_GROUP_SIZE):
+        if pyarrow is None:
+            raise ImportError('pyarrow is required for Parquet output: pip install github-watchman[parquet]')
+        self.base_out_path = out_path or os.path.join(os.getcwd(), FINDINGS_DIRECTORY)
+        self.row_group_size = row_group_size
+        # Identifies this run's files within a partition
+        self.run_id = '{}-{}'.format(time.strftime('%Y%m%dT%H%M%S', time.gmtime()), os.getpid())
+        # (filename, scope) to [path, parquet.ParquetWriter or None, buffered rows]
+        self.writers = {}
+        self.lock = threading.Lock()
+
+    def _write_row_group(self, scope, entry):
+        path, writer, rows = entry
+        if not rows:
+            return
+        if writer is None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            writer = entry[1] = parquet.ParquetWriter(path, schema(scope), compression='zstd')
+        writer.write_batch(pyarrow.RecordBatch.from_pylist(rows, schema=schema(scope)))
+        entry[2] = []
+
+    def write_row(self, filename, scope, finding, detect_type=None, severity=None):
+        """Buffer a finding, writing a row group once ROW_GROUP_SIZE are buffered for the rule and scope"""
+
+        row = _row(finding, detect_type, severity, datetime.now(timezone.utc))
+        with self.lock:
+            entry = self.writers.get((filename, scope))
+            if entry is None:
+                path = os.path.join(self.base_out_path, 'scope={}'.format(scope), 'rule={}'.format(filename),
+                                    '{}.parquet'.format(self.run_id))
+                # A daemon completes the same rule and scope on every run, later files are numbered
+                number = 1
+                while os.path.exists(path):
+                    number += 1
+                    path = os.path.join(os.path.dirname(path), '{}-{}.parquet'.format(self.run_id, number))
+                entry = self.writers[(filename, scope)] = [path, None, []]
+            entry[2].append(row)
+            if len(entry[2]) >= self.row_group_size:
+                self._write_row_group(scope, entry)
+
+    def complete(self, filename, scope):
+        """Write what is buffered for the rule and scope and close its file. Returns the path of
+            the file, or None if nothing was found"""
+
+        with self.lock:
+            entry = self.writers.pop((filename, scope), None)
+            if entry is None:
+                return None
+            self._write_row_group(scope, entry)
+        entry[1].close()
+        return entry[0]
+
+    def close(self):
+        for filename, scope in list(self.writers):
+            self.complete(filename, scope)
@@ -0,0 +1,140 @@
+import re
+
+# GitHub rejects search queries longer than this, not counting operators or qualifiers
+MAX_QUERY_LENGTH = 256
+# Most AND, OR and NOT operators GitHub accepts in one search query
+MAX_OPERATORS = 5
+# A quoted phrase, or a run of anything but whitespace
+TOKEN = re.compile(r'"[^"]*"|\S+')
+# Qualifiers like in:file, extension:json or pushed:>2020-01-01T00:00:00Z
+QUALIFIER = re.compile(r'^-?[a-z][a-z_-]*:[^"\s]+$', re.IGNORECASE)
+OPERATORS = {'AND', 'OR', 'NOT'}
+
+
+class PlannedQuery(object):
+    """A search query for a scope, made up of the search strings of one or more rules. Results of
+        a query for more than one rule are routed to every rule whose pattern matches them.
+
+        The rules matches() finds for a result are kept until matching_rules() is asked about
+        the same fragments, so each pattern runs once for a result that is filtered then routed"""
+
+    __slots__ = ('scope', 'query', 'rules', 'matched')
+
+    def __init__(self, scope, query, rules):
+        self.scope = scope
+        self.query = query
+        self.rules = rules
+        # Fragments of results matches() found rules for, to those rules
+        self.matched = {}
+
+    def __repr__(self):
+        return 'PlannedQuery({!r}, {!r}, {!r})'.format(self.scope, self.query, self.rules)
+
+    def _match(self, text_matches, sha, match_cache):
+        if sha is not None and match_cache is not None:
+            return [rule for rule in self.rules if match_cache.matches(rule, sha, text_matches)]
+        return [rule for rule in self.rules if rule.matches(text_matches)]
+
+    def matching_rules(self, text_matches, sha=None, match_cache=None):
+        """The rules matching any fragment of a search result's text_matches. For code results,
+            pass the blob sha and match_cache to use and store cached verdicts"""
+
+        rules = self.matched.pop(_fragments(text_matches), None)
+        if rules is not None:
+            return rules
+        return self._match(text_matches, sha, match_cache)
+
+    def matches(self, text_matches, sha=None, match_cache=None):
+        """Whether any rule matches a search result, keeping the rules that do for matching_rules()"""
+
+        rules = self._match(text_matches, sha, match_cache)
+        if rules:
+            self.matched[_fragments(text_matches)] = rules
+        return bool(rules)
+
+
+def _fragments(text_matches):
+    return tuple(match.get('fragment') for match in text_matches or [])
+
+
+def parse(query):
+    """Split a search string into its search term and its qualifiers, normalising the case of
+        the term and whitespace, which GitHub search ignores. Returns None for strings that can't be combined
+        with others: those using operators or with more than one term, which are ANDed together"""
+
+    terms = []
+    qualifiers = []
+    for token in TOKEN.findall(query):
+        if token in OPERATORS:
+            return None
+        if QUALIFIER.match(token):
+            qualifiers.append(token)
+        else:
+            terms.append(token.lower())
+    if len(terms) != 1:
+        return None
+    return terms[0], tuple(qualifiers)
+
+
+def _normalised(query):
+    return ' '.join(token.lower() for token in TOKEN.findall(query))
+
+
+def plan(items):
+    """Plan the search queries for (rule, scope, query) items.
+
+        Search strings are normalised, and the same string searched for by several rules becomes
+        one query for all of them. Single term strings with the same qualifiers in a scope are
+        then combined with OR, up to GitHub's limits on query length and operators. Returns a
+        list of PlannedQuery in the order their first string was given"""
+
+    planned = []
+    # (scope, sorted qualifiers) to the term -> rules of strings that can be combined
+    combinable = {}
+    # Qualifiers of each key, in the order they were first given
+    qualifier_order = {}
+    # (scope, normalised string) to rules of strings that have to be searched for on their own
+    alone = {}
+    for rule, scope, query in items:
+        parsed = parse(query)
+        if parsed is None:
+            key = (scope, _normalised(query))
+            if key not in alone:
+                alone[key] = []
+                planned.append((key, query))
+            if rule not in alone[key]:
+                alone[key].append(rule)
+            continue
+        term, qualifiers = parsed
+        key = (scope, tuple(sorted(qualifiers)))
+        if key not in combinable:
+            combinable[key] = {}
+            qualifier_order[key] = qualifiers
+            planned.append((key, None))
+        rules = combinable[key].setdefault(term, [])
+        if rule not in rules:
+            rules.append(rule)
+
+    queries = []
+    for key, query in planned:
+        scope = key[0]
+        if query is not None:
+            queries.append(PlannedQuery(scope, query, alone.get(key)))
+            continue
+        suffix = ''.join(' ' + qualifier for qualifier in qualifier_order.get(key))
+        terms = []
+        for term, rules in combinable.get(key).items():
+            if terms and (len(terms) > MAX_OPERATORS or
+                          len(' '.join(t for t, _ in terms)) + 1 + len(term) > MAX_QUERY_LENGTH):
+                queries.append(_combined(scope, terms, suffix))
+                terms = []
+            terms.append((term, rules))
+        queries.append(_combined(scope, terms, suffix))
+    return queries
+
+
+def _combined(scope, terms, suffix):
+    rules = []
+    for _, term_rules in terms:
+        rules.extend(rule for rule in term_rules if rule not in rules)
+    return PlannedQuery(scope, ' OR '.join(term for term, _ in terms) + suffix, rules)
@@ -0,0 +1,256 @@
+import random
+import threading
+import time
+
+import github_watchman.metrics as metrics
+
+# GitHub's documented limits for authenticated requests
+SEARCH_LIMIT = 30
+SEARCH_PERIOD = 60
+CORE_LIMIT = 5000
+CORE_PERIOD = 3600
+GRAPHQL_LIMIT = 5000
+GRAPHQL_PERIOD = 3600
+# Retries for a single request before giving up
+MAX_RETRIES = 5
+# Exponential backoff starts at this many seconds and is capped at BACKOFF_CAP
+BACKOFF_BASE = 2
+BACKOFF_CAP = 120
+# Once less than this share of the quota is left, the rest is spread out until the reset
+PACING_THRESHOLD = 0.1
+RETRY_STATUS_CODES = (403, 429, 500, 502, 503, 504)
+
+
+class TokenBucket(object):
+    """Token bucket holding up to `capacity` tokens, refilled evenly over `period` seconds"""
+
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """Take a token if one is available. Returns 0 if it was taken, otherwise how many
+            seconds until one will be"""
+
+        with self.lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def release(self):
+        """Give back a token taken by reserve()"""
+
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+
+class RateLimitBudget(object):
+    """Tracks the request quota GitHub reports in the X-RateLimit-* headers of every response.
+
+        Requests are let through freely while plenty of quota is left. Below the pacing
+        threshold the remaining requests are spread evenly until the window resets, so the
+        quota runs out at the reset rather than ending in a 403"""
+
+    def __init__(self, pacing_threshold=PACING_THRESHOLD):
+        self.pacing_threshold = pacing_threshold
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+        self.blocked_until = 0
+        self.next_request = 0
+        self.lock = threading.Lock()
+
+    def update(self, headers):
+        if headers.get('X-RateLimit-Remaining') is None or headers.get('X-RateLimit-Reset') is None:
+            return
+        remaining = int(headers.get('X-RateLimit-Remaining'))
+        reset = int(headers.get('X-RateLimit-Reset'))
+        with self.lock:
+            if headers.get('X-RateLimit-Limit') is not None:
+                self.limit = int(headers.get('X-RateLimit-Limit'))
+            # Responses from concurrent requests can arrive out of order, so within
+            # the same window the lowest remaining count is the accurate one
+            if self.reset is None or reset > self.reset:
+                self.reset, self.remaining = reset, remaining
+            elif reset == self.reset:
+                self.remaining = min(self.remaining, remaining)
+
+    def block(self, seconds):
+        """Hold back every request for this resource, used when GitHub asks us to back off"""
+
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.time() + seconds)
+
+    def _wait(self, now):
+        if self.blocked_until > now:
+            return self.blocked_until - now
+        if self.remaining is None or self.reset <= now:
+            return 0
+        if self.remaining <= 0:
+            return self.reset - now + 1
+        if self.limit and self.remaining < self.limit * self.pacing_threshold:
+            return max(self.next_request - now, 0)
+        return 0
+
+    def wait_time(self):
+        with self.lock:
+            return self._wait(time.time())
+
+    def reserve(self):
+        """Take one request from the budget. Returns 0 if it was taken, otherwise how many
+            seconds to wait"""
+
+        with self.lock:
+            now = time.time()
+            wait = self._wait(now)
+            if wait:
+                return max(wait, 0.1)
+            if self.remaining is not None and self.reset > now:
+                self.remaining -= 1
+                self.next_request = now + (self.reset - now) / max(self.remaining, 1)
+            return 0
+
+    def release(self):
+        """Give back a request taken by reserve()"""
+
+        with self.lock:
+            if self.remaining is not None:
+                self.remaining += 1
+
+
+class RateLimiter(object):
+    """Central governor for requests to the GitHub API, shared by every worker and by both the
+        threaded and asyncio clients.
+
+        The search, core and GraphQL APIs have separate limits. Each is paced by a token bucket and by
+        the quota GitHub reports back on every response. Failed requests are retried with
+        jittered exponential backoff, up to max_retries per request"""
+
+    def __init__(self, search_limit=SEARCH_LIMIT, core_limit=CORE_LIMIT, max_retries=MAX_RETRIES,
+                 backoff_base=BACKOFF_BASE, backoff_cap=BACKOFF_CAP, graphql_limit=GRAPHQL_LIMIT):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.buckets = {
+            'search': TokenBucket(search_limit, SEARCH_PERIOD),
+            'core': TokenBucket(core_limit, CORE_PERIOD),
+            'graphql': TokenBucket(graphql_limit, GRAPHQL_PERIOD)
+        }
+        self.budgets = {
+            'search': RateLimitBudget(),
+            'core': RateLimitBudget(),
+            'graphql': RateLimitBudget()
+        }
+
+    @staticmethod
+    def resource(url):
+        """Work out which rate limit a request URL counts against"""
+
+        if '/search/' in url:
+            return 'search'
+        if url.endswith('/graphql'):
+            return 'graphql'
+        return 'core'
+
+    def reserve(self, resource):
+        """Reserve a request against both limits. Returns 0 if it was reserved, otherwise how
+            many seconds to wait before trying again"""
+
+        wait = self.budgets[resource].reserve()
+        if wait:
+            return wait
+        wait = self.buckets[resource].reserve()
+        if wait:
+            self.budgets[resource].release()
+        return wait
+
+    def acquire(self, resource):
+        wait = self.reserve(resource)
+        while wait:
+            metrics.SLEEP_SECONDS.inc(wait, reason='rate_limit')
+            time.sleep(wait)
+            wait = self.reserve(resource)
+
+    async def acquire_async(self, resource):
+        # Imported here so the threaded client doesn't pay for importing asyncio at startup
+        import asyncio
+
+        wait = self.reserve(resource)
+        while wait:
+            metrics.SLEEP_SECONDS.inc(wait, reason='rate_limit')
+            await asyncio.sleep(wait)
+            wait = self.reserve(resource)
+
+    def update(self, resource, headers):
+        # GitHub names the limit a response counted against, trust that over the URL
+        if headers.get('X-RateLimit-Resource') in self.budgets:
+            resource = headers.get('X-RateLimit-Resource')
+        self.budgets[resource].update(headers)
+
+    def backoff(self, attempt):
+        """Jittered exponential backoff for the given retry attempt"""
+
+        delay = min(self.backoff_cap, self.backoff_base * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    def retry_delay(self, resource, attempt, status_code=None, headers=None, message=''):
+        """How long to wait before retrying a failed request, or None if it should not be retried.
+            A status code of None means the request failed to connect, message is the body of
+            the error response"""
+
+        if attempt >= self.max_retries:
+            return None
+        if status_code is not None and status_code not in RETRY_STATUS_CODES:
+            return None
+        headers = headers or {}
+        delay = self.backoff(attempt)
+        if headers.get('Retry-After'):
+            # Abuse or secondary rate limit, nothing for this resource should go out until it passes
+            delay = max(delay, int(headers.get('Retry-After')))
+            self.budgets[resource].block(delay)
+        elif status_code == 403 and headers.get('X-RateLimit-Remaining') != '0':
+            # A 403 that isn't about rate limits is a permissions error
+            if 'rate limit' not in message.lower():
+                return None
+        elif status_code == 403:
+            # The budget has seen the empty quota and holds the retry until the reset
+            delay = 0
+        return delay
+
+    def state(self):
+        """Snapshot of the governor for each resource: quota left, when it resets and how long
+            a request made now would have to wait"""
+
+        state = {}
+        for resource, budget in self.budgets.items():
+            with budget.lock:
+                state[resource] = {
+                    'limit': budget.limit,
+                    'remaining': budget.remaining,
+                    'reset': budget.reset,
+                    'wait': budget._wait(time.time())
+                }
+        return state
+
+    def wait_time(self, resource):
+        return self.budgets[resource].wait_time()
+
+
+def retry_message(status_code, headers):
+    if status_code is None:
+        return 'Connection failed - retrying'
+    if headers.get('Retry-After'):
+        return 'GitHub API abuse limit hit - retrying in {} seconds'.format(headers.get('Retry-After'))
+    if status_code == 403:
+        return 'GitHub API rate limit reached - cooling off'
+    return 'Retrying...'
@@ -0,0 +1,343 @@
+import hashlib
+import os
+import pickle
+import re
+import threading
+import time
+
+import github_watchman.metrics as metrics
+
+try:
+    import regex
+except ImportError:
+    regex = None
+try:
+    import re2
+except ImportError:
+    re2 = None
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
+# Longest a pattern may spend matching one fragment. Only enforced when the regex module is
+# installed, install with `pip install github-watchman[regex]`
+MATCH_TIMEOUT = 1.0
+# Inline flags at the start of a pattern, these must be scoped to the pattern when it is
+# combined with others
+GLOBAL_FLAGS = re.compile(r'^\(\?([aiLmsux]+)\)')
+# File the definitions of loaded rules are packed into in the cache directory, one for each
+# directory of rules
+RULE_PACK = 'rules-{}.pack'
+# Changed whenever what is stored in the rule pack changes, so older packs are rebuilt
+RULE_PACK_VERSION = 1
+# Type of patterns compiled by re, re.Pattern is only public from Python 3.7
+RE_PATTERN = type(re.compile(''))
+
+
+class Rule(object):
+    """A detection rule with its pattern compiled once at load time"""
+
+    __slots__ = ('filename', 'enabled', 'meta', 'name', 'severity', 'scope', 'test_cases', 'strings', 'pattern',
+                 'pattern_id', 'regex', 'interval', 'timeouts')
+
+    def __init__(self, definition):
+        self.filename = definition.get('filename')
+        self.enabled = definition.get('enabled')
+        self.meta = definition.get('meta') or {}
+        self.name = self.meta.get('name')
+        self.severity = self.meta.get('severity')
+        self.scope = definition.get('scope') or []
+        self.test_cases = definition.get('test_cases') or {}
+        self.strings = definition.get('strings') or []
+        self.pattern = definition.get('pattern') or ''
+        # Identifies this version of the pattern, so results cached for an older one can be told apart
+        self.pattern_id = hashlib.sha1(self.pattern.encode('utf-8')).hexdigest()[:16]
+        self.regex = compile_pattern(self.pattern)
+        # How often the daemon runs the rule, None for its default interval
+        self.interval = definition.get('interval')
+        # Fragments given up on because matching them ran past MATCH_TIMEOUT
+        self.timeouts = 0
+
+    def __repr__(self):
+        return 'Rule({!r})'.format(self.filename)
+
+    def search(self, fragment):
+        started = time.perf_counter()
+        try:
+            return self.regex.search(fragment, **_budget(self.regex)) is not None
+        except TimeoutError:
+            self.timeouts += 1
+            return False
+        finally:
+            metrics.REGEX_EVALUATIONS.inc(rule=self.filename)
+            metrics.REGEX_SECONDS.inc(time.perf_counter() - started, rule=self.filename)
+
+    def finditer(self, text):
+        """Generator over the matches of the pattern in text, stopping if it runs past MATCH_TIMEOUT"""
+
+        try:
+            yield from self.regex.finditer(text, **_budget(self.regex))
+        except TimeoutError:
+            self.timeouts += 1
+
+    def matches(self, text_matches):
+        """Check whether the pattern matches any of the fragments of a search result's text_matches"""
+
+        return any(self.search(match.get('fragment') or '') for match in text_matches or [])
+
+
+def compile_pattern(pattern):
+    """Compile with the regex module when it is installed, so matching can be given a time budget.
+        Patterns it can't compile fall back to re, which raises re.error if they are invalid"""
+
+    if regex is not None:
+        try:
+            return regex.compile(pattern, regex.V0)
+        except regex.error:
+            pass
+    return re.compile(pattern)
+
+
+def _budget(compiled):
+    return {} if isinstance(compiled, RE_PATTERN) else {'timeout': MATCH_TIMEOUT}
+
+
+def _scoped(pattern):
+    flags = GLOBAL_FLAGS.match(pattern)
+    if flags:
+        return '(?{}:{})'.format(flags.group(1), pattern[flags.end():])
+    return '(?:{})'.format(pattern)
+
+
+class Re2Matcher(object):
+    """Finds every pattern matching a fragment in one linear time pass, with a google-re2 Set.
+        Rules using syntax RE2 doesn't support, like lookarounds and backreferences, are left
+        in fallback. Install with `pip install github-watchman[re2]`"""
+
+    def __init__(self, rules):
+        if re2 is None:
+            raise ImportError('google-re2 is required for the re2 matcher: pip install github-watchman[re2]')
+        options = re2.Options()
+        options.log_errors = False
+        self.rules = []
+        self.fallback = []
+        self.set = re2.Set.SearchSet(options)
+        for rule in rules:
+            try:
+                re2.compile(rule.pattern, options=options)
+            except re2.error:
+                self.fallback.append(rule)
+                continue
+            self.set.Add(rule.pattern)
+            self.rules.append(rule)
+        if self.rules:
+            self.set.Compile()
+
+    def matching(self, fragment):
+        if not self.rules:
+            return []
+        # Match gives None rather than an empty list when nothing matched
+        return [self.rules[index] for index in self.set.Match(fragment) or []]
+
+
+class HyperscanMatcher(object):
+    """Finds every pattern matching a fragment in one linear time pass, with a Hyperscan database.
+        Rules using syntax Hyperscan doesn't support, like lookarounds and backreferences, are
+        left in fallback. Install with `pip install github-watchman[hyperscan]`"""
+
+    def __init__(self, rules):
+        if hyperscan is None:
+            raise ImportError('hyperscan is required for the hyperscan matcher: pip install github-watchman[hyperscan]')
+        self.rules = []
+        self.fallback = []
+        for rule in rules:
+            try:
+                self._compile([rule])
+            except hyperscan.error:
+                self.fallback.append(rule)
+                continue
+            self.rules.append(rule)
+        self.database = self._compile(self.rules) if self.rules else None
+        # Scans share the database's scratch space, which only one scan can use at a time
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _compile(rules):
+        # Only whether a rule matches is needed, not where, and \w, \d etc. match Unicode like re
+        flags = hyperscan.HS_FLAG_SINGLEMATCH | hyperscan.HS_FLAG_UTF8 | hyperscan.HS_FLAG_UCP
+        database = hyperscan.Database()
+        database.compile(expressions=[rule.pattern.encode('utf-8') for rule in rules], ids=list(range(len(rules))),
+                         elements=len(rules), flags=[flags] * len(rules))
+        return database
+
+    def matching(self, fragment):
+        if self.database is None:
+            return []
+        hits = []
+        with self.lock:
+            self.database.scan(fragment.encode('utf-8', 'replace'),
+                               match_event_handler=lambda index, start, end, flags, context: hits.append(index))
+        return [self.rules[index] for index in hits]
+
+
+MATCHERS = {
+    're2': Re2Matcher,
+    'hyperscan': HyperscanMatcher
+}
+
+
+class RuleEngine(object):
+    """Matches fragments against every enabled rule at once.
+
+        With the default re matcher, the patterns of all rules are combined into one alternation
+        that rejects fragments no rule matches in a single pass. Rules found by that pass are hits,
+        the remaining rules only need checking on their own when the fragment matched something.
+
+        The re2 and hyperscan matchers report every rule that matches in one pass. Rules they
+        can't compile are checked on their own with re"""
+
+    def __init__(self, rules, matcher='re'):
+        self.rules = list(rules)
+        self.combined = None
+        self.matcher = None
+        # Patterns that match the empty string would win every position of the alternation
+        self.always_checked = [rule for rule in self.rules if rule.regex.fullmatch('') is not None]
+        combined_rules = [rule for rule in self.rules if rule not in self.always_checked]
+        if matcher != 're':
+            self.matcher = MATCHERS[matcher](combined_rules)
+            self.always_checked.extend(self.matcher.fallback)
+            return
+        try:
+            self.combined = compile_pattern('|'.join('(?P<r{}>{})'.format(i, _scoped(rule.pattern))
+                                                     for i, rule in enumerate(combined_rules)))
+            self.group_rules = {'r{}'.format(i): rule for i, rule in enumerate(combined_rules)}
+        except re.error:
+            # Patterns using backreferences or conflicting flags can't be combined
+            self.combined = None
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def matching_rules(self, fragment):
+        """Return the rules whose pattern matches the fragment, in rule order"""
+
+        if self.matcher is not None:
+            hits = set(self.matcher.matching(fragment))
+            hits.update(rule for rule in self.always_checked if rule.search(fragment))
+            return [rule for rule in self.rules if rule in hits]
+
+        if self.combined is None:
+            return [rule for rule in self.rules if rule.search(fragment)]
+
+        try:
+            hits = {self.group_rules.get(match.lastgroup)
+                    for match in self.combined.finditer(fragment, **_budget(self.combined))}
+        except TimeoutError:
+            # Each rule gets its own time budget instead
+            return [rule for rule in self.rules if rule.search(fragment)]
+        hits.update(rule for rule in self.always_checked if rule.search(fragment))
+        if not hits:
+            return []
+        # Matches are non-overlapping, so a rule may have been hidden by another rule's match
+        return [rule for rule in self.rules if rule in hits or rule.search(fragment)]
+
+    def match_item(self, text_matches):
+        """Return the rules matching any fragment of a search result's text_matches"""
+
+        found = set()
+        for match in text_matches or []:
+            found.update(self.matching_rules(match.get('fragment') or ''))
+        return [rule for rule in self.rules if rule in found]
+
+
+def rule_files(path):
+    """The YAML rule files in a directory, in name order, with their (mtime, size) stamps"""
+
+    files = {}
+    for file in sorted(os.scandir(path), key=lambda entry: entry.name):
+        if file.name.endswith('.yaml'):
+            stat = file.stat()
+            files[file.path] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+
+def _read_pack(pack_path):
+    try:
+        with open(pack_path, 'rb') as pack_file:
+            pack = pickle.load(pack_file)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+        return None
+    if not isinstance(pack, dict) or pack.get('version') != RULE_PACK_VERSION:
+        return None
+    return pack
+
+
+def _write_pack(pack_path, pack):
+    os.makedirs(os.path.dirname(pack_path), exist_ok=True)
+    # Written alongside and moved into place, so concurrent runs never read half a pack
+    temporary = '{}.{}'.format(pack_path, os.getpid())
+    with open(temporary, 'wb') as pack_file:
+        pickle.dump(pack, pack_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, pack_path)
+
+
+def _parse_rules(files):
+    """Parse the rule files, returning their sha1 hashes and the definitions of enabled rules"""
+
+    # Only needed when the rule pack is out of date, so left out of startup otherwise
+    import yaml
+
+    hashes = {}
+    definitions = []
+    for file_path in files:
+        with open(file_path, 'rb') as yaml_file:
+            content = yaml_file.read()
+        hashes[file_path] = hashlib.sha1(content).hexdigest()
+        definition = yaml.safe_load(content)
+        if definition.get('enabled'):
+            definitions.append(definition)
+    return hashes, definitions
+
+
+def _hashes(files):
+    hashes = {}
+    for file_path in files:
+        with open(file_path, 'rb') as rule_file:
+            hashes[file_path] = hashlib.sha1(rule_file.read()).hexdigest()
+    return hashes
+
+
+def load_rules(path, cache_path=None):
+    """Load and compile the enabled rules in a directory of YAML rule files.
+
+        When cache_path is given, the parsed definitions are kept in a rule pack there. The pack
+        is used while the rule files have the modification times and sizes it was built from, or
+        the same content if those have changed. Otherwise the files are parsed again and the pack
+        is rebuilt"""
+
+    files = rule_files(path)
+    if cache_path is None:
+        return [Rule(definition) for definition in _parse_rules(files)[1]]
+
+    path_id = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:12]
+    pack_path = os.path.join(cache_path, RULE_PACK.format(path_id))
+    pack = _read_pack(pack_path)
+    if pack is not None and pack.get('stamps') == files:
+        return [Rule(definition) for definition in pack.get('definitions')]
+    if pack is not None and list(pack.get('hashes')) == list(files) and pack.get('hashes') == _hashes(files):
+        # Touched but not changed, only the stamps need updating
+        _write_pack(pack_path, dict(pack, stamps=files))
+        return [Rule(definition) for definition in pack.get('definitions')]
+
+    hashes, definitions = _parse_rules(files)
+    _write_pack(pack_path, {
+        'version': RULE_PACK_VERSION,
+        'stamps': files,
+        'hashes': hashes,
+        'definitions': definitions
+    })
+    return [Rule(definition) for definition in definitions]
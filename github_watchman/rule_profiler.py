@@ -0,0 +1,161 @@
+import argparse
+import json
+import math
+import time
+from pathlib import Path
+
+import github_watchman.rule_engine as rule_engine
+
+RULES_PATH = (Path(__file__).parent / 'rules').resolve()
+# Inputs are doubled in length from the first size up to the last
+SIZES = [16 * 2 ** step for step in range(10)]
+# Each input is matched this many times and the fastest time kept
+REPEATS = 3
+# Times below this are too noisy to tell how a pattern scales
+MIN_TIME = 0.0005
+# Match time is fitted as size ** exponent between successive sizes. Linear patterns come out
+# around 1, anything above this is flagged
+SUPERLINEAR_EXPONENT = 1.5
+# Larger inputs are not tried once one is expected to take longer than this
+PROFILE_BUDGET = 2.0
+# Characters patterns commonly repeat, flooded to make backtracking patterns work hard
+FLOODS = {
+    'word': 'a',
+    'digits': '0',
+    'spaces': ' ',
+    'quotes': '\'"',
+    'symbols': '!@#$&()/-`_.+,',
+    'newlines': '\n'
+}
+
+
+class RuleProfile(object):
+    """How long a rule's pattern took on each adversarial input and on recorded fragments"""
+
+    __slots__ = ('rule', 'timings', 'exponent', 'worst_input', 'fragments', 'fragment_time', 'worst_fragment_time',
+                 'stopped')
+
+    def __init__(self, rule):
+        self.rule = rule
+        # Input name to a list of (size, seconds)
+        self.timings = {}
+        self.exponent = None
+        self.worst_input = None
+        self.fragments = 0
+        self.fragment_time = 0
+        self.worst_fragment_time = 0
+        # Inputs that were not grown to the largest size because they were taking too long
+        self.stopped = []
+
+    @property
+    def superlinear(self):
+        return bool(self.stopped) or (self.exponent is not None and self.exponent > SUPERLINEAR_EXPONENT)
+
+
+def adversarial_inputs(rule):
+    """Seeds for inputs to time the rule's pattern on. Each is repeated to the length being tried.
+        Besides floods of characters patterns often repeat, every test case is used with its last
+        character dropped, so the pattern gets close to matching over and over"""
+
+    seeds = dict(FLOODS)
+    test_cases = rule.test_cases.get('match_cases', []) + rule.test_cases.get('fail_cases', [])
+    for index, test_case in enumerate(case for case in test_cases if case and case != 'blank'):
+        seeds['near_miss_{}'.format(index)] = test_case[:-1] or test_case
+    return seeds
+
+
+def _time(rule, text):
+    best = None
+    for _ in range(REPEATS):
+        started = time.perf_counter()
+        rule.search(text)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _exponent(timings):
+    """The steepest growth between successive sizes that were slow enough to measure"""
+
+    exponents = [math.log(t2 / t1) / math.log(s2 / s1)
+                 for (s1, t1), (s2, t2) in zip(timings, timings[1:]) if t1 >= MIN_TIME and t2 >= MIN_TIME]
+    return max(exponents) if exponents else None
+
+
+def profile_rule(rule, fragments=()):
+    """Time the rule's pattern on growing adversarial inputs, and on each recorded fragment"""
+
+    profile = RuleProfile(rule)
+    for name, seed in adversarial_inputs(rule).items():
+        timings = []
+        for size in SIZES:
+            elapsed = _time(rule, (seed * (size // len(seed) + 1))[:size])
+            timings.append((size, elapsed))
+            exponent = _exponent(timings[-2:])
+            if size != SIZES[-1] and elapsed * 2 ** max(exponent or 1, 1) > PROFILE_BUDGET:
+                profile.stopped.append(name)
+                break
+        profile.timings[name] = timings
+        exponent = _exponent(timings)
+        if exponent is not None and (profile.exponent is None or exponent > profile.exponent):
+            profile.exponent = exponent
+            profile.worst_input = name
+
+    for fragment in fragments:
+        elapsed = _time(rule, fragment)
+        profile.fragments += 1
+        profile.fragment_time += elapsed
+        profile.worst_fragment_time = max(profile.worst_fragment_time, elapsed)
+    return profile
+
+
+def load_fragments(path):
+    """Fragments from a JSON file of strings, search results or a recorded search response"""
+
+    with open(path) as fragments_file:
+        recorded = json.load(fragments_file)
+    if isinstance(recorded, dict):
+        recorded = recorded.get('items', [])
+    fragments = []
+    for item in recorded:
+        if isinstance(item, str):
+            fragments.append(item)
+        else:
+            fragments.extend(match.get('fragment') or '' for match in item.get('text_matches') or [])
+    return fragments
+
+
+def print_profiles(profiles):
+    print('{:<40} {:>9} {:<16} {:>14} {:>14}'.format('rule', 'exponent', 'worst input', 'fragment ms', 'worst frag ms'))
+    for profile in profiles:
+        print('{:<40} {:>9} {:<16} {:>14} {:>14}{}'.format(
+            profile.rule.filename,
+            '-' if profile.exponent is None else '{:.2f}'.format(profile.exponent),
+            ', '.join(profile.stopped) or profile.worst_input or '-',
+            '{:.3f}'.format(profile.fragment_time * 1000 / profile.fragments) if profile.fragments else '-',
+            '{:.3f}'.format(profile.worst_fragment_time * 1000) if profile.fragments else '-',
+            '  SUPER-LINEAR' if profile.superlinear else ''))
+
+
+def main(argv=None):
+    """`github-watchman rules profile`. Returns 1 if any rule was flagged as super-linear"""
+
+    parser = argparse.ArgumentParser(prog='github-watchman rules', description='Work with detection rules')
+    commands = parser.add_subparsers(dest='command')
+    command = commands.add_parser('profile', help='Time each rule\'s pattern on adversarial inputs and recorded '
+                                                  'fragments, and flag those that scale super-linearly')
+    command.add_argument('--fragments', help='JSON file of fragments, search results or a recorded search response '
+                                             'to time each pattern on')
+    command.add_argument('--rules-path', dest='rules_path', default=RULES_PATH,
+                         help='Directory of rules to profile (default: the bundled rules)')
+    args = parser.parse_args(argv)
+    if args.command != 'profile':
+        parser.print_help()
+        return 2
+
+    if rule_engine.regex is None:
+        print('The regex module is not installed, patterns will not be given a time budget during scans')
+    fragments = load_fragments(args.fragments) if args.fragments else []
+    profiles = [profile_rule(rule, fragments) for rule in rule_engine.load_rules(args.rules_path)]
+    print_profiles(profiles)
+    return 1 if any(profile.superlinear for profile in profiles) else 0
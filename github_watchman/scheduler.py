@@ -0,0 +1,270 @@
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from termcolor import colored
+
+import github_watchman.config as cfg
+import github_watchman.github_wrapper as github
+import github_watchman.logger as logger
+import github_watchman.metrics as metrics
+import github_watchman.query_planner as query_planner
+from github_watchman.dedup import Deduplicator
+from github_watchman.state import result_fingerprint
+
+# Findings waiting for the calling thread to output them, workers block when this is full
+MAX_PENDING_FINDINGS = 1000
+# How often to check the rate limiter when no results are arriving
+RATE_LIMIT_REPORT_INTERVAL = 30
+# How often a worker blocked on a full event queue checks whether the scan has stopped
+PUT_TIMEOUT = 0.5
+
+
+class ScanStopped(Exception):
+    """Raised in a worker when the scan it is working for has stopped"""
+
+
+def put_event(events, stopping, event):
+    """Put an event on a bounded queue, giving up with ScanStopped once stopping is set so a
+        worker is never left blocked on a queue nobody is reading"""
+
+    while not stopping.is_set():
+        try:
+            events.put(event, timeout=PUT_TIMEOUT)
+            return
+        except queue.Full:
+            continue
+    raise ScanStopped()
+
+
+def drain(events):
+    while True:
+        try:
+            events.get_nowait()
+        except queue.Empty:
+            return
+
+
+class WorkerPool(object):
+    """Thread pool running the queries of a scan. On a normal exit it waits for them to finish,
+        when the scan is stopped by an exception queries not yet started are cancelled and
+        those running are left to notice and stop"""
+
+    def __init__(self, workers):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.futures = []
+
+    def submit(self, function, *args):
+        self.futures.append(self.executor.submit(function, *args))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.executor.shutdown(wait=True)
+            return
+        for future in self.futures:
+            future.cancel()
+        self.executor.shutdown(wait=False)
+
+
+class ScanGroup(object):
+    """The queries of one rule and scope, and what has been found for them so far"""
+
+    def __init__(self, rule, scope, queries, seen, deduplicator):
+        self.rule = rule
+        self.scope = scope
+        self.queries = queries
+        self.seen = seen
+        self.deduplicator = deduplicator
+        # Planned queries still to finish that include a query of this group
+        self.pending = 0
+        self.started = False
+        self.complete = True
+        self.total = 0
+        self.fingerprints = []
+
+
+class ScanScheduler(object):
+    """Runs every search query of a scan as a work item on a shared worker pool. Findings are
+        streamed back to the calling thread as soon as they pass the filters.
+
+        Unless merge_queries is False, the search strings of every rule are planned into as few
+        queries as possible by query_planner, and results are routed to each rule they match"""
+
+    def __init__(self, github_connection, log_handler, timeframe=cfg.ALL_TIME, workers=4, state=None,
+                 deduplicator=None, merge_queries=True):
+        self.github = github_connection
+        self.log_handler = log_handler
+        self.timeframe = timeframe
+        self.workers = workers
+        self.state = state
+        # When set, findings are deduplicated across rules as well as within each rule
+        self.deduplicator = deduplicator
+        self.merge_queries = merge_queries
+        # Rule timeouts already reported, keyed on rule filename
+        self.timeouts = {}
+
+    def _work(self, events, stopping, planned, groups):
+        """Runs a single query on a worker thread, passing each finding back through events with
+            the group of each rule it is for. Stops early once stopping is set"""
+
+        if stopping.is_set():
+            return
+        try:
+            query_function = github.QUERY_FUNCTIONS.get(planned.scope)
+            if len(groups) == 1:
+                group = groups[0]
+                hits = github.run_query(query_function(self.github, group.rule, planned.query, self.timeframe,
+                                                       group.seen),
+                                        lambda finding: put_event(events, stopping, ('finding', group, finding)))
+            else:
+                hits = github.run_query(query_function(self.github, planned, planned.query, self.timeframe),
+                                        lambda finding: self._route(events, stopping, planned, groups, finding))
+            put_event(events, stopping, ('done', groups, (planned.query, hits)))
+        except ScanStopped:
+            pass
+        except Exception as e:
+            try:
+                put_event(events, stopping, ('error', groups, e))
+            except ScanStopped:
+                pass
+
+    def _route(self, events, stopping, planned, groups, finding):
+        """Pass a finding of a query for several rules to the group of each rule it matches"""
+
+        sha = finding.get('sha') if planned.scope == 'code' else None
+        rules = planned.matching_rules(finding.get('matches'), sha, self.github.match_cache)
+        for group in groups:
+            if group.rule not in rules:
+                continue
+            if group.seen is not None and result_fingerprint(group.scope, finding) in group.seen:
+                continue
+            put_event(events, stopping, ('finding', group, finding))
+
+    def run(self, jobs, output, complete=None, deduplicator=None):
+        """Search for each (rule, scope) pair in jobs. output(rule, scope, finding) is called from
+            this thread for each new finding as it is found, and complete(rule, scope, total) once
+            every query for the pair has finished. A deduplicator given here is shared by the rules
+            of this run in place of the scheduler's own"""
+
+        run_started = int(time.time())
+        shared = deduplicator if deduplicator is not None else self.deduplicator
+        events = queue.Queue(maxsize=MAX_PENDING_FINDINGS)
+        groups = []
+        for rule, scope in jobs:
+            queries = rule.strings
+            seen = None
+            if self.state is not None:
+                queries = [self.state.qualify(rule, scope, query) for query in queries]
+                seen = self.state.seen(rule, scope)
+            groups.append(ScanGroup(rule, scope, queries, seen, shared if shared is not None else Deduplicator()))
+
+        items = [(group.rule, group.scope, query) for group in groups for query in group.queries]
+        if self.merge_queries:
+            planned_queries = query_planner.plan(items)
+        else:
+            planned_queries = [query_planner.PlannedQuery(scope, query, [rule]) for rule, scope, query in items]
+        groups_by_rule = {(group.rule.filename, group.scope): group for group in groups}
+
+        submissions = []
+        for planned in planned_queries:
+            planned_groups = [groups_by_rule.get((rule.filename, planned.scope)) for rule in planned.rules]
+            for group in planned_groups:
+                group.pending += 1
+            submissions.append((planned, planned_groups))
+
+        stopping = threading.Event()
+        with self._start(events, stopping, submissions):
+            try:
+                self._consume(events, groups, len(submissions), run_started, output, complete)
+            except BaseException:
+                # Stop the workers and unblock any waiting on the full queue, so leaving the
+                # pool doesn't wait on them
+                stopping.set()
+                drain(events)
+                raise
+
+    def _consume(self, events, groups, outstanding, run_started, output, complete):
+        """Output findings and complete groups as events arrive, until every query has finished"""
+
+        for group in groups:
+            if not group.pending:
+                self._finish(group, run_started, complete)
+
+        while outstanding:
+            try:
+                event, target, value = events.get(timeout=RATE_LIMIT_REPORT_INTERVAL)
+            except queue.Empty:
+                self._report_rate_limits()
+                continue
+            # Findings are for one group, a query finishing or failing is for every group it searched for
+            event_groups = [target] if event == 'finding' else target
+            for group in event_groups:
+                if not group.started:
+                    group.started = True
+                    logger.print_info(self.log_handler, colored(
+                        'Searching for {} in {}'.format(group.rule.name, group.scope), 'yellow'))
+
+            if event == 'finding':
+                group = target
+                if not group.deduplicator.is_new(group.scope, value):
+                    metrics.DEDUP_DROPS.inc(scope=group.scope)
+                else:
+                    group.total += 1
+                    metrics.FINDINGS.inc(rule=group.rule.filename, scope=group.scope)
+                    if self.state is not None:
+                        group.fingerprints.append(result_fingerprint(group.scope, value))
+                    try:
+                        output(group.rule, group.scope, value)
+                    except Exception as e:
+                        logger.print_critical(self.log_handler, colored(e, 'red'))
+                continue
+
+            outstanding -= 1
+            if event == 'done':
+                github.report_query(self.log_handler, event_groups[0].scope, *value)
+            else:
+                logger.print_critical(self.log_handler, colored(value, 'red'))
+            for group in event_groups:
+                group.pending -= 1
+                if event != 'done':
+                    group.complete = False
+                if not group.pending:
+                    self._finish(group, run_started, complete)
+
+    def _start(self, events, stopping, submissions):
+        """Start running each (planned query, groups) submission, passing what happens back through
+            events until stopping is set. Returns a context manager that waits for the work to
+            finish on a normal exit"""
+
+        pool = WorkerPool(self.workers)
+        for planned, planned_groups in submissions:
+            pool.submit(self._work, events, stopping, planned, planned_groups)
+        return pool
+
+    def _report_rate_limits(self):
+        """Explain a quiet spell when it is caused by waiting on a rate limit"""
+
+        for resource, state in self.github.rate_limiter.state().items():
+            if state.get('wait') > 1:
+                logger.print_info(self.log_handler, colored(
+                    'Waiting {:.0f} seconds for the GitHub {} rate limit, {} requests left'.format(
+                        state.get('wait'), resource, state.get('remaining')), 'yellow'))
+
+    def _finish(self, group, run_started, complete):
+        github.report_total(self.log_handler, group.total)
+        timeouts = group.rule.timeouts - self.timeouts.get(group.rule.filename, 0)
+        if timeouts:
+            self.timeouts[group.rule.filename] = group.rule.timeouts
+            logger.print_critical(self.log_handler, colored(
+                '{} fragments took too long to match {} and were skipped'.format(timeouts, group.rule.name), 'red'))
+        if complete is not None:
+            try:
+                complete(group.rule, group.scope, group.total)
+            except Exception as e:
+                logger.print_critical(self.log_handler, colored(e, 'red'))
+        if self.state is not None:
+            # The watermark only moves once every query for the rule has succeeded
+            self.state.record(group.rule, group.scope, group.fingerprints, run_started if group.complete else None)
@@ -0,0 +1,57 @@
+import calendar
+import time
+
+# The search API returns at most this many results for a query, however many match
+SEARCH_RESULT_CAP = 1000
+# GitHub only indexes files smaller than 384 KB for code search
+MAX_CODE_SIZE = 384 * 1024
+# No searchable content predates GitHub
+EARLIEST_DATE = calendar.timegm((2007, 10, 1, 0, 0, 0))
+# Qualifier each search endpoint is split on. Commits use author-date so shards can't clash
+# with the committer-date qualifier added by incremental scans
+SHARD_QUALIFIERS = {
+    'search/code': 'size',
+    'search/commits': 'author-date',
+    'search/issues': 'created',
+    'search/repositories': 'created'
+}
+
+
+class Shard(object):
+    """A search restricted to an inclusive range of a numeric or date qualifier"""
+
+    __slots__ = ('base_query', 'qualifier', 'low', 'high')
+
+    def __init__(self, base_query, qualifier, low, high):
+        self.base_query = base_query
+        self.qualifier = qualifier
+        self.low = low
+        self.high = high
+
+    @classmethod
+    def for_endpoint(cls, url, query):
+        """A shard covering every possible value of the qualifier used for the endpoint"""
+
+        qualifier = SHARD_QUALIFIERS.get(url)
+        if qualifier is None:
+            return None
+        if qualifier == 'size':
+            return cls(query, qualifier, 0, MAX_CODE_SIZE)
+        return cls(query, qualifier, EARLIEST_DATE, calendar.timegm(time.gmtime()) + 86400)
+
+    def _format(self, value):
+        if self.qualifier == 'size':
+            return str(value)
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(value))
+
+    @property
+    def query(self):
+        return '{} {}:{}..{}'.format(self.base_query, self.qualifier, self._format(self.low), self._format(self.high))
+
+    def splittable(self):
+        return self.high > self.low
+
+    def split(self):
+        middle = (self.low + self.high) // 2
+        return [Shard(self.base_query, self.qualifier, self.low, middle),
+                Shard(self.base_query, self.qualifier, middle + 1, self.high)]
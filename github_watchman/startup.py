@@ -0,0 +1,26 @@
+import time
+
+# Imported before anything else by the package, so this is when it started importing
+IMPORT_STARTED = time.perf_counter()
+
+
+class StartupProfile(object):
+    """Time spent in each phase of starting a scan, reported with --profile-startup"""
+
+    def __init__(self, started=IMPORT_STARTED):
+        self.phases = []
+        self.last = started
+
+    def mark(self, phase):
+        """Record the time since the previous phase ended as the time spent in this one"""
+
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self):
+        width = max(len(phase) for phase, _ in self.phases)
+        lines = ['Startup profile:']
+        lines.extend('  {:<{}} {:>8.1f} ms'.format(phase, width, seconds * 1000) for phase, seconds in self.phases)
+        lines.append('  {:<{}} {:>8.1f} ms'.format('total', width, sum(seconds for _, seconds in self.phases) * 1000))
+        return '\n'.join(lines)
@@ -0,0 +1,98 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from github_watchman.cache import CACHE_PATH
+
+# Search qualifiers that let GitHub do the time filtering. Code search has no date qualifier
+DATE_QUALIFIERS = {
+    'commits': 'committer-date',
+    'issues': 'updated',
+    'repositories': 'pushed'
+}
+# Watermarks are moved back by this much to allow for clock skew and indexing delay,
+# results seen again in the overlap are dropped by their fingerprint
+WATERMARK_OVERLAP = 3600
+# Fingerprints of results not seen again for this long are pruned
+FINGERPRINT_MAX_AGE = 90 * 86400
+# The fields of a finding that identify the reported version of a result
+RESULT_KEYS = {
+    'code': ('sha', 'file_url'),
+    'commits': ('sha', 'commit_url'),
+    'issues': ('updated_at', 'issue_url'),
+    'repositories': ('updated_at', 'repository_url')
+}
+
+
+def fingerprint(version, url):
+    """Compact 64 bit fingerprint of a search result from its sha (or update time) and URL"""
+
+    digest = hashlib.sha1('{}\0{}'.format(version, url).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+
+def result_fingerprint(scope, result):
+    version_key, url_key = RESULT_KEYS.get(scope)
+    return fingerprint(result.get(version_key), result.get(url_key))
+
+
+class ScanState(object):
+    """Persists, per rule and scope, when it was last scanned and fingerprints of the results
+        already reported, so incremental scans only process new activity"""
+
+    def __init__(self, path=CACHE_PATH):
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(path, 'state.db'), check_same_thread=False)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS watermarks '
+                                    '(rule TEXT, scope TEXT, last_run INTEGER, PRIMARY KEY (rule, scope))')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS seen '
+                                    '(rule TEXT, scope TEXT, fingerprint INTEGER, reported INTEGER, '
+                                    'PRIMARY KEY (rule, scope, fingerprint)) WITHOUT ROWID')
+            self.connection.execute('DELETE FROM seen WHERE reported < ?', (int(time.time()) - FINGERPRINT_MAX_AGE,))
+
+    @staticmethod
+    def _rule_id(rule):
+        return rule.filename
+
+    def watermark(self, rule, scope):
+        with self.lock:
+            row = self.connection.execute('SELECT last_run FROM watermarks WHERE rule = ? AND scope = ?',
+                                          (self._rule_id(rule), scope)).fetchone()
+        return row[0] if row else None
+
+    def qualify(self, rule, scope, query):
+        """Add a date qualifier to a search string so only activity since the last run is returned"""
+
+        last_run = self.watermark(rule, scope)
+        if last_run is None or scope not in DATE_QUALIFIERS:
+            return query
+        since = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(last_run - WATERMARK_OVERLAP))
+        return '{} {}:>{}'.format(query, DATE_QUALIFIERS.get(scope), since)
+
+    def seen(self, rule, scope):
+        """Set of fingerprints already reported for the rule and scope"""
+
+        with self.lock:
+            rows = self.connection.execute('SELECT fingerprint FROM seen WHERE rule = ? AND scope = ?',
+                                           (self._rule_id(rule), scope))
+            return {row[0] for row in rows}
+
+    def record(self, rule, scope, fingerprints, run_started=None):
+        """Store the fingerprints of reported results. When run_started is given the watermark
+            is moved up to it"""
+
+        now = int(time.time())
+        rule_id = self._rule_id(rule)
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO seen VALUES (?, ?, ?, ?)',
+                                        ((rule_id, scope, value, now) for value in fingerprints))
+            if run_started is not None:
+                self.connection.execute('INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?)',
+                                        (rule_id, scope, run_started))
+
+    def close(self):
+        self.connection.close()
@@ -31,6 +31,16 @@ setup(
         'termcolor',
         'PyYAML',
     ],
+    extras_require={
+        'async': ['aiohttp'],
+        'regex': ['regex'],
+        're2': ['google-re2'],
+        'hyperscan': ['hyperscan'],
+        'orjson': ['orjson'],
+        'zstd': ['zstandard'],
+        'parquet': ['pyarrow'],
+        'redis': ['redis'],
+    },
     packages=['github_watchman'],
     include_package_data=True,
     package_data={
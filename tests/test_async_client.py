@@ -0,0 +1,100 @@
+import asyncio
+import unittest
+
+import github_watchman.config as cfg
+from github_watchman.async_client import AsyncGitHubAPIClient, EventLoopGitHubAPIClient, aiohttp
+from github_watchman.ratelimit import RateLimiter
+from github_watchman.rule_engine import Rule
+from github_watchman.scheduler import ScanScheduler
+from benchmarks.github_stub import GitHubStub
+
+RULES = [Rule({'filename': 'rule{}.yaml'.format(index), 'pattern': 'access_token',
+               'strings': ['access_token{}'.format(index)]}) for index in range(20)]
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+@unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+class TestAsyncGitHubAPIClient(unittest.TestCase):
+    def search(self, stub, query='access_token', media_type=None):
+        async def search():
+            limiter = RateLimiter(search_limit=1000, backoff_base=0.01)
+            async with AsyncGitHubAPIClient('token', stub.url, rate_limiter=limiter) as client:
+                if media_type:
+                    return await client.multipage_search('search/commits', query, media_type)
+                return await client.multipage_search('search/code', query)
+        return run(search())
+
+    def test_pagination(self):
+        """Check every page is fetched and items come back in page order"""
+
+        with GitHubStub(results=250) as stub:
+            items = self.search(stub)
+        self.assertEqual([item.get('sha') for item in items], ['{:040x}'.format(i) for i in range(250)])
+        self.assertEqual(sorted(params.get('page')[0] for _, params, _ in stub.requests), ['1', '2', '3'])
+
+    def test_past_result_cap(self):
+        """Check a search matching more than 1000 results is sharded like the threaded client does"""
+
+        with GitHubStub(results=2500, search_limit=1000) as stub:
+            items = self.search(stub)
+        self.assertEqual(sorted(item.get('sha') for item in items), ['{:040x}'.format(i) for i in range(2500)])
+
+    def test_media_type_per_request(self):
+        """Check each request sends its own Accept header"""
+
+        with GitHubStub(results=10) as stub:
+            self.search(stub, media_type='application/vnd.github.cloak-preview.text-match+json')
+        self.assertEqual(stub.requests[0][2].get('Accept'), 'application/vnd.github.cloak-preview.text-match+json')
+
+    def test_abuse_limit_retried(self):
+        """Check a 403 with Retry-After is retried like the threaded client does"""
+
+        with GitHubStub(results=10) as stub:
+            stub.failures.append((403, {'Retry-After': '0'}))
+            items = self.search(stub)
+        self.assertEqual(len(items), 10)
+        self.assertEqual(len(stub.requests), 2)
+
+
+@unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+class TestEventLoopGitHubAPIClient(unittest.TestCase):
+    def test_scan(self):
+        """Check a scan with many workers finds every result, with enrichment, through one event loop"""
+
+        found = []
+        with GitHubStub(results=150, search_limit=10000) as stub:
+            connection = EventLoopGitHubAPIClient('token', stub.url, rate_limiter=RateLimiter(search_limit=10000))
+            try:
+                ScanScheduler(connection, None, timeframe=cfg.ALL_TIME - 1, workers=50, merge_queries=False).run(
+                    [(rule, 'code') for rule in RULES], lambda rule, scope, finding: found.append(finding))
+            finally:
+                connection.close()
+            lookups = [request for request in stub.requests if request[0].endswith('/graphql')]
+        self.assertEqual(len(found), 150 * len(RULES))
+        self.assertEqual(len(lookups), 2 * len(RULES))
+        self.assertFalse(connection.thread.is_alive())
+
+    def test_server_errors_retried(self):
+        """Check server errors from the event loop are retried by make_request"""
+
+        with GitHubStub(results=10) as stub:
+            stub.failures.extend([(502, {}), (503, {})])
+            connection = EventLoopGitHubAPIClient('token', stub.url,
+                                                  rate_limiter=RateLimiter(search_limit=1000, backoff_base=0.01))
+            try:
+                items = connection.multipage_search('search/code', 'access_token')
+            finally:
+                connection.close()
+        self.assertEqual(len(items), 10)
+        self.assertEqual(len(stub.requests), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,19 @@
+import unittest
+
+from benchmarks.pipeline import COLUMNS, run
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_run(self):
+        """Check every stage of the pipeline benchmark runs and reports each measurement"""
+
+        rows = run(hits=400, rules=2, workers=2)
+        self.assertEqual([row.get('stage') for row in rows][0], 'search')
+        for row in rows:
+            self.assertEqual(set(row), set(COLUMNS))
+        self.assertEqual(rows[0].get('results'), 400)
+        self.assertGreater(rows[0].get('requests'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import tempfile
+import unittest
+
+from github_watchman.cache import MatchCache, RepositoryCache
+from github_watchman.rule_engine import Rule
+
+RULE = Rule({'filename': 'access_tokens.yaml', 'pattern': 'access_token'})
+
+
+class TestRepositoryCache(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def test_persisted_between_instances(self):
+        """Check repositories written by one cache are read back by the next"""
+
+        cache = RepositoryCache(self.path)
+        cache.put('MDEwOlJlcG9zaXRvcnkx', {'updated_at': '2020-01-01T00:00:00Z'})
+        cache.close()
+
+        entry = RepositoryCache(self.path).get('MDEwOlJlcG9zaXRvcnkx')
+        self.assertEqual(entry.data, {'updated_at': '2020-01-01T00:00:00Z'})
+
+    def test_ttl(self):
+        """Check entries older than the TTL are stale"""
+
+        cache = RepositoryCache(self.path, ttl=0)
+        entry = cache.put('MDEwOlJlcG9zaXRvcnkx', {})
+        self.assertFalse(cache.is_fresh(entry))
+
+        cache.ttl = 60
+        self.assertTrue(cache.is_fresh(entry))
+
+    def test_lru_bounded(self):
+        """Check the in-process LRU never grows past its size"""
+
+        cache = RepositoryCache(self.path, lru_size=2)
+        for name in ('a/a', 'b/b', 'c/c'):
+            cache.put(name, {'name': name})
+        self.assertEqual(list(cache.lru), ['b/b', 'c/c'])
+        self.assertEqual(cache.get('a/a').data, {'name': 'a/a'})
+
+
+class CountingRule(Rule):
+    __slots__ = ('searches',)
+
+    def search(self, fragment):
+        self.searches = getattr(self, 'searches', 0) + 1
+        return super().search(fragment)
+
+
+class TestMatchCache(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.rule = CountingRule({'filename': 'access_tokens.yaml', 'pattern': 'access_token'})
+
+    def test_repeated_blob(self):
+        """Check a blob seen again is not matched again, even with different fragments"""
+
+        cache = MatchCache()
+        self.assertTrue(cache.matches(self.rule, 'abc', [{'fragment': 'access_token = 1'}]))
+        self.assertTrue(cache.matches(self.rule, 'abc', [{'fragment': 'something else'}]))
+        self.assertEqual(self.rule.searches, 1)
+        self.assertEqual(cache.get('abc', self.rule).fragments, ('access_token = 1',))
+
+    def test_miss_only_reused_for_same_fragments(self):
+        """Check a miss is only reused when the search returned the same fragments"""
+
+        cache = MatchCache()
+        self.assertFalse(cache.matches(self.rule, 'abc', [{'fragment': 'nothing'}]))
+        self.assertFalse(cache.matches(self.rule, 'abc', [{'fragment': 'nothing'}]))
+        self.assertEqual(self.rule.searches, 1)
+        self.assertTrue(cache.matches(self.rule, 'abc', [{'fragment': 'access_token'}]))
+
+    def test_persisted_and_invalidated(self):
+        """Check verdicts are read back by the next run until the rule's pattern changes"""
+
+        cache = MatchCache(self.path)
+        cache.matches(RULE, 'abc', [{'fragment': 'access_token'}])
+        cache.matches(RULE, 'def', [{'fragment': 'access_token'}])
+        cache.close()
+
+        changed = Rule({'filename': 'access_tokens.yaml', 'pattern': 'access_token='})
+        cache = MatchCache(self.path)
+        self.assertTrue(cache.get('abc', RULE).matched)
+        self.assertIsNone(cache.get('abc', changed))
+        cache.invalidate([changed])
+        self.assertIsNone(cache.get('def', RULE))
+
+    def test_lru_bounded(self):
+        """Check the in-process LRU never grows past its size"""
+
+        cache = MatchCache(size=2)
+        for sha in ('a', 'b', 'c'):
+            cache.matches(RULE, sha, [{'fragment': 'access_token'}])
+        self.assertEqual(list(cache.lru), [('b', 'access_tokens.yaml'), ('c', 'access_tokens.yaml')])
+
+
+if __name__ == '__main__':
+    unittest.main()
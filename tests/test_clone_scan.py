@@ -0,0 +1,126 @@
+import os
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+import github_watchman.clone_scan as clone_scan
+from github_watchman.clone_scan import CloneScanner, MirrorRepository
+from github_watchman.rule_engine import Rule, load_rules
+
+RULE = Rule({'filename': 'access_tokens.yaml', 'pattern': 'access_token', 'scope': ['code', 'commits']})
+FRAGMENT = 'config = {"access_token": "0123456789abcdefghijklmnopqrstuvwxyz"}'
+RULES_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'github_watchman', 'rules')
+
+
+def git(path, *args):
+    subprocess.run(['git', '-C', path, '-c', 'user.name=Tyrion', '-c', 'user.email=tyrion@example.com'] + list(args),
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def commit(path, files, message):
+    for name, content in files.items():
+        with open(os.path.join(path, name), 'w') as file:
+            file.write(content)
+    git(path, 'add', '-A')
+    git(path, 'commit', '-q', '-m', message)
+
+
+class TestCloneScan(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.mirrors = os.path.join(self.path, 'mirrors')
+        self.repositories = []
+        for name in ('repo0', 'repo1'):
+            work = os.path.join(self.path, name)
+            git(self.path, 'init', '-q', name)
+            commit(work, {'config.py': FRAGMENT}, 'Add config')
+            commit(work, {'config.py': 'config = {}'}, 'Remove access_token from {}'.format(name))
+            self.repositories.append(MirrorRepository('org/{}'.format(name), work))
+        clone_scan._init_worker([RULE])
+
+    def test_full_history(self):
+        """Check blobs removed from the current tree and commit messages are both found"""
+
+        findings = clone_scan.scan_repository(self.repositories[0], self.mirrors)
+        scopes = sorted(scope for _, scope, _ in findings)
+        self.assertEqual(scopes, ['code', 'commits'])
+        code = next(finding for _, scope, finding in findings if scope == 'code')
+        self.assertEqual(code.get('file_name'), 'config.py')
+        self.assertEqual(code.get('matches')[0].get('fragment'), FRAGMENT)
+        self.assertEqual(code.get('repository').get('repository_name'), 'repo0')
+
+    def test_blobs_scanned_once(self):
+        """Check a blob shared between repositories is read once and reported for each"""
+
+        clone_scan.scan_repository(self.repositories[0], self.mirrors)
+        scanned = dict(clone_scan._BLOB_MATCHES)
+        findings = clone_scan.scan_repository(self.repositories[1], self.mirrors)
+        self.assertEqual(clone_scan._BLOB_MATCHES, scanned)
+        self.assertEqual(len([scope for _, scope, _ in findings if scope == 'code']), 1)
+
+    def test_engines_built_by_task(self):
+        """Check a process builds its rule engines from the first task given rules, and only once"""
+
+        clone_scan._ENGINES.clear()
+        clone_scan._ENGINES_KEY = None
+        findings = clone_scan.scan_repository(self.repositories[0], self.mirrors, rules=[RULE])
+        self.assertEqual(sorted(scope for _, scope, _ in findings), ['code', 'commits'])
+        engines = dict(clone_scan._ENGINES)
+        clone_scan.scan_repository(self.repositories[1], self.mirrors, rules=[RULE])
+        self.assertEqual(clone_scan._ENGINES, engines)
+
+    def test_blob_matches_bounded(self):
+        """Check a worker only remembers the matches of the most recently seen blobs"""
+
+        with mock.patch.object(clone_scan, 'BLOB_MATCH_CACHE_SIZE', 1):
+            findings = clone_scan.scan_repository(self.repositories[0], self.mirrors)
+        self.assertEqual(len(clone_scan._BLOB_MATCHES), 1)
+        self.assertEqual(len([scope for _, scope, _ in findings if scope == 'code']), 1)
+
+    def test_token_needs_git_2_31(self):
+        """Check cloning with a token fails clearly when git is too old to be given it"""
+
+        with mock.patch.object(clone_scan, 'git_version', return_value=(2, 30)):
+            with self.assertRaisesRegex(Exception, 'needs git 2.31'):
+                clone_scan.sync(self.repositories[0], self.mirrors, token='token')
+        self.assertIn('GIT_CONFIG_COUNT', clone_scan._git_env('token'))
+
+    def test_incremental_fetch(self):
+        """Check a mirror that already exists is fetched into rather than cloned again"""
+
+        clone_scan.scan_repository(self.repositories[0], self.mirrors)
+        commit(self.repositories[0].clone_url, {'secrets.py': 'access_token = "new"'}, 'Add secrets')
+        findings = clone_scan.scan_repository(self.repositories[0], self.mirrors)
+        self.assertIn('secrets.py', [finding.get('file_name') for _, scope, finding in findings if scope == 'code'])
+
+    def test_scanner(self):
+        """Check the process pool reports each finding once per rule and scope"""
+
+        found = []
+        totals = {}
+        CloneScanner(None, self.mirrors, workers=2).run(
+            self.repositories, [(RULE, 'code'), (RULE, 'commits')],
+            lambda rule, scope, finding: found.append((rule, scope)),
+            lambda rule, scope, total: totals.update({scope: total}))
+        self.assertEqual(totals, {'code': 2, 'commits': 2})
+        self.assertEqual(found.count((RULE, 'code')), 2)
+
+    def test_shipped_rules(self):
+        """Check the shipped rules don't report ordinary files, rules that only rely on search qualifiers are skipped"""
+
+        work = os.path.join(self.path, 'plain')
+        git(self.path, 'init', '-q', 'plain')
+        commit(work, {'a.txt': 'Nothing to see here\n', 'b.py': 'print("hello")\n'}, 'Add files')
+        rules = load_rules(RULES_PATH)
+        self.assertIn('interesting_files.yaml', [rule.filename for rule in rules if not clone_scan.scannable(rule)])
+
+        found = []
+        CloneScanner(None, self.mirrors, workers=1).run(
+            [MirrorRepository('org/plain', work)], [(rule, scope) for rule in rules for scope in rule.scope],
+            lambda rule, scope, finding: found.append((rule.filename, scope, finding)))
+        self.assertEqual(found, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import yaml
+
+import github_watchman.config as cfg
+import github_watchman.metrics as metrics
+from github_watchman.daemon import Daemon, parse_interval
+from github_watchman.github_wrapper import GitHubAPIClient
+from github_watchman.ratelimit import RateLimiter
+from github_watchman.state import ScanState
+from benchmarks.github_stub import GitHubStub
+
+
+def write_rule(path, name, string, interval=None):
+    definition = {
+        'filename': '{}.yaml'.format(name),
+        'enabled': True,
+        'meta': {'name': name, 'severity': '70'},
+        'scope': ['issues'],
+        'strings': [string],
+        'pattern': 'access_token'
+    }
+    if interval is not None:
+        definition['interval'] = interval
+    with open(os.path.join(path, definition.get('filename')), 'w') as rule_file:
+        yaml.safe_dump(definition, rule_file)
+
+
+def searches(stub, string):
+    return [request for request in stub.requests if string in request[1].get('q', [''])[0]]
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.rules_path = tempfile.mkdtemp()
+        self.findings = []
+
+    def _daemon(self, stub, output=None, **kwargs):
+        connection = GitHubAPIClient('token', stub.url, rate_limiter=RateLimiter(search_limit=1000))
+        daemon = Daemon(connection, None, self.rules_path, ['issues'], ScanState(tempfile.mkdtemp()),
+                        output or (lambda rule, scope, finding: self.findings.append((rule.filename, finding))),
+                        timeframe=cfg.ALL_TIME, jitter=0, **kwargs)
+        thread = threading.Thread(target=daemon.run, daemon=True)
+        thread.start()
+        return daemon, thread
+
+    def test_parse_interval(self):
+        """Check intervals are read as seconds or with a unit suffix"""
+
+        self.assertEqual(parse_interval(90), 90)
+        self.assertEqual(parse_interval('15m'), 900)
+        self.assertEqual(parse_interval('6h'), 21600)
+        self.assertEqual(parse_interval('1d'), 86400)
+        for value in ('0', 'hourly', '-5m'):
+            self.assertRaises(ValueError, parse_interval, value)
+
+    def test_repeated_runs(self):
+        """Check each rule is scanned again on its interval and results are only reported once"""
+
+        write_rule(self.rules_path, 'access_tokens', 'access_token')
+        with GitHubStub(results=10, search_limit=1000) as stub:
+            daemon, thread = self._daemon(stub, interval=0.2)
+            self.assertTrue(wait_for(lambda: len(searches(stub, 'access_token')) >= 3))
+            daemon.stop()
+            thread.join()
+        self.assertEqual(len(self.findings), 10)
+        # Runs after the first only ask for activity since the last one
+        self.assertIn('updated:>', searches(stub, 'access_token')[-1][1].get('q')[0])
+
+    def test_no_overlapping_runs(self):
+        """Check a run that comes due while the last run of the rule is still going is skipped"""
+
+        def slow_output(rule, scope, finding):
+            time.sleep(0.05)
+            self.findings.append((rule.filename, finding))
+
+        write_rule(self.rules_path, 'access_tokens', 'access_token')
+        skipped = metrics.SCHEDULED_RUNS.value(outcome='skipped')
+        with GitHubStub(results=10, search_limit=1000) as stub:
+            daemon, thread = self._daemon(stub, output=slow_output, interval=0.05)
+            self.assertTrue(wait_for(lambda: len(self.findings) == 10))
+            daemon.stop()
+            thread.join()
+        self.assertGreater(metrics.SCHEDULED_RUNS.value(outcome='skipped'), skipped)
+        self.assertEqual(len(self.findings), 10)
+
+    def test_reload_rules(self):
+        """Check rules added while the daemon runs are scheduled, and a rule's own interval is used"""
+
+        write_rule(self.rules_path, 'access_tokens', 'access_token', interval='1h')
+        with GitHubStub(results=10, search_limit=1000) as stub:
+            daemon, thread = self._daemon(stub, interval=0.2, reload_interval=0.05)
+            self.assertTrue(wait_for(lambda: len(self.findings) == 10))
+            write_rule(self.rules_path, 'secret_keys', 'secret_key')
+            self.assertTrue(wait_for(lambda: len(searches(stub, 'secret_key')) >= 1))
+            time.sleep(0.3)
+            daemon.stop()
+            thread.join()
+        self.assertEqual(len(searches(stub, 'access_token')), 1)
+        self.assertEqual(sorted({filename for filename, _ in self.findings}), ['access_tokens.yaml', 'secret_keys.yaml'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+import unittest
+
+from github_watchman.dedup import Deduplicator
+
+
+class TestDeduplicator(unittest.TestCase):
+    def test_order_kept(self):
+        """Check duplicates are dropped and the first occurrence keeps its place"""
+
+        results = [{'issue_id': 3}, {'issue_id': 1}, {'issue_id': 3}, {'issue_id': 2}]
+        deduplicator = Deduplicator()
+        self.assertEqual(list(deduplicator.filter('issues', results)),
+                         [{'issue_id': 3}, {'issue_id': 1}, {'issue_id': 2}])
+        self.assertEqual(deduplicator.dropped, 1)
+
+    def test_identity_per_scope(self):
+        """Check code is identified by blob sha and file, other scopes by their ids"""
+
+        deduplicator = Deduplicator()
+        self.assertTrue(deduplicator.is_new('code', {'sha': 'a', 'file_url': 'x', 'matches': [1]}))
+        self.assertFalse(deduplicator.is_new('code', {'sha': 'a', 'file_url': 'x', 'matches': [2]}))
+        self.assertTrue(deduplicator.is_new('code', {'sha': 'a', 'file_url': 'y'}))
+        self.assertTrue(deduplicator.is_new('commits', {'sha': 'a'}))
+        self.assertTrue(deduplicator.is_new('repositories', {'repository_id': 1}))
+        self.assertFalse(deduplicator.is_new('repositories', {'repository_id': 1, 'updated_at': 'later'}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import github_watchman.config as cfg
+import github_watchman.distributed as distributed
+from github_watchman.dedup import Deduplicator
+from github_watchman.distributed import DistributedScheduler, SQLiteQueue, finding_key
+from github_watchman.rule_engine import Rule
+from benchmarks.github_stub import GitHubStub
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RULES = [
+    Rule({'filename': 'access_tokens.yaml', 'pattern': 'access_token', 'meta': {'name': 'Access Tokens'},
+          'strings': ['access_token', 'access_token in:file']}),
+    Rule({'filename': 'secret_keys.yaml', 'pattern': 'access_token', 'meta': {'name': 'Secret Keys'},
+          'strings': ['secret_key']})
+]
+
+
+class TestSQLiteQueue(unittest.TestCase):
+    def setUp(self):
+        self.queue = SQLiteQueue(os.path.join(tempfile.mkdtemp(), 'queue.db'))
+
+    def test_lease(self):
+        """Check items are leased once, in order, and taken over when a lease expires"""
+
+        first, second = self.queue.publish('scan', [{'query': 'a'}, {'query': 'b'}])
+        self.assertEqual(self.queue.lease('worker-1'), (first, {'query': 'a'}))
+        self.assertEqual(self.queue.lease('worker-2', lease_seconds=-1), (second, {'query': 'b'}))
+        # The second worker stopped responding, its item goes to the next worker to ask
+        self.assertEqual(self.queue.lease('worker-1'), (second, {'query': 'b'}))
+        self.assertIsNone(self.queue.lease('worker-3'))
+        self.assertFalse(self.queue.extend(second, 'worker-2'))
+
+        self.queue.complete(first, 'worker-1', 10)
+        self.assertEqual(self.queue.finished('scan'), [(first, 'done', 10, None)])
+        self.assertEqual(self.queue.outstanding('scan'), 1)
+
+    def test_retries(self):
+        """Check failed items are retried up to MAX_ATTEMPTS times before they are given up on"""
+
+        item_id, = self.queue.publish('scan', [{'query': 'a'}])
+        for _ in range(distributed.MAX_ATTEMPTS):
+            self.assertEqual(self.queue.lease('worker')[0], item_id)
+            self.queue.fail(item_id, 'worker', 'Boom')
+        self.assertIsNone(self.queue.lease('worker'))
+        self.assertEqual(self.queue.finished('scan'), [(item_id, 'failed', None, 'Boom')])
+
+    def test_findings_deduplicated(self):
+        """Check findings sent by more than one worker are only added to the sink once"""
+
+        finding = {'issue_id': 1, 'issue_url': 'https://github.example.com/org/repo/issues/1'}
+        row = (finding_key('access_tokens.yaml', 'issues', finding), 'access_tokens.yaml', 'issues', finding)
+        self.assertEqual(self.queue.add_findings('scan', [row]), 1)
+        self.assertEqual(self.queue.add_findings('scan', [row]), 0)
+        self.assertEqual(self.queue.add_findings('other', [row]), 1)
+        self.assertEqual([finding_id for finding_id, *_ in self.queue.findings('scan')], [1])
+        self.assertEqual(self.queue.findings('scan', after=1), [])
+
+    def test_quota(self):
+        """Check the quota recorded for a token is shared, and tokens with more left are picked first"""
+
+        reset = int(time.time()) + 60
+        self.queue.update_quota('a', 'search', 1, reset)
+        self.queue.update_quota('a', 'search', 5, reset)
+        self.assertEqual(self.queue.pick_token(['a', 'b'], 'search'), 'b')
+        self.queue.update_quota('b', 'search', 0, reset)
+        self.assertEqual(self.queue.pick_token(['a', 'b'], 'search'), 'a')
+        self.assertEqual(self.queue.reserve_quota('a', 'search', 3), (1, 0))
+        taken, wait = self.queue.reserve_quota('a', 'search')
+        self.assertEqual(taken, 0)
+        self.assertGreater(wait, 59)
+        self.assertEqual(self.queue.reserve_quota('c', 'search', 3), (3, 0))
+
+    def test_quota_reserved_in_batches(self):
+        """Check a worker takes requests from the shared quota a batch at a time"""
+
+        self.queue.update_quota('a', 'search', 25, int(time.time()) + 60)
+        limiter = distributed.PooledRateLimiter(self.queue, 'a', batch_size=10, search_limit=1000)
+        reserved = []
+        original = self.queue.reserve_quota
+
+        def reserve_quota(token, resource, count=1):
+            reserved.append(count)
+            return original(token, resource, count)
+
+        self.queue.reserve_quota = reserve_quota
+        for _ in range(25):
+            self.assertEqual(limiter.reserve('search'), 0)
+        self.assertGreater(limiter.reserve('search'), 59)
+        self.assertEqual(reserved, [10, 10, 10, 10])
+
+
+class TestDistributedScan(unittest.TestCase):
+    def _workers(self, stub, queue_path, count):
+        env = dict(os.environ, GITHUB_WATCHMAN_TOKENS='token-a,token-b', GITHUB_WATCHMAN_URL=stub.url,
+                   PYTHONPATH=ROOT)
+        return [subprocess.Popen([sys.executable, '-m', 'github_watchman', 'worker', '--queue', queue_path,
+                                  '--workers', '1', '--max-idle', '1'], env=env, cwd=ROOT,
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) for _ in range(count)]
+
+    def test_scan_with_worker_processes(self):
+        """Check a scan published to a file backed queue is run by several worker processes with a pool of
+            tokens, and each finding is output once"""
+
+        queue_path = os.path.join(tempfile.mkdtemp(), 'queue.db')
+        work_queue = SQLiteQueue(queue_path)
+        findings = []
+        completed = []
+        with GitHubStub(results=20, latency=0.05, search_limit=10000) as stub:
+            scheduler = DistributedScheduler(None, None, work_queue, cfg.ALL_TIME, merge_queries=False)
+            thread = threading.Thread(target=scheduler.run, args=(
+                [(rule, 'issues') for rule in RULES], lambda rule, scope, finding: findings.append((rule, finding)),
+                lambda rule, scope, total: completed.append((rule, total))), daemon=True)
+            thread.start()
+            workers = self._workers(stub, queue_path, 2)
+            thread.join(timeout=60)
+            for worker in workers:
+                worker.wait(timeout=30)
+        self.assertFalse(thread.is_alive())
+        # Both strings of the first rule find the same 20 issues
+        self.assertEqual(sorted((rule.filename, total) for rule, total in completed),
+                         [('access_tokens.yaml', 20), ('secret_keys.yaml', 20)])
+        self.assertEqual(len(findings), 40)
+        with work_queue.lock:
+            leased_by = {row[0] for row in work_queue.connection.execute('SELECT worker FROM items')}
+        self.assertEqual(len(leased_by), 2)
+        tokens = {headers.get('Authorization') for _, _, headers in stub.requests}
+        self.assertEqual(tokens, {'token token-a', 'token token-b'})
+
+    def test_dedup_across_rules(self):
+        """Check findings are deduplicated across rules by the coordinator when asked to"""
+
+        queue_path = os.path.join(tempfile.mkdtemp(), 'queue.db')
+        work_queue = SQLiteQueue(queue_path)
+        findings = []
+        with GitHubStub(results=5, search_limit=10000) as stub:
+            scheduler = DistributedScheduler(None, None, work_queue, cfg.ALL_TIME, deduplicator=Deduplicator())
+            workers = self._workers(stub, queue_path, 1)
+            scheduler.run([(rule, 'issues') for rule in RULES],
+                          lambda rule, scope, finding: findings.append((rule, finding)))
+            for worker in workers:
+                worker.wait(timeout=30)
+        self.assertEqual(len(findings), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
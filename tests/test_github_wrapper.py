@@ -0,0 +1,107 @@
+import unittest
+from unittest import mock
+
+import github_watchman.config as cfg
+import github_watchman.enrichment as enrichment
+import github_watchman.logger as logger
+from github_watchman.github_wrapper import GitHubAPIClient, query_code, query_commits
+from github_watchman.ratelimit import RateLimiter
+from github_watchman.rule_engine import Rule
+from benchmarks.github_stub import GitHubStub
+
+RULE = Rule({'filename': 'access_tokens.yaml', 'pattern': 'access_token'})
+
+
+def client(stub, max_retries=5):
+    limiter = RateLimiter(search_limit=1000, max_retries=max_retries, backoff_base=0.01)
+    return GitHubAPIClient('token', stub.url, max_workers=4, rate_limiter=limiter)
+
+
+class TestGitHubAPIClient(unittest.TestCase):
+    def test_multipage_search(self):
+        """Check every page is fetched and items come back in page order"""
+
+        with GitHubStub(results=250) as stub:
+            items = client(stub).multipage_search('search/code', 'access_token')
+        self.assertEqual([item.get('sha') for item in items], ['{:040x}'.format(i) for i in range(250)])
+
+    def test_server_errors_retried(self):
+        """Check server errors are retried with backoff until the request succeeds"""
+
+        with GitHubStub(results=10) as stub:
+            stub.failures.extend([(502, {}), (500, {}), (503, {})])
+            items = client(stub).multipage_search('search/code', 'access_token')
+        self.assertEqual(len(items), 10)
+        self.assertEqual(len(stub.requests), 4)
+
+    def test_retries_logged(self):
+        """Check retry messages go through the output logger so they don't break stdout output"""
+
+        log_handler = logger.StdoutLogger()
+        with GitHubStub(results=10) as stub, mock.patch.object(log_handler, 'log_info') as log_info, \
+                mock.patch('builtins.print') as printed:
+            stub.failures.extend([(502, {}), (403, {'Retry-After': '0'})])
+            github = client(stub)
+            github.log_handler = log_handler
+            github.multipage_search('search/code', 'access_token')
+        self.assertEqual(log_info.call_count, 2)
+        printed.assert_not_called()
+
+    def test_failure_raised(self):
+        """Check a request that keeps failing raises instead of returning None"""
+
+        with GitHubStub(results=10) as stub:
+            stub.failures.extend([(502, {})] * 3)
+            with self.assertRaises(Exception):
+                client(stub, max_retries=2).make_request('{}/search/code'.format(stub.url))
+        self.assertEqual(len(stub.requests), 3)
+
+
+class TestEnrichment(unittest.TestCase):
+    def test_repositories_batched(self):
+        """Check repository node IDs are resolved 100 at a time and unknown IDs are left out"""
+
+        node_ids = ['MDEwOlJlcG9zaXRvcnk{}'.format(i) for i in range(250)] + ['unknown']
+        with GitHubStub() as stub:
+            repositories = enrichment.repositories(client(stub), node_ids)
+        self.assertEqual(len(stub.requests), 3)
+        self.assertEqual(len(repositories), 250)
+        self.assertEqual(repositories.get(node_ids[0]).get('default_branch'), 'main')
+
+    def test_code_timeframe_batched(self):
+        """Check filtering code results by timeframe costs one lookup per batch, not per result"""
+
+        with GitHubStub(results=250) as stub:
+            results = list(query_code(client(stub), RULE, 'access_token', timeframe=cfg.ALL_TIME - 1))
+            lookups = [request for request in stub.requests if request[0].endswith('/graphql')]
+        self.assertEqual(len(results), 250)
+        self.assertEqual(len(lookups), 3)
+
+    def test_committers(self):
+        """Check only commits the search didn't link to an account are looked up with GraphQL"""
+
+        with GitHubStub(results=20) as stub:
+            results = list(query_commits(client(stub), RULE, 'access_token'))
+            lookups = [request[1] for request in stub.requests if request[0].endswith('/graphql')]
+        self.assertEqual([lookup.get('variables').get('ids') for lookup in lookups],
+                         [['MDY6Q29tbWl019', 'MDY6Q29tbWl09']])
+        self.assertEqual({result.get('committer_login') for result in results}, {'tyrion'})
+        self.assertEqual(results[0].get('committer_name'), 'Tyrion')
+
+    def test_committers_without_graphql(self):
+        """Check commit results keep the committer from the search when the GraphQL lookup fails"""
+
+        def graphql(query, variables):
+            raise Exception('GraphQL request failed')
+
+        with GitHubStub(results=10) as stub:
+            github = client(stub)
+            github.graphql = graphql
+            results = list(query_commits(github, RULE, 'access_token'))
+        self.assertEqual(len(results), 10)
+        self.assertEqual(results[9].get('committer_email'), 'tyrion@example.com')
+        self.assertIsNone(results[9].get('committer_login'))
+        self.assertEqual(results[0].get('committer_login'), 'tyrion')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,244 @@
+import csv
+import gzip
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import github_watchman.logger as logger
+
+
+class Collector(object):
+    """TCP server standing in for Logstash, keeping every line it receives"""
+
+    def __init__(self, port=0):
+        self.lines = []
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', port))
+        self.server.listen(5)
+        self.port = self.server.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._read, args=(connection,), daemon=True).start()
+
+    def _read(self, connection):
+        buffer = b''
+        while True:
+            chunk = connection.recv(65536)
+            if not chunk:
+                break
+            buffer += chunk
+        self.lines.extend(json.loads(line) for line in buffer.decode('utf-8').splitlines())
+
+    def close(self):
+        # Shutting down first wakes the accept() in the other thread, closing alone may not
+        self.server.shutdown(socket.SHUT_RDWR)
+        self.server.close()
+
+
+class TestSocketJSONLogger(unittest.TestCase):
+    def setUp(self):
+        self.spool_path = os.path.join(tempfile.mkdtemp(), 'spool.ndjson')
+
+    def stream(self, port):
+        return logger.SocketJSONLogger('127.0.0.1', port, spool_path=self.spool_path, flush_interval=0.05)
+
+    def wait_for(self, collector, count):
+        deadline = time.time() + 5
+        while len(collector.lines) < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_batched(self):
+        """Check findings are sent in order over one connection once the stream is closed"""
+
+        collector = Collector()
+        stream = self.stream(collector.port)
+        for index in range(500):
+            stream.log_notification({'index': index}, 'code', 'Test', 50)
+        stream.close()
+        self.wait_for(collector, 500)
+        collector.close()
+        self.assertEqual([line.get('detection_data').get('index') for line in collector.lines], list(range(500)))
+
+    def test_spooled_and_replayed(self):
+        """Check findings sent while the collector is down are spooled, then replayed when it is back"""
+
+        collector = Collector()
+        port = collector.port
+        collector.close()
+
+        stream = self.stream(port)
+        stream.log_notification({'index': 0}, 'code', 'Test', 50)
+        stream.close()
+        self.assertGreater(os.path.getsize(self.spool_path), 0)
+
+        collector = Collector(port)
+        stream = self.stream(port)
+        stream.log_notification({'index': 1}, 'code', 'Test', 50)
+        stream.close()
+        self.wait_for(collector, 2)
+        collector.close()
+        self.assertEqual([line.get('detection_data').get('index') for line in collector.lines], [0, 1])
+        self.assertEqual(os.path.getsize(self.spool_path), 0)
+
+    def test_overflow_in_order(self):
+        """Check findings logged faster than the collector takes them are spooled and still arrive in order"""
+
+        collector = Collector()
+        stream = logger.SocketJSONLogger('127.0.0.1', collector.port, spool_path=self.spool_path, batch_bytes=1,
+                                         max_pending=5)
+        send, spool = stream._send, stream._spool
+        spooled = []
+
+        def slow_send(data):
+            time.sleep(0.002)
+            send(data)
+
+        def counted_spool(data):
+            spooled.append(data)
+            spool(data)
+
+        stream._send, stream._spool = slow_send, counted_spool
+        for index in range(300):
+            stream.log_notification({'index': index}, 'code', 'Test', 50)
+        stream.close()
+        self.assertTrue(spooled)
+        self.wait_for(collector, 300)
+        collector.close()
+        self.assertEqual([line.get('detection_data').get('index') for line in collector.lines], list(range(300)))
+        self.assertEqual(os.path.getsize(self.spool_path), 0)
+
+
+class TestFileLogger(unittest.TestCase):
+    def setUp(self):
+        self.log_path = tempfile.mkdtemp()
+        self.file_logger = logger.FileLogger(self.log_path)
+
+    def lines(self):
+        with open(os.path.join(self.log_path, 'github_watchman.log')) as log_file:
+            return [json.loads(line) for line in log_file]
+
+    def test_valid_json(self):
+        """Check messages and findings containing quotes and newlines are logged as valid JSON"""
+
+        self.file_logger.log_info('Searching for "token"\n')
+        self.file_logger.log_notification({'fragment': 'key = "abc\\"'}, 'code', 'Quoted "type"', 50)
+        self.file_logger.close()
+        info, finding = self.lines()
+        self.assertEqual(info.get('message'), 'Searching for "token"\n')
+        self.assertEqual(list(finding), ['localtime', 'level', 'source', 'scope', 'severity', 'detection_type',
+                                         'detection_data'])
+        self.assertEqual(finding.get('detection_type'), 'Quoted "type"')
+        self.assertEqual(finding.get('detection_data'), {'fragment': 'key = "abc\\"'})
+
+    def test_concurrent_writes(self):
+        """Check findings logged from several threads are written as whole lines"""
+
+        def log(worker):
+            for index in range(500):
+                self.file_logger.log_notification({'worker': worker, 'index': index, 'padding': 'x' * 200},
+                                                  'code', 'Test', 50)
+
+        threads = [threading.Thread(target=log, args=(worker,)) for worker in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.file_logger.close()
+        lines = self.lines()
+        self.assertEqual(len(lines), 4000)
+        for worker in range(8):
+            self.assertEqual([line.get('detection_data').get('index') for line in lines
+                              if line.get('detection_data').get('worker') == worker], list(range(500)))
+
+    def test_reopened_when_moved(self):
+        """Check the log file is reopened after it has been rotated"""
+
+        log_file = os.path.join(self.log_path, 'github_watchman.log')
+        self.file_logger.log_info('before')
+        self.file_logger.writer.flush()
+        os.rename(log_file, log_file + '.1')
+        self.file_logger.log_info('after')
+        self.file_logger.close()
+        self.assertEqual([line.get('message') for line in self.lines()], ['after'])
+
+
+CODE_FINDING = {
+    'file_name': 'settings.py',
+    'file_url': 'https://github.com/westeros/lannister_docs/blob/abc/settings.py',
+    'sha': 'abc',
+    'repository': {
+        'repository_id': 1,
+        'repository_node_id': 'R_1',
+        'repository_name': 'lannister_docs',
+        'repository_url': 'https://github.com/westeros/lannister_docs'
+    },
+    'matches': [{'object_url': 'https://github.com/westeros/lannister_docs', 'object_type': 'FileContent',
+                 'fragment': 'token = "abc",\nsecret'}]
+}
+
+
+class TestCSVLogger(unittest.TestCase):
+    def setUp(self):
+        self.out_path = tempfile.mkdtemp()
+
+    def rows(self, path, opener=open):
+        with opener(path, mode='rt', encoding='utf-8', newline='') as csv_file:
+            return list(csv.DictReader(csv_file))
+
+    def test_appended(self):
+        """Check findings are flattened, written as they arrive and appended to on later runs"""
+
+        csv_logger = logger.CSVLogger(self.out_path, flush_interval=0)
+        csv_logger.write_row('exposed_tokens', 'code', CODE_FINDING)
+        path = os.path.join(self.out_path, 'exposed_tokens_code.csv')
+        self.assertEqual(len(self.rows(path)), 1)
+        self.assertEqual(csv_logger.complete('exposed_tokens', 'code'), path)
+        self.assertIsNone(csv_logger.complete('exposed_tokens', 'code'))
+
+        csv_logger = logger.CSVLogger(self.out_path)
+        csv_logger.write_row('exposed_tokens', 'code', CODE_FINDING)
+        csv_logger.close()
+        rows = self.rows(path)
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1].get('repository_name'), 'lannister_docs')
+        self.assertEqual(json.loads(rows[1].get('matches')), CODE_FINDING.get('matches'))
+
+    def test_gzip(self):
+        """Check gzip compressed output can be read back after being appended to"""
+
+        for _ in range(2):
+            csv_logger = logger.CSVLogger(self.out_path, compression='gzip')
+            csv_logger.write_row('exposed_tokens', 'code', CODE_FINDING)
+            csv_logger.close()
+        rows = self.rows(os.path.join(self.out_path, 'exposed_tokens_code.csv.gz'), gzip.open)
+        self.assertEqual([row.get('sha') for row in rows], ['abc', 'abc'])
+
+    @unittest.skipIf(logger.zstandard is None, 'zstandard is not installed')
+    def test_zstd(self):
+        """Check zstd compressed output can be read back after being appended to"""
+
+        for _ in range(2):
+            csv_logger = logger.CSVLogger(self.out_path, compression='zstd')
+            csv_logger.write_row('exposed_tokens', 'code', CODE_FINDING)
+            csv_logger.close()
+        path = os.path.join(self.out_path, 'exposed_tokens_code.csv.zst')
+        with open(path, 'rb') as compressed:
+            reader = logger.zstandard.ZstdDecompressor().stream_reader(compressed, read_across_frames=True)
+            text = reader.read().decode('utf-8')
+        rows = list(csv.DictReader(text.splitlines()))
+        self.assertEqual([row.get('sha') for row in rows], ['abc', 'abc'])
+
+
+if __name__ == '__main__':
+    unittest.main()
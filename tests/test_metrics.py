@@ -0,0 +1,91 @@
+import json
+import os
+import tempfile
+import unittest
+import urllib.request
+
+import github_watchman.config as cfg
+import github_watchman.metrics as metrics
+from github_watchman.github_wrapper import GitHubAPIClient, query_issues
+from github_watchman.ratelimit import RateLimiter
+from github_watchman.rule_engine import Rule
+from benchmarks.github_stub import GitHubStub
+
+RULE = Rule({'filename': 'metrics_access_tokens.yaml', 'pattern': 'access_token'})
+
+
+class TestMetrics(unittest.TestCase):
+    def test_render(self):
+        """Check counters and histograms are rendered in the OpenMetrics text format"""
+
+        registry = metrics.Registry()
+        requests = registry.counter('requests', 'Requests made', ['endpoint'])
+        latency = registry.histogram('latency_seconds', 'Request latency', ['endpoint'], buckets=(0.1, 1, float('inf')))
+        requests.inc(endpoint='search/code')
+        requests.inc(2, endpoint='search/code')
+        latency.observe(0.5, endpoint='graphql')
+        self.assertEqual(registry.render().splitlines(), [
+            '# TYPE requests counter',
+            '# HELP requests Requests made',
+            'requests_total{endpoint="search/code"} 3',
+            '# TYPE latency_seconds histogram',
+            '# HELP latency_seconds Request latency',
+            'latency_seconds_bucket{endpoint="graphql",le="0.1"} 0',
+            'latency_seconds_bucket{endpoint="graphql",le="1"} 1',
+            'latency_seconds_bucket{endpoint="graphql",le="+Inf"} 1',
+            'latency_seconds_count{endpoint="graphql"} 1',
+            'latency_seconds_sum{endpoint="graphql"} 0.5',
+            '# EOF'
+        ])
+        self.assertEqual(registry.summary().get('latency_seconds').get('graphql').get('mean'), 0.5)
+
+    def test_endpoint(self):
+        """Check request URLs are grouped by endpoint without ids or names"""
+
+        self.assertEqual(metrics.endpoint('https://github.example.com/api/v3/search/code?q=x'), 'search/code')
+        self.assertEqual(metrics.endpoint('https://github.example.com/api/v3/repos/org/repo'), 'repos')
+        self.assertEqual(metrics.endpoint('https://github.example.com/api/graphql'), 'graphql')
+        self.assertEqual(metrics.endpoint('https://api.github.com/users/org'), 'users')
+
+    def test_scan_instrumented(self):
+        """Check a search records its requests, pages, timeframe filtering and regex evaluations"""
+
+        responses = metrics.RESPONSES.value(endpoint='search/issues', status=200)
+        pages = metrics.PAGES.value(endpoint='search/issues')
+        filtered = metrics.TIMEFRAME_FILTERED.value(scope='issues')
+        with GitHubStub(results=150) as stub:
+            limiter = RateLimiter(search_limit=1000, backoff_base=0.01)
+            connection = GitHubAPIClient('token', stub.url, rate_limiter=limiter)
+            results = list(query_issues(connection, RULE, 'access_token', timeframe=cfg.DAY_TIMEFRAME))
+        self.assertEqual(results, [])
+        self.assertEqual(metrics.RESPONSES.value(endpoint='search/issues', status=200) - responses, 2)
+        self.assertEqual(metrics.PAGES.value(endpoint='search/issues') - pages, 2)
+        self.assertEqual(metrics.TIMEFRAME_FILTERED.value(scope='issues') - filtered, 150)
+        self.assertEqual(metrics.REGEX_EVALUATIONS.value(rule=RULE.filename), 0)
+
+        with GitHubStub(results=10) as stub:
+            connection = GitHubAPIClient('token', stub.url, rate_limiter=RateLimiter(search_limit=1000))
+            self.assertEqual(len(list(query_issues(connection, RULE, 'access_token'))), 10)
+        self.assertEqual(metrics.REGEX_EVALUATIONS.value(rule=RULE.filename), 10)
+
+    def test_server_and_summary(self):
+        """Check metrics are served at /metrics and written as a JSON summary"""
+
+        registry = metrics.Registry()
+        registry.counter('findings', 'Findings', ['rule']).inc(rule='aws')
+        server = metrics.MetricsServer(0, registry=registry)
+        try:
+            with urllib.request.urlopen('http://127.0.0.1:{}/metrics'.format(server.port)) as response:
+                self.assertTrue(response.headers.get('Content-Type').startswith('application/openmetrics-text'))
+                self.assertIn('findings_total{rule="aws"} 1', response.read().decode('utf-8'))
+        finally:
+            server.close()
+
+        path = os.path.join(tempfile.mkdtemp(), 'summary.json')
+        registry.write_summary(path)
+        with open(path) as summary_file:
+            self.assertEqual(json.load(summary_file), {'findings': {'aws': 1}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime, timezone
+
+import github_watchman.parquet_logger as parquet_logger
+
+COMMIT_FINDING = {
+    'commit_url': 'https://github.com/westeros/lannister_docs/commit/abc',
+    'sha': 'abc',
+    'comments_url': None,
+    'committer_name': 'Tyrion Lannister',
+    'committer_id': 12345,
+    'committer_email': 'tyrion@westeros.com',
+    'committer_login': 'tlannister',
+    'commit_date': '2020-09-27T02:47:23+01:00',
+    'message': 'Add token',
+    'repository': {
+        'repository_id': 1,
+        'repository_node_id': 'R_1',
+        'repository_name': 'lannister_docs',
+        'repository_url': 'https://github.com/westeros/lannister_docs'
+    },
+    'matches': [{'object_url': 'https://github.com/westeros/lannister_docs/commit/abc', 'object_type': 'Commit',
+                 'fragment': 'token = abc'}]
+}
+
+
+@unittest.skipIf(parquet_logger.pyarrow is None, 'pyarrow is not installed')
+class TestParquetLogger(unittest.TestCase):
+    def setUp(self):
+        self.out_path = tempfile.mkdtemp()
+
+    def test_typed_columns(self):
+        """Check findings are written with typed columns to a file partitioned by scope and rule"""
+
+        parquet = parquet_logger.ParquetLogger(self.out_path)
+        parquet.write_row('tokens', 'commits', COMMIT_FINDING, 'Tokens', 70)
+        path = parquet.complete('tokens', 'commits')
+        self.assertEqual(os.path.dirname(path), os.path.join(self.out_path, 'scope=commits', 'rule=tokens'))
+
+        table = parquet_logger.parquet.read_table(path)
+        self.assertEqual(table.schema, parquet_logger.schema('commits'))
+        row = table.to_pylist()[0]
+        self.assertEqual(row.get('committer_id'), 12345)
+        self.assertEqual(row.get('severity'), 70)
+        self.assertEqual(row.get('repository_name'), 'lannister_docs')
+        self.assertEqual(row.get('commit_date'), datetime(2020, 9, 27, 1, 47, 23, tzinfo=timezone.utc))
+        self.assertEqual(row.get('matches'), COMMIT_FINDING.get('matches'))
+
+    def test_row_groups(self):
+        """Check buffered findings are written out a row group at a time"""
+
+        parquet = parquet_logger.ParquetLogger(self.out_path, row_group_size=10)
+        for index in range(25):
+            parquet.write_row('tokens', 'commits', dict(COMMIT_FINDING, sha=str(index)), 'Tokens', 70)
+        path = parquet.writers.get(('tokens', 'commits'))[0]
+        self.assertEqual(len(parquet.writers.get(('tokens', 'commits'))[2]), 5)
+        parquet.close()
+
+        metadata = parquet_logger.parquet.ParquetFile(path).metadata
+        self.assertEqual([metadata.row_group(group).num_rows for group in range(metadata.num_row_groups)],
+                         [10, 10, 5])
+        self.assertIsNone(parquet.complete('tokens', 'commits'))
+
+
+class TestTimestamp(unittest.TestCase):
+    def test_formats(self):
+        """Check the date formats GitHub and git use are read as UTC"""
+
+        expected = datetime(2020, 9, 27, 1, 47, 23, tzinfo=timezone.utc)
+        self.assertEqual(parquet_logger._timestamp('2020-09-27T01:47:23Z'), expected)
+        self.assertEqual(parquet_logger._timestamp('2020-09-27T02:47:23+01:00'), expected)
+        self.assertEqual(parquet_logger._timestamp('2020-09-26T20:47:23-0500'), expected)
+        self.assertEqual(parquet_logger._timestamp('2020-09-27T01:47:23.500+00:00'),
+                         expected.replace(microsecond=500000))
+        self.assertIsNone(parquet_logger._timestamp(None))
+        self.assertRaises(ValueError, parquet_logger._timestamp, '27/09/2020')
+
+
+if __name__ == '__main__':
+    unittest.main()
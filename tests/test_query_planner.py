@@ -0,0 +1,95 @@
+import unittest
+
+import github_watchman.query_planner as query_planner
+from github_watchman.github_wrapper import GitHubAPIClient
+from github_watchman.ratelimit import RateLimiter
+from github_watchman.rule_engine import Rule
+from github_watchman.scheduler import ScanScheduler
+from benchmarks.github_stub import GitHubStub
+
+
+def rule(filename, pattern, strings):
+    return Rule({'filename': filename, 'pattern': pattern, 'strings': strings, 'meta': {'name': filename}})
+
+
+ACCESS_TOKENS = rule('access_tokens.yaml', 'access_token', ['"access_token:"', 'ACCESS_TOKEN'])
+TOKENS = rule('tokens.yaml', 'access_token', ['access_token', 'token'])
+SECRETS = rule('secrets.yaml', 'client_secret', ['secret', 'secret in:file extension:json', 'password is'])
+
+
+class CountingRule(Rule):
+    __slots__ = ('searches',)
+
+    def search(self, fragment):
+        self.searches = getattr(self, 'searches', 0) + 1
+        return super().search(fragment)
+
+
+class TestQueryPlanner(unittest.TestCase):
+    def test_duplicates_merged(self):
+        """Check the same string from several rules is searched once for all of them"""
+
+        planned = query_planner.plan([(ACCESS_TOKENS, 'code', 'ACCESS_TOKEN'), (TOKENS, 'code', 'access_token'),
+                                      (TOKENS, 'commits', 'access_token')])
+        self.assertEqual([(query.scope, query.query) for query in planned],
+                         [('code', 'access_token'), ('commits', 'access_token')])
+        self.assertEqual(planned[0].rules, [ACCESS_TOKENS, TOKENS])
+
+    def test_combined_by_qualifiers(self):
+        """Check single terms are ORed together with strings sharing their qualifiers, and other strings are left alone"""
+
+        items = [(rule, 'code', string) for rule in (ACCESS_TOKENS, TOKENS, SECRETS) for string in rule.strings]
+        planned = query_planner.plan(items)
+        self.assertEqual([query.query for query in planned],
+                         ['"access_token:" OR access_token OR token OR secret', 'secret in:file extension:json',
+                          'password is'])
+        self.assertEqual(planned[0].rules, [ACCESS_TOKENS, TOKENS, SECRETS])
+        self.assertEqual(planned[1].rules, [SECRETS])
+
+    def test_limits(self):
+        """Check combined queries stay within GitHub's operator and length limits"""
+
+        terms = ['term{}'.format(index) for index in range(20)] + ['x' * 200, 'y' * 200]
+        planned = query_planner.plan([(TOKENS, 'code', term) for term in terms])
+        for query in planned:
+            self.assertLessEqual(query.query.count(' OR '), query_planner.MAX_OPERATORS)
+            self.assertLessEqual(len(query.query.replace(' OR ', ' ')), query_planner.MAX_QUERY_LENGTH)
+        self.assertEqual(sorted(term for query in planned for term in query.query.split(' OR ')), sorted(terms))
+
+    def test_matched_once(self):
+        """Check the rules a result matched when it was filtered are reused to route it"""
+
+        rules = [CountingRule({'filename': '{}.yaml'.format(name), 'pattern': name}) for name in ('token', 'secret')]
+        planned = query_planner.PlannedQuery('issues', 'token OR secret', rules)
+        self.assertTrue(planned.matches([{'fragment': 'token = 1', 'object_type': 'Issue'}]))
+        self.assertEqual(planned.matching_rules([{'fragment': 'token = 1'}]), rules[:1])
+        self.assertEqual([rule.searches for rule in rules], [1, 1])
+        self.assertEqual(planned.matched, {})
+
+
+class TestPlannedScan(unittest.TestCase):
+    def scan(self, merge_queries):
+        findings = {}
+        with GitHubStub(results=20) as stub:
+            limiter = RateLimiter(search_limit=1000, backoff_base=0.01)
+            connection = GitHubAPIClient('token', stub.url, max_workers=4, rate_limiter=limiter)
+            jobs = [(rule, 'code') for rule in (ACCESS_TOKENS, TOKENS, SECRETS)]
+            ScanScheduler(connection, None, merge_queries=merge_queries).run(
+                jobs, lambda rule, scope, finding: findings.setdefault(rule.filename, []).append(finding.get('sha')))
+            searches = [request for request in stub.requests if request[0].endswith('/search/code')]
+        return findings, searches
+
+    def test_same_findings_fewer_searches(self):
+        """Check merged queries find the same results for each rule with fewer searches"""
+
+        merged, merged_searches = self.scan(True)
+        separate, separate_searches = self.scan(False)
+        self.assertEqual({filename: sorted(shas) for filename, shas in merged.items()},
+                         {filename: sorted(shas) for filename, shas in separate.items()})
+        self.assertEqual(sorted(merged), ['access_tokens.yaml', 'tokens.yaml'])
+        self.assertEqual(len(merged_searches), 3)
+        self.assertEqual(len(separate_searches), 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import time
+import unittest
+
+from github_watchman.ratelimit import RateLimiter
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_backoff_jittered_and_capped(self):
+        """Check backoff grows exponentially, is jittered and never passes the cap"""
+
+        limiter = RateLimiter(backoff_base=1, backoff_cap=10)
+        for attempt, ceiling in ((0, 1), (1, 2), (2, 4), (8, 10)):
+            delay = limiter.backoff(attempt)
+            self.assertGreaterEqual(delay, ceiling / 2)
+            self.assertLessEqual(delay, ceiling)
+
+    def test_retry_budget(self):
+        """Check server errors are retried until max_retries is reached"""
+
+        limiter = RateLimiter(max_retries=2)
+        self.assertIsNotNone(limiter.retry_delay('core', 0, 502))
+        self.assertIsNotNone(limiter.retry_delay('core', 1, None))
+        self.assertIsNone(limiter.retry_delay('core', 2, 502))
+
+    def test_not_retried(self):
+        """Check client errors and permission 403s are not retried"""
+
+        limiter = RateLimiter()
+        self.assertIsNone(limiter.retry_delay('core', 0, 404))
+        self.assertIsNone(limiter.retry_delay('core', 0, 403, {'X-RateLimit-Remaining': '10'}, 'Forbidden'))
+        self.assertIsNotNone(limiter.retry_delay('core', 0, 403, {'X-RateLimit-Remaining': '10'},
+                                                 '{"message": "You have exceeded a secondary rate limit"}'))
+
+    def test_abuse_limit_blocks_resource(self):
+        """Check a Retry-After holds back every request for the resource, not just the retry"""
+
+        limiter = RateLimiter()
+        self.assertGreaterEqual(limiter.retry_delay('search', 0, 403, {'Retry-After': '60'}), 60)
+        self.assertGreater(limiter.reserve('search'), 50)
+        self.assertEqual(limiter.reserve('core'), 0)
+        self.assertGreater(limiter.state().get('search').get('wait'), 50)
+
+    def test_pacing(self):
+        """Check the last of the quota is spread out until the reset instead of used at once"""
+
+        limiter = RateLimiter(search_limit=1000)
+        limiter.update('search', {'X-RateLimit-Limit': '30', 'X-RateLimit-Remaining': '2',
+                                  'X-RateLimit-Reset': str(int(time.time()) + 60)})
+        self.assertEqual(limiter.reserve('search'), 0)
+        self.assertGreater(limiter.reserve('search'), 10)
+
+        limiter.update('core', {'X-RateLimit-Limit': '5000', 'X-RateLimit-Remaining': '4000',
+                                'X-RateLimit-Reset': str(int(time.time()) + 60)})
+        self.assertEqual(limiter.reserve('core'), 0)
+        self.assertEqual(limiter.reserve('core'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+import os
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import github_watchman.rule_engine as rule_engine
+from github_watchman.rule_engine import Rule, RuleEngine, load_rules
+
+RULES_PATH = (Path(__file__).parents[1] / 'github_watchman/rules').resolve()
+
+
+def rule(filename, pattern):
+    return Rule({'filename': filename, 'enabled': True, 'pattern': pattern})
+
+
+class TestRuleEngine(unittest.TestCase):
+    def test_matches_fragments_only(self):
+        """Check patterns are matched against fragments, not the repr of the text_matches"""
+
+        test_rule = rule('quote.yaml', r"^'fragment'")
+        text_matches = [{'object_url': 'https://github.example.com', 'fragment': 'secret'}]
+        self.assertFalse(test_rule.matches(text_matches))
+        self.assertTrue(rule('secret.yaml', '^secret$').matches(text_matches))
+
+    def test_combined_flags_scoped(self):
+        """Check inline flags only apply to the pattern they were written for"""
+
+        engine = RuleEngine([rule('a.yaml', '(?i)token'), rule('b.yaml', 'KEY')])
+        self.assertEqual([r.filename for r in engine.matching_rules('TOKEN key')], ['a.yaml'])
+        self.assertEqual([r.filename for r in engine.matching_rules('token KEY')], ['a.yaml', 'b.yaml'])
+        self.assertEqual(engine.matching_rules('nothing here'), [])
+
+    def test_overlapping_matches(self):
+        """Check a rule whose match is inside another rule's match is still found"""
+
+        engine = RuleEngine([rule('long.yaml', 'abcdef'), rule('short.yaml', 'cd')])
+        self.assertEqual([r.filename for r in engine.matching_rules('abcdef')], ['long.yaml', 'short.yaml'])
+
+    def test_empty_pattern(self):
+        """Check a rule with an empty pattern matches everything without hiding other rules"""
+
+        engine = RuleEngine([rule('empty.yaml', ''), rule('key.yaml', 'key')])
+        self.assertEqual([r.filename for r in engine.matching_rules('a key')], ['empty.yaml', 'key.yaml'])
+        self.assertEqual([r.filename for r in engine.matching_rules('nothing')], ['empty.yaml'])
+
+    def test_engine_agrees_with_rules(self):
+        """Check the combined engine finds the same rules as matching each rule separately"""
+
+        rules = load_rules(RULES_PATH)
+        engine = RuleEngine(rules)
+        self.assertIsNotNone(engine.combined)
+        for test_rule in rules:
+            for test_case in test_rule.test_cases.get('match_cases') + test_rule.test_cases.get('fail_cases'):
+                self.assertEqual(engine.matching_rules(test_case),
+                                 [r for r in rules if r.search(test_case)], msg=test_case)
+
+
+    def check_matcher(self, matcher):
+        rules = load_rules(RULES_PATH) + [rule('lookbehind.yaml', '(?<!x)key')]
+        engine = RuleEngine(rules, matcher)
+        self.assertEqual([r.filename for r in engine.matcher.fallback], ['aws_api_tokens.yaml', 'lookbehind.yaml'])
+        for test_rule in rules:
+            for test_case in test_rule.test_cases.get('match_cases', []) + test_rule.test_cases.get('fail_cases', []):
+                self.assertEqual(engine.matching_rules(test_case),
+                                 [r for r in rules if r.search(test_case)], msg=test_case)
+        self.assertEqual([r.filename for r in engine.matching_rules('a key')],
+                         ['interesting_files.yaml', 'lookbehind.yaml'])
+
+    @unittest.skipIf(rule_engine.re2 is None, 'google-re2 is not installed')
+    def test_re2_matcher(self):
+        """Check the re2 matcher finds the same rules as re, checking unsupported patterns with re"""
+
+        self.check_matcher('re2')
+
+    @unittest.skipIf(rule_engine.hyperscan is None, 'hyperscan is not installed')
+    def test_hyperscan_matcher(self):
+        """Check the hyperscan matcher finds the same rules as re, checking unsupported patterns with re"""
+
+        self.check_matcher('hyperscan')
+
+    @unittest.skipIf(rule_engine.regex is None, 'regex is not installed')
+    def test_match_timeout(self):
+        """Check matching gives up on a fragment once it runs past the time budget"""
+
+        slow = rule('slow.yaml', '(x+x+)+y')
+        engine = RuleEngine([slow, rule('key.yaml', 'x')])
+        timeout = rule_engine.MATCH_TIMEOUT
+        rule_engine.MATCH_TIMEOUT = 0.05
+        try:
+            self.assertEqual([r.filename for r in engine.matching_rules('x' * 5000)], ['key.yaml'])
+        finally:
+            rule_engine.MATCH_TIMEOUT = timeout
+        self.assertGreater(slow.timeouts, 0)
+
+
+class TestRulePack(unittest.TestCase):
+    def setUp(self):
+        self.rules_path = tempfile.mkdtemp()
+        self.cache_path = tempfile.mkdtemp()
+        for name in ('aws_api_tokens.yaml', 'slack_api_tokens.yaml'):
+            shutil.copy(os.path.join(RULES_PATH, name), self.rules_path)
+
+    def load(self):
+        return [(r.filename, r.pattern) for r in load_rules(self.rules_path, self.cache_path)]
+
+    def test_pack_reused(self):
+        """Check rules come from the pack until a rule file changes"""
+
+        loaded = self.load()
+        self.assertEqual(loaded, [(r.filename, r.pattern) for r in load_rules(self.rules_path)])
+        with mock.patch.object(rule_engine, '_parse_rules', side_effect=AssertionError('parsed')):
+            self.assertEqual(self.load(), loaded)
+            # Touched without changing, the pack is still used
+            os.utime(os.path.join(self.rules_path, 'slack_api_tokens.yaml'), ns=(0, 0))
+            self.assertEqual(self.load(), loaded)
+
+        with open(os.path.join(self.rules_path, 'slack_api_tokens.yaml')) as rule_file:
+            definition = rule_file.read()
+        with open(os.path.join(self.rules_path, 'slack_api_tokens.yaml'), 'w') as rule_file:
+            rule_file.write(definition.replace('enabled: true', 'enabled: false'))
+        self.assertEqual(self.load(), loaded[:1])
+
+    def test_corrupt_pack_rebuilt(self):
+        """Check an unreadable pack is rebuilt rather than failing the scan"""
+
+        loaded = self.load()
+        for name in os.listdir(self.cache_path):
+            with open(os.path.join(self.cache_path, name), 'wb') as pack_file:
+                pack_file.write(b'not a pack')
+        self.assertEqual(self.load(), loaded)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import threading
+import unittest
+from unittest import mock
+
+import github_watchman.scheduler as scheduler
+from github_watchman.github_wrapper import GitHubAPIClient
+from github_watchman.ratelimit import RateLimiter
+from github_watchman.rule_engine import Rule
+from github_watchman.scheduler import ScanScheduler
+from benchmarks.github_stub import GitHubStub
+
+RULES = [Rule({'filename': 'rule{}.yaml'.format(index), 'pattern': 'access_token',
+               'strings': ['access_token{}'.format(index)]}) for index in range(40)]
+
+
+class TestScanScheduler(unittest.TestCase):
+    def test_interrupted_scan_returns(self):
+        """Check a scan interrupted mid-stream stops its workers and returns instead of hanging"""
+
+        found = []
+        raised = []
+
+        def output(rule, scope, finding):
+            found.append(finding)
+            if len(found) == 5:
+                raise KeyboardInterrupt()
+
+        def scan():
+            try:
+                ScanScheduler(connection, None, workers=2, merge_queries=False).run(
+                    [(rule, 'issues') for rule in RULES], output)
+            except BaseException as e:
+                raised.append(e)
+
+        with GitHubStub(results=50, search_limit=10000) as stub, \
+                mock.patch.object(scheduler, 'MAX_PENDING_FINDINGS', 10):
+            connection = GitHubAPIClient('token', stub.url, rate_limiter=RateLimiter(search_limit=10000))
+            thread = threading.Thread(target=scan, daemon=True)
+            thread.start()
+            thread.join(timeout=20)
+            self.assertFalse(thread.is_alive())
+            requests = len(stub.requests)
+        self.assertEqual([type(e) for e in raised], [KeyboardInterrupt])
+        self.assertEqual(len(found), 5)
+        # Queries not yet started were cancelled rather than run
+        self.assertLess(requests, len(RULES))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+from unittest import mock
+
+import github_watchman.logger as logger
+from github_watchman.github_wrapper import GitHubAPIClient
+from github_watchman.ratelimit import RateLimiter
+from github_watchman.sharding import MAX_CODE_SIZE, Shard
+from benchmarks.github_stub import GitHubStub
+
+
+class TestShard(unittest.TestCase):
+    def test_split(self):
+        """Check a shard splits into two halves that cover its range without overlapping"""
+
+        low, high = Shard('access_token', 'size', 0, 101).split()
+        self.assertEqual((low.low, low.high, high.low, high.high), (0, 50, 51, 101))
+        self.assertEqual(low.query, 'access_token size:0..50')
+        self.assertFalse(Shard('access_token', 'size', 7, 7).splittable())
+
+    def test_for_endpoint(self):
+        """Check each search endpoint is sharded on its own qualifier"""
+
+        self.assertEqual(Shard.for_endpoint('search/code', 'x').high, MAX_CODE_SIZE)
+        self.assertEqual(Shard.for_endpoint('search/commits', 'x').qualifier, 'author-date')
+        self.assertIn('created:2007-10-01T00:00:00Z..', Shard.for_endpoint('search/issues', 'x').query)
+        self.assertIsNone(Shard.for_endpoint('search/labels', 'x'))
+
+
+class TestShardedSearch(unittest.TestCase):
+    def test_past_result_cap(self):
+        """Check a search matching more than 1000 results returns all of them"""
+
+        with GitHubStub(results=2500, search_limit=1000) as stub:
+            limiter = RateLimiter(search_limit=1000, backoff_base=0.01)
+            items = GitHubAPIClient('token', stub.url, rate_limiter=limiter).multipage_search(
+                'search/code', 'access_token')
+        self.assertEqual(sorted(item.get('sha') for item in items), ['{:040x}'.format(i) for i in range(2500)])
+
+    def test_under_cap_unsharded(self):
+        """Check searches under the cap are run without a qualifier"""
+
+        with GitHubStub(results=150) as stub:
+            GitHubAPIClient('token', stub.url, rate_limiter=RateLimiter(search_limit=1000)).multipage_search(
+                'search/code', 'access_token')
+        self.assertEqual({params.get('q')[0] for _, params, _ in stub.requests}, {'access_token'})
+
+    def test_unsplittable_logged(self):
+        """Check a search past the cap that can't be sharded is reported through the output logger"""
+
+        log_handler = logger.StdoutLogger()
+        with GitHubStub(results=1500, search_limit=1000) as stub, \
+                mock.patch.object(log_handler, 'log_info') as log_info, mock.patch('builtins.print') as printed:
+            items = GitHubAPIClient('token', stub.url, rate_limiter=RateLimiter(search_limit=1000),
+                                    log_handler=log_handler).multipage_search('search/users', 'access_token')
+        self.assertEqual(len(items), 1000)
+        log_info.assert_called_once_with('1500 results for access_token, only the first 1000 can be returned')
+        printed.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import tempfile
+import unittest
+
+from github_watchman.rule_engine import Rule
+from github_watchman.state import ScanState, fingerprint, result_fingerprint
+
+RULE = Rule({'filename': 'access_tokens.yaml', 'pattern': 'access_token'})
+
+
+class TestScanState(unittest.TestCase):
+    def setUp(self):
+        self.state = ScanState(tempfile.mkdtemp())
+
+    def test_first_run_unqualified(self):
+        """Check queries are left alone until a rule has completed a run"""
+
+        self.assertEqual(self.state.qualify(RULE, 'issues', '"access_token:"'), '"access_token:"')
+
+    def test_qualify(self):
+        """Check date qualifiers are added for scopes that support them"""
+
+        self.state.record(RULE, 'issues', [], 1600000000)
+        self.state.record(RULE, 'code', [], 1600000000)
+        self.assertEqual(self.state.qualify(RULE, 'issues', '"access_token:"'),
+                         '"access_token:" updated:>2020-09-13T11:26:40Z')
+        self.assertEqual(self.state.qualify(RULE, 'code', '"access_token:"'), '"access_token:"')
+
+    def test_seen(self):
+        """Check reported results are fingerprinted the same way as raw search results"""
+
+        result = {'sha': 'abc', 'file_url': 'https://github.example.com/a'}
+        self.state.record(RULE, 'code', [result_fingerprint('code', result)])
+        self.assertIn(fingerprint('abc', 'https://github.example.com/a'), self.state.seen(RULE, 'code'))
+        self.assertEqual(self.state.seen(RULE, 'commits'), set())
+        self.assertIsNone(self.state.watermark(RULE, 'code'))
+
+
+if __name__ == '__main__':
+    unittest.main()